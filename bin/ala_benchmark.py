@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+import pathfix
+import ala
+import governor
+import metrics
+import fake_ala_server
+import logging
+import argparse
+import json
+import os
+import os.path
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+#requests per second allowed by default. Much higher than against the real
+#ALA, so the request governor doesn't hide how fast the code is
+MAX_REQUEST_RATE = 1000.0
+#ways of fetching records that can be benchmarked. 'syncer' is a whole
+#first sync into a database, like ala_db_update.py does
+CASES = ('search', 'search-concurrent', 'facet', 'download', 'syncer')
+STRATEGY_CASES = ('search', 'search-concurrent', 'facet', 'download')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Measures how fast records are fetched, against a
+        local stand-in for ALA (see fake_ala_server.py), so the numbers only
+        change when the code does. Reports records/sec, bytes/record and
+        peak RSS for each ala.records_for_species strategy, and optionally a
+        whole sync into a scratch database.
+
+        Each case runs in its own process, once to warm up the stand-in's
+        response cache, then --repeat times, and the median run is
+        reported. Save the results with --output, and compare a later run
+        against them with --baseline.''')
+
+    fake_ala_server.add_dataset_args(parser)
+    fake_ala_server.add_server_args(parser)
+
+    parser.add_argument('--cases', type=str, nargs='+', choices=CASES,
+        default=list(STRATEGY_CASES), help='''The cases to run. Default is
+        every strategy. 'syncer' needs --db-config.''')
+
+    parser.add_argument('--repeat', type=int, default=3,
+        help='''Runs of each case. Default is %(default)s.''')
+
+    parser.add_argument('--concurrency', type=int, default=4,
+        help='''Pages fetched at the same time by the 'search-concurrent'
+        case. Default is %(default)s.''')
+
+    parser.add_argument('--max-request-rate', type=float,
+        default=MAX_REQUEST_RATE, dest='max_request_rate',
+        help='''Requests per second allowed by the request governor, which
+        starts at this rate instead of ramping up to it. Default is
+        %(default)s. Give {0} to see the limits used against ALA.'''.format(
+            governor.MAX_RATE))
+
+    parser.add_argument('--max-concurrent-requests', type=int,
+        default=governor.MAX_CONCURRENCY, dest='max_concurrent_requests',
+        help='''Requests in flight allowed by the request governor. Default
+        is %(default)s.''')
+
+    parser.add_argument('--db-config', type=str, default=None,
+        dest='db_config', help='''The JSON config file of a SCRATCH database
+        for the 'syncer' case. Its species, sources, occurrences and sync
+        ledger are deleted before every run.''')
+
+    parser.add_argument('--output', type=str, default=None,
+        help='''Save the results to this JSON file.''')
+
+    parser.add_argument('--baseline', type=str, default=None,
+        help='''Compare the results with a JSON file saved by --output.''')
+
+    parser.add_argument('--log-level', type=str, nargs=1,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default=['WARNING'], help='''Determines how much info is
+            printed.''')
+
+    # used to run one case in a subprocess
+    parser.add_argument('--run-case', type=str, choices=CASES,
+        dest='run_case', help=argparse.SUPPRESS)
+    parser.add_argument('--ala-url', type=str, dest='ala_url',
+        help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def run_case(args):
+    '''Runs args.run_case against the server at args.ala_url, and returns a
+    dict of the results. Runs in the subprocess.'''
+
+    ala.BIE = ala.BIOCACHE = args.ala_url
+    ala.set_request_governor(governor.Governor(
+            initial_rate=args.max_request_rate,
+            max_rate=args.max_request_rate,
+            initial_concurrency=args.max_concurrent_requests,
+            max_concurrency=args.max_concurrent_requests))
+
+    if args.run_case == 'syncer':
+        return run_syncer_case(args)
+
+    strategy = args.run_case.split('-')[0]
+    concurrency = args.concurrency if args.run_case.endswith('-concurrent') \
+            else 1
+    species = list(ala.all_bird_species())
+
+    stats = ala.reset_request_stats()
+    start_time = time.time()
+    num_records = 0
+    for s in species:
+        records = ala.records_for_species(s.lsid, strategy,
+                concurrency=concurrency)
+        for record in records:
+            num_records += 1
+    seconds = time.time() - start_time
+
+    return {
+        'records': num_records,
+        'bytes': stats.bytes,
+        'requests': stats.requests,
+        'seconds': seconds,
+    }
+
+
+def run_syncer_case(args):
+    '''A first sync of every species, like `ala_db_update.py` does'''
+    import db
+    import sync
+    import ala_db_update
+
+    with open(args.db_config, 'rb') as f:
+        db.connect(json.load(f))
+    ala_source_id = reset_db()
+
+    syncer = sync.Syncer()
+    start_time = time.time()
+    ala_db_update.update_species(syncer, True, True)
+    from_d, to_d = syncer.start_ledger(None, datetime.utcnow())
+    if not ala_db_update.update_occurrences(syncer, from_d, to_d,
+                                            ala_source_id):
+        raise RuntimeError('Some species failed to sync')
+    syncer.close()
+    seconds = time.time() - start_time
+
+    counters = metrics.registry().summary()['counters']
+    return {
+        'records': int(counters.get('records_written_total', 0)),
+        'bytes': int(counters.get('http_bytes_total', 0)),
+        'requests': int(sum(value for name, value in counters.iteritems()
+                            if name.startswith('http_requests_total'))),
+        'seconds': seconds,
+    }
+
+
+def reset_db():
+    '''Empties the scratch database, and returns the id of the ALA row in
+    the sources table'''
+    import db
+    db.occurrences_ratings_bridge.delete().execute()
+    db.occurrences.delete().execute()
+    db.sync_ledger.delete().execute()
+    db.species.delete().execute()
+    db.sources.delete().execute()
+    result = db.sources.insert().execute(name='ALA', last_import_time=None)
+    return result.inserted_primary_key[0]
+
+
+def run_case_process(case, url, args):
+    '''Runs one case in a new process, and returns its results with the
+    peak RSS of the process (and its fetch workers) added'''
+
+    command = [sys.executable, os.path.abspath(__file__),
+               '--run-case', case,
+               '--ala-url', url,
+               '--concurrency', str(args.concurrency),
+               '--max-request-rate', str(args.max_request_rate),
+               '--max-concurrent-requests', str(args.max_concurrent_requests),
+               '--log-level', args.log_level[0]]
+    if args.db_config is not None:
+        command += ['--db-config', args.db_config]
+
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.stdout.read()
+    # wait4 gives the resource usage of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = status
+    if status != 0:
+        raise RuntimeError('Benchmark case {0} failed'.format(case))
+
+    result = json.loads(output.strip().splitlines()[-1])
+    result['case'] = case
+    # ru_maxrss is in KB on Linux
+    result['peak_rss_mb'] = usage.ru_maxrss / 1024.0
+    result['records_per_second'] = result['records'] / result['seconds']
+    result['bytes_per_record'] = \
+            result['bytes'] / float(max(1, result['records']))
+    return result
+
+
+def settings(args, dataset):
+    '''What the results depend on, besides the code'''
+    return {
+        'fixture': args.fixture,
+        'species': len(dataset.species),
+        'records': dataset.num_records,
+        'seed': args.seed,
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'bandwidth': args.bandwidth,
+        'error_rate': args.error_rate,
+        'gzip': args.gzip,
+        'concurrency': args.concurrency,
+        'max_request_rate': args.max_request_rate,
+        'max_concurrent_requests': args.max_concurrent_requests,
+        'page_size': ala.PAGE_SIZE,
+        'python': platform.python_version(),
+    }
+
+
+def print_results(results, baseline):
+    print '{0:<18} {1:>9} {2:>8} {3:>10} {4:>9} {5:>9} {6:>9}'.format(
+            'case', 'records', 'seconds', 'records/s', 'bytes/rec',
+            'requests', 'peak MB')
+    for r in results:
+        print '{0:<18} {1:>9} {2:>8.2f} {3:>10.0f} {4:>9.1f} {5:>9} ' \
+              '{6:>9.1f}'.format(r['case'], r['records'], r['seconds'],
+                r['records_per_second'], r['bytes_per_record'],
+                r['requests'], r['peak_rss_mb'])
+
+    if baseline is None:
+        return
+
+    print
+    print 'Compared with the baseline:'
+    print '{0:<18} {1:>10} {2:>10} {3:>10}'.format(
+            'case', 'records/s', 'bytes/rec', 'peak MB')
+    baseline_results = dict((r['case'], r) for r in baseline['results'])
+    for r in results:
+        old = baseline_results.get(r['case'])
+        if old is None:
+            print '{0:<18} {1:>10}'.format(r['case'], 'new')
+            continue
+        print '{0:<18} {1:>10} {2:>10} {3:>10}'.format(r['case'],
+                percent_change(old['records_per_second'],
+                               r['records_per_second']),
+                percent_change(old['bytes_per_record'],
+                               r['bytes_per_record']),
+                percent_change(old['peak_rss_mb'], r['peak_rss_mb']))
+
+
+def percent_change(old, new):
+    if not old:
+        return '-'
+    return '{0:+.1f}%'.format((new - old) * 100.0 / old)
+
+
+def benchmark(args):
+    if 'syncer' in args.cases and args.db_config is None:
+        raise SystemExit("The 'syncer' case needs --db-config")
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'rb') as f:
+            baseline = json.load(f)
+
+    dataset = fake_ala_server.dataset_from_args(args)
+    run_settings = settings(args, dataset)
+    if baseline is not None and baseline['settings'] != run_settings:
+        logging.warning('The baseline was run with different settings, so '
+                        'the results may not be comparable')
+
+    server = fake_ala_server.server_from_args(args, dataset)
+    server.start()
+    results = []
+    try:
+        for case in args.cases:
+            run_case_process(case, server.url, args)  # warm up
+            runs = []
+            for _ in xrange(args.repeat):
+                runs.append(run_case_process(case, server.url, args))
+                logging.info('%s: %0.2fs', case, runs[-1]['seconds'])
+            runs.sort(key=lambda r: r['seconds'])
+            results.append(runs[len(runs) // 2])
+    finally:
+        server.stop()
+
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'wb') as f:
+            json.dump({'settings': run_settings, 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.__dict__[args.log_level[0]])
+
+    if args.run_case is not None:
+        print json.dumps(run_case(args))
+    else:
+        benchmark(args)
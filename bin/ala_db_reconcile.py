@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import pathfix
+import db
+import sync
+import ala
+import reconcile
+import logging
+import argparse
+import json
+from datetime import datetime
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Deletes occurrences from the local database that have
+        been deleted from ALA. Downloads the uuid of every record of every
+        species, so this takes a while. Run it occasionally, not every
+        update.''')
+
+    parser.add_argument('--strategy', type=str, choices=['facet', 'search'],
+        default='facet', help='''How the record uuids are fetched. 'facet'
+        downloads one CSV of uuids per species, which is the least data.
+        'search' pages through search results. Default is %(default)s.''')
+
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+        help='''Count the deleted occurrences, but don't delete them.''')
+
+    parser.add_argument('--max-delete-fraction', type=float,
+        default=reconcile.MAX_DELETE_FRACTION, dest='max_delete_fraction',
+        help='''Species with more than this fraction of their occurrences
+        missing from ALA are skipped, in case ALA is having problems. Default
+        is %(default)s.''')
+
+    parser.add_argument('--species', type=str, action='append',
+        dest='species', help='''Only reconcile the species with this
+        scientific name. Can be given more than once.''')
+
+    parser.add_argument('--log-level', type=str, nargs=1,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default=['INFO'], help='''Determines how much info is printed.''')
+
+    parser.add_argument('config', metavar='config_file', type=str, nargs=1,
+            help='''The path to the JSON config file.''')
+
+    return parser.parse_args()
+
+
+def species_to_reconcile(syncer, names=None):
+    '''Returns a dict of LSID to species_id, for the species with the given
+    scientific names, or every species if `names` is None'''
+
+    species_ids = syncer.species_ids_by_lsid()
+    if names is None:
+        return species_ids
+
+    wanted = set()
+    for name in names:
+        row = db.species.select()\
+                .where(db.species.c.scientific_name == name)\
+                .execute().fetchone()
+        if row is None:
+            logging.warning('Species not in local db: %s', name)
+        else:
+            wanted.add(row['id'])
+
+    return dict((lsid, species_id)
+                for lsid, species_id in species_ids.iteritems()
+                if species_id in wanted)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.__dict__[args.log_level[0]])
+
+    with open(args.config[0], 'rb') as f:
+        db.connect(json.load(f))
+
+    logging.info("Started at %s", str(datetime.now()))
+    try:
+        species_ids = species_to_reconcile(sync.Syncer(), args.species)
+        reconciler = reconcile.Reconciler(args.strategy, args.dry_run,
+                args.max_delete_fraction)
+        reconciler.reconcile(species_ids)
+    finally:
+        logging.info("Ended at %s", str(datetime.now()))
@@ -4,6 +4,10 @@ import pathfix
 import sys
 import db
 import sync
+import ala
+import governor
+import metrics
+import profiling
 import logging
 import argparse
 import json
@@ -31,6 +35,109 @@ def parse_args():
         anything to the occurrences table. Useful if you only want to update
         the species table.''')
 
+    parser.add_argument('--global-changes', action='store_true',
+        dest='global_changes', help='''Fetch changed occurrences with one
+        query for all bird species, instead of one query per species. This is
+        much faster for small, frequent (e.g. nightly) updates where most
+        species haven't changed. Only used for incremental updates, not the
+        first sync, and not when resuming an interrupted sync.''')
+
+    parser.add_argument('--write-mode', type=str,
+        choices=sorted(sync.FLUSH_THRESHOLDS.keys()), default='insert',
+        dest='write_mode', help='''How occurrences are written to the
+        database. 'insert' uses big INSERT statements. 'load' bulk loads
+        occurrences through a temporary staging table with LOAD DATA LOCAL
+        INFILE, which is much faster for initial loads and big updates, but
+        needs "local_infile=1" in the query string of the db url. Default is
+        %(default)s.''')
+
+    parser.add_argument('--flush-threshold', type=int, default=None,
+        dest='flush_threshold', help='''Number of occurrences written to the
+        database at a time. Defaults to 1000 for the 'insert' write mode, and
+        100000 for the 'load' write mode.''')
+
+    parser.add_argument('--http-pool-size', type=int,
+        default=ala.HTTP_POOL_SIZE, dest='http_pool_size', help='''The
+        maximum number of idle keep-alive connections kept per host, in each
+        process. Default is %(default)s.''')
+
+    parser.add_argument('--http-idle-timeout', type=float,
+        default=ala.HTTP_IDLE_TIMEOUT, dest='http_idle_timeout', help='''Idle
+        keep-alive connections are closed after this many seconds. Default is
+        %(default)s.''')
+
+    parser.add_argument('--connect-timeout', type=float,
+        default=ala.CONNECT_TIMEOUT, dest='connect_timeout', help='''Seconds
+        to wait for a connection to ALA to open before trying again. Default
+        is %(default)s.''')
+
+    parser.add_argument('--read-timeout', type=float,
+        default=ala.READ_TIMEOUT, dest='read_timeout', help='''Seconds to
+        wait for ALA to send more of a response before trying again. Default
+        is %(default)s.''')
+
+    parser.add_argument('--hedge-requests', action='store_true',
+        dest='hedge_requests', help='''If a request takes longer than 95%% of
+        recent requests, send it again and use whichever response arrives
+        first. Uses a few more requests, but stops a few stalled requests
+        from holding up the whole sync.''')
+
+    parser.add_argument('--max-request-rate', type=float,
+        default=governor.MAX_RATE, dest='max_request_rate', help='''The most
+        requests per second sent to ALA, by all processes together. The rate
+        starts lower and adapts to how fast ALA responds. Default is
+        %(default)s.''')
+
+    parser.add_argument('--max-concurrent-requests', type=int,
+        default=governor.MAX_CONCURRENCY, dest='max_concurrent_requests',
+        help='''The most requests waiting on ALA at once, by all processes
+        together. Default is %(default)s.''')
+
+    parser.add_argument('--ipc-batch-size', type=int,
+        default=sync.IPC_BATCH_SIZE, dest='ipc_batch_size', help='''The max
+        number of records each fetch process sends to the main process at a
+        time. Default is %(default)s.''')
+
+    parser.add_argument('--ipc-flush-interval', type=float,
+        default=sync.IPC_FLUSH_INTERVAL, dest='ipc_flush_interval', help='''Max
+        seconds a fetch process holds on to records before sending them to the
+        main process. Default is %(default)s.''')
+
+    parser.add_argument('--shard-max-records', type=int,
+        default=sync.SHARD_MAX_RECORDS, dest='shard_max_records',
+        help='''Species with more occurrences than this are split into date
+        ranges, which are fetched in parallel. Default is %(default)s.''')
+
+    parser.add_argument('--cache-dir', type=str, default=None,
+        dest='cache_dir', help='''Cache responses from the BIE taxonomy web
+        services in this directory, so repeated runs don't fetch them again.
+        Not cached by default.''')
+
+    parser.add_argument('--cache-max-mb', type=float, default=100,
+        dest='cache_max_mb', help='''The least recently used responses are
+        deleted when the cache gets bigger than this. Default is
+        %(default)s.''')
+
+    parser.add_argument('--metrics-json', type=str, default=None,
+        dest='metrics_json', help='''Write a JSON summary of where the time
+        went (counters and timings of each stage of the sync) to this file
+        at exit.''')
+
+    parser.add_argument('--metrics-textfile', type=str, default=None,
+        dest='metrics_textfile', help='''Keep this file up to date with the
+        same metrics in the Prometheus text format during the run, for
+        node_exporter's textfile collector. Should end in .prom''')
+
+    parser.add_argument('--profile', type=str, default=None,
+        metavar='DIR', help='''Profile the main process and every fetch
+        worker, and write the merged profile to DIR/report.txt, and
+        DIR/stacks.collapsed for flamegraph.pl. The profile of each process
+        is kept in DIR too. Slows the update down a bit.''')
+
+    parser.add_argument('--ala-url', type=str, default=None,
+        dest='ala_url', help='''Send every request for BIE and biocache to
+        this url instead of ALA, e.g. a fake_ala_server.py.''')
+
     parser.add_argument('--log-level', type=str, nargs=1,
             choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
             default=['INFO'], help='''Determines how much info is printed.''')
@@ -45,7 +152,8 @@ def update_species(syncer, add_new=True, delete_old=True):
     '''Updates the species table in the database
 
     Checks ALA for new species, and species that have been deleted (e.g. merged
-    into another existing species).
+    into another existing species). Also caches the current LSID of every
+    species, which saves the occurrence fetching from looking them up again.
     '''
     if not add_new and not delete_old:
         return
@@ -60,26 +168,77 @@ def update_species(syncer, add_new=True, delete_old=True):
         for species in added:
             syncer.add_species(species)
 
+    syncer.refresh_species_lsids()
+
 
 def update_occurrences(syncer, from_d, to_d, ala_source_id):
-    '''Updates the occurrences table of the db with data from ALA '''
+    '''Updates the occurrences table of the db with data from ALA.
+
+    Progress is saved in the sync ledger as it goes. Returns True if every
+    species was synced, or False if some failed and need to be resumed by
+    running this script again. Call syncer.start_ledger first.'''
+
+    writer = sync.BackgroundWriter(syncer)
+    try:
+        for item in syncer.ledger_updates():
+            writer.write(item)
+    finally:
+        writer.close()
 
-    for occurrence in syncer.occurrences_changed_since(from_d):
-        syncer.upsert_occurrence(occurrence, occurrence.species_id)
+    if not syncer.ledger_is_complete():
+        return False
 
-    syncer.flush_upserts()
+    syncer.clear_ledger()
+    return True
+
+
+def update_occurrences_globally(syncer, from_d, to_d):
+    '''Updates the occurrences table of the db with the records of every
+    species that changed between `from_d` and `to_d`, with one query'''
+
+    writer = sync.BackgroundWriter(syncer)
+    try:
+        for batch in syncer.global_occurrence_batches_changed_since(from_d,
+                to_d):
+            writer.write(batch)
+    finally:
+        writer.close()
 
 
 def update():
     ala_source = db.sources.select().execute(name='ALA').fetchone()
     from_d = ala_source['last_import_time']
     to_d = datetime.utcnow()
-    syncer = sync.Syncer()
+    syncer = sync.Syncer(args.write_mode, args.flush_threshold)
 
     update_species(syncer, not args.dont_add_species, not args.dont_delete_species)
 
     if not args.dont_update_occurrences:
-        update_occurrences(syncer, from_d, to_d, ala_source['id'])
+        if args.global_changes and from_d is not None and \
+                syncer.ledger_is_empty():
+            syncer.start_run('global', from_d, to_d)
+            completed = False
+            try:
+                update_occurrences_globally(syncer, from_d, to_d)
+                completed = True
+            finally:
+                finish_run(syncer, completed)
+        else:
+            # an interrupted sync is resumed with its original dates
+            from_d, to_d = syncer.start_ledger(from_d, to_d)
+            syncer.start_run('species', from_d, to_d)
+            completed = False
+            try:
+                completed = update_occurrences(syncer, from_d, to_d,
+                                               ala_source['id'])
+            finally:
+                finish_run(syncer, completed)
+
+            if not completed:
+                logging.warning('Some species failed to sync. Run again to '
+                                'resume where this run left off.')
+                return
+
         # only set the last_import_time if records were updated
         db.sources.update().\
                 where(db.sources.c.id == ala_source['id']).\
@@ -87,19 +246,60 @@ def update():
                 execute()
 
 
+def finish_run(syncer, completed):
+    '''Saves the run stats. Failing to save them shouldn't fail the sync.'''
+    try:
+        syncer.finish_run(completed)
+    except Exception:
+        logging.exception('Failed to save sync run stats')
+
 if __name__ == '__main__':
     args = parse_args()
 
     logging.basicConfig()
     logging.root.setLevel(logging.__dict__[args.log_level[0]])
 
+    if args.ala_url is not None:
+        ala.BIE = ala.BIOCACHE = args.ala_url
+    ala.HTTP_POOL_SIZE = args.http_pool_size
+    ala.HTTP_IDLE_TIMEOUT = args.http_idle_timeout
+    ala.CONNECT_TIMEOUT = args.connect_timeout
+    ala.READ_TIMEOUT = args.read_timeout
+    ala.HEDGE_REQUESTS = args.hedge_requests
+    sync.IPC_BATCH_SIZE = args.ipc_batch_size
+    sync.IPC_FLUSH_INTERVAL = args.ipc_flush_interval
+    sync.SHARD_MAX_RECORDS = args.shard_max_records
+    ala.set_request_governor(governor.Governor(
+            max_rate=args.max_request_rate,
+            initial_concurrency=sync.FETCH_WORKERS,
+            max_concurrency=args.max_concurrent_requests))
+
+    if args.cache_dir is not None:
+        ala.enable_response_cache(args.cache_dir,
+                int(args.cache_max_mb * 1024 * 1024))
+
     with open(args.config[0], 'rb') as f:
         db.connect(json.load(f))
 
+    if args.profile is not None:
+        profiling.enable(args.profile)
+
+    textfile_writer = None
+    if args.metrics_textfile is not None:
+        textfile_writer = metrics.TextfileWriter(metrics.registry(),
+                args.metrics_textfile)
+
     logging.info("Started at %s", str(datetime.now()))
     try:
-        update()
+        profiling.profile_call('main', update)
     finally:
+        if args.profile is not None:
+            profiling.write_reports()
+        logging.info("Request stats: %s", ala.request_governor().stats())
+        if textfile_writer is not None:
+            textfile_writer.close()
+        if args.metrics_json is not None:
+            metrics.registry().write_json(args.metrics_json)
         logging.info("Ended at %s", str(datetime.now()))
 
 
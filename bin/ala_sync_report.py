@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import pathfix
+import db
+import runstats
+import argparse
+import json
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Prints the performance of recent occurrence syncs, the
+        species that got slower to fetch in the latest one, and an estimate of
+        how long a full load of the occurrences would take.''')
+
+    parser.add_argument('--runs', type=int, default=10, help='''The number of
+        recent syncs to show. Default is %(default)s.''')
+
+    parser.add_argument('--records', type=int, default=16000000, help='''The
+        number of records to estimate the time of a full load for. Default is
+        %(default)s.''')
+
+    parser.add_argument('config', metavar='config_file', type=str, nargs=1,
+            help='''The path to the JSON config file.''')
+
+    return parser.parse_args()
+
+
+def print_runs(runs):
+    print '{0:>5} {1:<19} {2:<7} {3:>3} {4:>10} {5:>8} {6:>8} {7:>8} ' \
+          '{8:>8} {9:>7} {10:>7} {11:>8}'.format(
+            'id', 'started', 'mode', 'ok', 'records', 'MB', 'minutes',
+            'rec/s', 'requests', 'retries', 'p95 s', 'db s')
+
+    for run in runs:
+        print '{0:>5} {1:<19} {2:<7} {3:>3} {4:>10} {5:>8.1f} {6:>8.1f} ' \
+              '{7:>8} {8:>8} {9:>7} {10:>7} {11:>8.1f}'.format(
+                run['id'],
+                run['started_time'].strftime('%Y-%m-%d %H:%M:%S'),
+                run['mode'],
+                'yes' if run['completed'] else 'no',
+                run['records'],
+                run['bytes'] / 1048576.0,
+                run['seconds'] / 60.0,
+                format_rate(run['records'], run['seconds']),
+                run['requests'],
+                run['retries'],
+                '-' if run['latency_p95'] is None
+                    else '{0:.2f}'.format(run['latency_p95']),
+                run['db_flush_seconds'])
+
+
+def print_regressions(run_id):
+    regressions = runstats.species_regressions(run_id)
+    if len(regressions) == 0:
+        print 'No species got slower to fetch in run {0}.'.format(run_id)
+        return
+
+    print 'Species that got slower to fetch in run {0}:'.format(run_id)
+    for species_id, name, rate, median_rate in regressions:
+        print '  {0} ({1}): {2:.0f} rec/s, usually {3:.0f} rec/s'.format(
+                name, species_id, rate, median_rate)
+
+
+def print_projection(runs, num_records):
+    '''Estimates a full load from the fastest completed species sync, since
+    full loads fetch every species in parallel'''
+
+    runs = [r for r in runs
+            if r['completed'] and r['mode'] == 'species' and
+            r['records'] >= runstats.REGRESSION_MIN_RECORDS]
+    if len(runs) == 0:
+        print 'No completed species syncs to project a full load from.'
+        return
+
+    fetch_rate = max(r['records'] / float(r['seconds'])
+                     for r in runs if r['seconds'])
+    db_rates = [r['records'] / float(r['db_flush_seconds'])
+                for r in runs if r['db_flush_seconds']]
+
+    print 'Projected full load of {0} records:'.format(num_records)
+    print '  fetching from ALA: {0:.1f} hours at {1:.0f} rec/s'.format(
+            runstats.projected_hours(num_records, fetch_rate), fetch_rate)
+    if db_rates:
+        db_rate = max(db_rates)
+        print '  writing to the db: {0:.1f} hours at {1:.0f} rec/s'.format(
+                runstats.projected_hours(num_records, db_rate), db_rate)
+
+
+def format_rate(records, seconds):
+    if not seconds:
+        return '-'
+    return '{0:.0f}'.format(records / float(seconds))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    with open(args.config[0], 'rb') as f:
+        db.connect(json.load(f))
+
+    runs = runstats.recent_runs(args.runs)
+    if len(runs) == 0:
+        print 'No syncs have been recorded yet.'
+    else:
+        print_runs(runs)
+        print
+        print_regressions(runs[0]['id'])
+        print
+        print_projection(runs, args.records)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import pathfix
+import db
+import export
+import snapshot
+import argparse
+import json
+import logging
+import sys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='''Writes a CSV file of
+        SPPCODE,LATDEC,LONGDEC rows for each species into a directory, from
+        the occurrences already in the local database (see
+        ala_db_update.py), the same as fetch_occur_csv.py --output-dir
+        writes from ALA. A manifest.json of the records and time taken for
+        each species is written too. Species already in the manifest are
+        skipped, so an interrupted export can be carried on by running it
+        again.''')
+
+    parser.add_argument('config', metavar='config_file', type=str, nargs=1,
+            help='''The path to the JSON config file.''')
+
+    parser.add_argument('output_dir', metavar='output_dir', type=str,
+            nargs=1, help='''The directory to write the files into.''')
+
+    parser.add_argument('species', metavar='SPECIES', type=str, nargs='*',
+            help='''Scientific names or LSIDs of the species to export.
+            Default is every species in the database.''')
+
+    parser.add_argument('--species-concurrency', type=int,
+            default=export.SPECIES_CONCURRENCY, dest='species_concurrency',
+            help='''Default is %(default)s. The number of species read at
+            the same time, each on its own database connection.''')
+
+    parser.add_argument('--gzip', action='store_true',
+            help='''Gzip the files.''')
+
+    parser.add_argument('--snapshot', type=str, default=None,
+            choices=sorted(snapshot.FLOAT_SIZES), help='''Write columnar
+            snapshot files (see src/snapshot.py) with latitudes and
+            longitudes of this type, instead of CSV. They load without
+            parsing, straight into numpy arrays.''')
+
+    parser.add_argument('--valid-only', action='store_true',
+            dest='valid_only', help='''Leave out records rated 'known
+            invalid' or 'assumed invalid'. By default every record is
+            exported, like the ALA exports of fetch_occur_csv.py.''')
+
+    parser.add_argument('--no-resume', action='store_false', dest='resume',
+            help='''Export every species again, even if it is already in the
+            manifest.''')
+
+    parser.add_argument('--log-level', type=str, nargs=1,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default=['INFO'], help='''Determines how much info is printed.''')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.__dict__[args.log_level[0]])
+
+    if args.snapshot is not None and args.gzip:
+        raise SystemExit("Snapshots can't be gzipped")
+
+    with open(args.config[0], 'rb') as f:
+        db.connect(json.load(f))
+
+    writer = None
+    if args.snapshot is not None:
+        writer = snapshot.SnapshotWriter(args.snapshot)
+    db_export = export.DatabaseExport(args.output_dir[0],
+            compress=args.gzip,
+            species_concurrency=args.species_concurrency,
+            valid_only=args.valid_only,
+            writer=writer)
+    try:
+        manifest = db_export.run(args.species or None, args.resume)
+    except ValueError, e:
+        raise SystemExit(str(e))
+
+    logging.info('Exported %d records of %d species in %0.2f secs, %d failed',
+            manifest['records'], len(manifest['species']),
+            manifest['seconds'], len(manifest['failed']))
+    if manifest['failed']:
+        sys.exit(1)
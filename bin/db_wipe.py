@@ -20,10 +20,13 @@ if '--go' not in sys.argv:
 with open('config.json', 'rb') as f:
     db.connect(json.load(f))
 
-# wipe
+# wipe, child tables first, so nothing is left pointing at deleted rows
+db.sync_species_stats.delete().execute()
+db.sync_runs.delete().execute()
+db.sync_ledger.delete().execute()
+db.occurrences.delete().execute()
 db.species.delete().execute()
 db.sources.delete().execute()
-db.occurrences.delete().execute()
 
 # insert species
 db.species.insert().execute(
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+import pathfix
+import db
+import sync
+import writebench
+import logging
+import argparse
+import json
+import platform
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Measures how fast occurrences are written to the db by
+        each combination of storage engine, write path and flush threshold,
+        using made up records. Reports rows/sec, flush times, lock waits and
+        how much the indexes grow.
+
+        DROPS THE OCCURRENCES TABLE of the database in the config file, so
+        only run it against a scratch database, and give --go to show you
+        mean it. The table is created again empty at the end.''')
+
+    parser.add_argument('config', type=str, help='''The JSON config file of
+        the scratch database.''')
+
+    parser.add_argument('--go', action='store_true', help='''Required,
+        because the occurrences table is dropped.''')
+
+    parser.add_argument('--rows', type=int, default=1000000,
+        help='''Rows written by each trial. Default is %(default)s.''')
+
+    parser.add_argument('--initial-rows', type=int, default=0,
+        dest='initial_rows', help='''Rows written into the table before each
+        trial starts timing, to measure writing into a big table. Default is
+        %(default)s.''')
+
+    parser.add_argument('--update-fraction', type=float, default=0.1,
+        dest='update_fraction', help='''The fraction of rows that update an
+        existing row instead of inserting a new one. Default is
+        %(default)s.''')
+
+    parser.add_argument('--species', type=int, default=800,
+        help='''The number of species the rows are split between. Default is
+        %(default)s.''')
+
+    parser.add_argument('--engines', type=str, nargs='+',
+        choices=['MyISAM', 'InnoDB'], default=['MyISAM'],
+        help='''Storage engines of the occurrences table. Default is
+        %(default)s.''')
+
+    parser.add_argument('--write-paths', type=str, nargs='+',
+        choices=writebench.WRITE_PATHS, default=['insert', 'load'],
+        dest='write_paths', help='''Ways of writing the rows. 'insert' and
+        'load' are the --write-mode options of ala_db_update.py, and
+        'executemany' is a parameterised version of 'insert'. Default is
+        %(default)s.''')
+
+    parser.add_argument('--flush-thresholds', type=int, nargs='+',
+        default=None, dest='flush_thresholds', help='''Rows per flush. The
+        default is the default of each write path ({0}).'''.format(
+            ', '.join('{0} for {1}'.format(n, mode) for mode, n
+                      in sorted(sync.FLUSH_THRESHOLDS.iteritems()))))
+
+    parser.add_argument('--readers', type=int, default=0,
+        help='''Threads reading the table while it is written, like the web
+        site does, to show lock contention. Default is %(default)s.''')
+
+    parser.add_argument('--samples', type=int, default=4,
+        help='''Times the table size is sampled during each trial. Default is
+        %(default)s.''')
+
+    parser.add_argument('--seed', type=int, default=0,
+        help='''The made up rows are the same for the same seed. Default is
+        %(default)s.''')
+
+    parser.add_argument('--output', type=str, default=None,
+        help='''Save the results to this JSON file.''')
+
+    parser.add_argument('--log-level', type=str, nargs=1,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default=['INFO'], help='''Determines how much info is printed.''')
+
+    return parser.parse_args()
+
+
+def trials(args):
+    thresholds = args.flush_thresholds or [None]
+    for engine in args.engines:
+        for write_path in args.write_paths:
+            for threshold in thresholds:
+                yield writebench.Trial(engine, write_path, threshold)
+
+
+def print_results(results):
+    print '{0:<7} {1:<11} {2:>7} {3:>9} {4:>9} {5:>8} {6:>8} {7:>9} ' \
+          '{8:>9} {9:>10}'.format('engine', 'path', 'flush', 'rows/s',
+            'flush p95', 'tbl wait', 'row wait', 'reads/s', 'read p95',
+            'idx B/row')
+    for r in results:
+        print '{0:<7} {1:<11} {2:>7} {3:>9.0f} {4:>9.3f} {5:>8} {6:>8} ' \
+              '{7:>9.1f} {8:>9} {9:>10.1f}'.format(r['engine'],
+                r['write_path'], r['flush_threshold'], r['rows_per_second'],
+                r['flush_p95'] or 0.0, r['table_locks_waited'],
+                r['innodb_row_lock_waits'], r['reads_per_second'],
+                '-' if r['read_p95'] is None else
+                    '{0:.3f}'.format(r['read_p95']),
+                r['index_bytes_per_new_row'])
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.__dict__[args.log_level[0]])
+
+    # make sure this isn't run accidentally
+    if not args.go:
+        raise SystemExit('This drops the occurrences table. Give --go if '
+                         'this is a scratch database.')
+
+    with open(args.config, 'rb') as f:
+        db.connect(json.load(f))
+
+    results = []
+    try:
+        for trial in trials(args):
+            logging.info('Running %r', trial)
+            results.append(trial.run(args.rows,
+                                     update_fraction=args.update_fraction,
+                                     num_species=args.species,
+                                     initial_rows=args.initial_rows,
+                                     num_readers=args.readers,
+                                     num_samples=args.samples,
+                                     seed=args.seed))
+    finally:
+        writebench.create_occurrences_table('MyISAM')
+
+    print_results(results)
+    if args.output is not None:
+        settings = {
+            'rows': args.rows,
+            'initial_rows': args.initial_rows,
+            'update_fraction': args.update_fraction,
+            'species': args.species,
+            'readers': args.readers,
+            'seed': args.seed,
+            'python': platform.python_version(),
+        }
+        with open(args.output, 'wb') as f:
+            json.dump({'settings': settings, 'results': results}, f,
+                      indent=2, sort_keys=True)
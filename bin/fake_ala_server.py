@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import pathfix
+import fakeala
+import logging
+import argparse
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Serves made up or recorded species and occurrence
+        records through the same web services as ALA, for running the other
+        scripts offline. Give them --ala-url http://HOST:PORT/''')
+
+    add_dataset_args(parser)
+    add_server_args(parser)
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+        help='''The address to listen on. Default is %(default)s.''')
+
+    parser.add_argument('--port', type=int, default=8080,
+        help='''The port to listen on. Default is %(default)s.''')
+
+    parser.add_argument('--record', type=str, metavar='LSID',
+        action='append', help='''Instead of serving anything, fetch the
+        records of this species from ALA and save them into the --fixture
+        file. Can be given more than once.''')
+
+    parser.add_argument('--log-level', type=str, nargs=1,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default=['INFO'], help='''Determines how much info is printed.''')
+
+    return parser.parse_args()
+
+
+def add_dataset_args(parser):
+    '''Arguments for `dataset_from_args`. Also used by ala_benchmark.py'''
+
+    parser.add_argument('--fixture', type=str, default=None,
+        help='''Serve the records in this fixture file, instead of made up
+        ones.''')
+
+    parser.add_argument('--species', type=int, default=20,
+        help='''The number of made up species. Default is %(default)s.''')
+
+    parser.add_argument('--records', type=int, default=100000,
+        help='''The number of made up records, split between the species.
+        Default is %(default)s.''')
+
+    parser.add_argument('--seed', type=int, default=0,
+        help='''Made up records are the same for the same seed. Default is
+        %(default)s.''')
+
+
+def add_server_args(parser):
+    '''Arguments for `server_from_args`. Also used by ala_benchmark.py'''
+
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='''Seconds before each response starts. Default is
+        %(default)s.''')
+
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+        dest='latency_jitter', help='''Up to this many more seconds are
+        randomly added to the latency. Default is %(default)s.''')
+
+    parser.add_argument('--bandwidth', type=float, default=None,
+        help='''Limit each response to this many KB/s. Not limited by
+        default.''')
+
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        dest='error_rate', help='''The fraction of requests that fail.
+        Default is %(default)s.''')
+
+    parser.add_argument('--error-status', type=int, default=503,
+        dest='error_status', help='''The HTTP status of failed requests.
+        Default is %(default)s.''')
+
+    parser.add_argument('--no-gzip', action='store_false', dest='gzip',
+        help='''Don't compress responses, even if the client asks.''')
+
+
+def dataset_from_args(args):
+    if args.fixture is not None:
+        return fakeala.Dataset.load(args.fixture)
+    return fakeala.Dataset.synthetic(args.species, args.records, args.seed)
+
+
+def server_from_args(args, dataset, host='127.0.0.1', port=0):
+    bandwidth = None
+    if args.bandwidth is not None:
+        bandwidth = args.bandwidth * 1024
+    return fakeala.StandInServer(dataset, host, port,
+            latency=args.latency,
+            latency_jitter=args.latency_jitter,
+            bandwidth=bandwidth,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            gzip=args.gzip,
+            seed=args.seed)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    logging.basicConfig()
+    logging.root.setLevel(logging.__dict__[args.log_level[0]])
+
+    if args.record:
+        if args.fixture is None:
+            raise SystemExit('--record needs a --fixture file to save to')
+        fakeala.Dataset.record(args.record).save(args.fixture)
+        raise SystemExit()
+
+    dataset = dataset_from_args(args)
+    server = server_from_args(args, dataset, args.host, args.port)
+    logging.info('Serving %d records of %d species at %s',
+                 dataset.num_records, len(dataset.species), server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
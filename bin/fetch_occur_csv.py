@@ -2,9 +2,10 @@
 
 import sys
 import pathfix
-import csv
-import string
 import ala
+import export
+import snapshot
+import profiling
 import argparse
 import textwrap
 import logging
@@ -17,7 +18,9 @@ log = logging.getLogger()
 def parse_args():
     args = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
-        description='Writes a CSV of occurrence records to standard output',
+        description='''Writes a CSV of occurrence records to standard
+        output. With --output-dir, writes one CSV file per species into the
+        directory instead, for any number of species.''',
         epilog=textwrap.dedent('''\
             Below are some example LSID values, but they are not persistant so
             they may have changed by now.
@@ -40,8 +43,41 @@ bd08-6536a53abec9
 -939c-fd3cafc1887a
         '''))
 
-    args.add_argument('lsid', metavar='LSID', type=str, nargs=1,
-            help='The LSID of the species')
+    args.add_argument('species', metavar='SPECIES', type=str, nargs='*',
+            help='''The LSID of the species. With --output-dir, any number of
+            LSIDs or scientific names.''')
+
+    args.add_argument('--output-dir', type=str, default=None,
+            dest='output_dir', help='''Write one file per species into this
+            directory, named after its SPPCODE, with a manifest.json of the
+            number of records and time taken for each. Species already in
+            the manifest are skipped, so an interrupted export can be carried
+            on by running it again.''')
+
+    args.add_argument('--species-file', type=str, default=None,
+            dest='species_file', help='''With --output-dir, also export the
+            species in this file, one LSID or scientific name per line.''')
+
+    args.add_argument('--all-birds', action='store_true', dest='all_birds',
+            help='''With --output-dir, export every bird species in ALA.''')
+
+    args.add_argument('--species-concurrency', type=int,
+            default=export.SPECIES_CONCURRENCY, dest='species_concurrency',
+            help='''Default is %(default)s. The number of species fetched at
+            the same time with --output-dir.''')
+
+    args.add_argument('--gzip', action='store_true',
+            help='''Gzip the files written with --output-dir.''')
+
+    args.add_argument('--snapshot', type=str, default=None,
+            choices=sorted(snapshot.FLOAT_SIZES), help='''With --output-dir,
+            write columnar snapshot files (see src/snapshot.py) with
+            latitudes and longitudes of this type, instead of CSV. They load
+            without parsing, straight into numpy arrays.''')
+
+    args.add_argument('--no-resume', action='store_false', dest='resume',
+            help='''Export every species with --output-dir again, even if
+            it is already in the manifest.''')
 
     args.add_argument('--speed-info', action='store_true', dest='speed_info',
             help='''Print speed information to standard error.  Useful for
@@ -60,44 +96,115 @@ bd08-6536a53abec9
             about 8kb/s).  This argument will probably be removed once the best
             strategy is clear.''')
 
-    return args.parse_args()
+    args.add_argument('--concurrency', type=int, default=1,
+            help='''Default is 1. The number of pages fetched at the same time
+            by the 'search' strategy.''')
 
+    args.add_argument('--unordered', action='store_false', dest='ordered',
+            help='''Write records in whatever order the pages arrive, instead
+            of page order. Only useful with --concurrency.''')
 
-def spp_code_for_species_name(species_name):
-    '''Uppercase alpha-only name with length <= 8
+    args.add_argument('--weighted', action='store_true',
+            help='''Write one row per distinct lat/long, with an extra COUNT
+            column holding the number of records at that lat/long, instead of
+            repeating the row COUNT times. Much smaller and faster with the
+            'facet' strategy. With other strategies COUNT is always 1.''')
 
-    Not sure if this is too restrictive, but Jeremy's example uses
-    "GOULFINC" for "Gould Finch"
-    '''
-    allowed_chars = frozenset(string.ascii_letters + ' ')
-    filtered = ''.join([c for c in species_name if c in allowed_chars])
-    filtered = filtered.upper()
-    parts = filtered.split(' ')
-    if len(parts) > 1:
-        return parts[0].strip()[:4] + parts[-1].strip()[:4]
-    else:
-        return filtered.strip()[:8]
+    args.add_argument('--cache-dir', type=str, default=None,
+        dest='cache_dir', help='''Cache responses from the BIE taxonomy web
+        services in this directory, so repeated runs don't fetch them again.
+        Not cached by default.''')
 
+    args.add_argument('--cache-max-mb', type=float, default=100,
+        dest='cache_max_mb', help='''The least recently used responses are
+        deleted when the cache gets bigger than this. Default is
+        %(default)s.''')
 
-def write_csv_for_species_lsid(species_lsid, strategy):
+    args.add_argument('--ala-url', type=str, default=None, dest='ala_url',
+        help='''Send every request for BIE and biocache to this url instead
+        of ALA, e.g. a fake_ala_server.py.''')
+
+    args.add_argument('--profile', type=str, default=None, metavar='DIR',
+        help='''Profile the fetch, including the page fetching threads, and
+        write the merged profile to DIR/report.txt, and DIR/stacks.collapsed
+        for flamegraph.pl.''')
+
+    return args.parse_args()
+
+
+def write_csv_for_species_lsid(species_lsid, strategy, concurrency=1,
+        ordered=True, weighted=False):
     species = ala.species_for_lsid(species_lsid)
-    sppCode = spp_code_for_species_name(species.scientific_name)
+    sppCode = export.spp_code_for_species_name(species.scientific_name)
 
     t = time.time()
-    num_records = 0
-    writer = csv.writer(sys.stdout)
-    writer.writerow(['SPPCODE', 'LATDEC', 'LONGDEC'])
-    for record in ala.records_for_species(species_lsid, strategy):
-        writer.writerow([sppCode, record.latitude, record.longitude])
-        num_records += 1
+    batches = ala.record_batches_for_species(species_lsid, strategy,
+            concurrency=concurrency, ordered=ordered)
+    num_records = export.write_csv(sys.stdout, sppCode, batches, weighted)
     t = time.time() - t
     log.info('Processed %d total records in %0.2f secs (%0.2f records/sec)',
             num_records, t, float(num_records) / t)
 
 
+def export_species(args):
+    '''Writes a file per species into args.output_dir. Returns False if
+    any species failed.'''
+    species = list(args.species)
+    if args.species_file is not None:
+        with open(args.species_file, 'rb') as f:
+            species.extend(line.strip() for line in f if line.strip())
+    if args.all_birds:
+        species.extend(ala.all_bird_species())
+
+    writer = None
+    if args.snapshot is not None:
+        writer = snapshot.SnapshotWriter(args.snapshot)
+    batch_export = export.BatchExport(args.output_dir, args.strategy[0],
+            weighted=args.weighted,
+            compress=args.gzip,
+            species_concurrency=args.species_concurrency,
+            page_concurrency=args.concurrency,
+            ordered=args.ordered,
+            writer=writer)
+    manifest = batch_export.run(species, args.resume)
+    log.info('Exported %d records of %d species in %0.2f secs, %d failed',
+            manifest['records'], len(manifest['species']),
+            manifest['seconds'], len(manifest['failed']))
+    return len(manifest['failed']) == 0
+
+
 if __name__ == '__main__':
     args = parse_args()
-    if args.speed_info:
-        log.setLevel(logging.INFO)
+    # batch mode always reports failures, and progress with --speed-info
+    if args.speed_info or args.output_dir is not None:
+        log.setLevel(logging.INFO if args.speed_info else logging.WARNING)
         log.addHandler(logging.StreamHandler())
-    write_csv_for_species_lsid(args.lsid[0], args.strategy[0])
+    if args.ala_url is not None:
+        ala.BIE = ala.BIOCACHE = args.ala_url
+    if args.cache_dir is not None:
+        ala.enable_response_cache(args.cache_dir,
+                int(args.cache_max_mb * 1024 * 1024))
+
+    if args.profile is not None:
+        profiling.enable(args.profile)
+
+    if args.output_dir is None and (len(args.species) != 1 or
+            args.species_file is not None or args.all_birds):
+        raise SystemExit('Give exactly one LSID, or use --output-dir')
+    if args.snapshot is not None and (args.output_dir is None or args.gzip):
+        raise SystemExit('--snapshot needs --output-dir, and no --gzip')
+
+    try:
+        if args.output_dir is None:
+            succeeded = True
+            profiling.profile_call('main', write_csv_for_species_lsid,
+                    args.species[0], args.strategy[0], args.concurrency,
+                    args.ordered, args.weighted)
+        else:
+            succeeded = profiling.profile_call('main', export_species, args)
+    finally:
+        if args.profile is not None:
+            profiling.write_reports()
+
+    if not succeeded:
+        sys.exit(1)
@@ -18,10 +18,19 @@ CREATE TABLE IF NOT EXISTS `species` (
     `id` SMALLINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
     `scientific_name` VARCHAR(256) NOT NULL,
     `common_name` VARCHAR(256) NULL
-        COMMENT "Some species don't have a common name"
+        COMMENT "Some species don't have a common name",
+    `lsid` VARCHAR(256) NULL
+        COMMENT 'the ALA LSID last seen for this species. LSIDs change over time',
+    `lsid_verified_time` DATETIME NULL
+        COMMENT 'when `lsid` was last confirmed with ALA'
 )
 CHARSET=utf8;
 
+-- For databases created before the lsid columns were added:
+--     ALTER TABLE `species`
+--         ADD COLUMN `lsid` VARCHAR(256) NULL,
+--         ADD COLUMN `lsid_verified_time` DATETIME NULL;
+
 
 -- Each row represents a data source of occurrences (e.g. ALA).
 -- Each source has many occurrences, and each occurrence belongs to one source.
@@ -67,6 +76,81 @@ PACK_KEYS=1
 ROW_FORMAT=FIXED;
 
 
+-- Progress of the current occurrence sync, one row per species (or per date
+-- window, for species with lots of occurrences), so that an interrupted sync
+-- can carry on where it left off instead of starting again.
+-- Emptied once every species has been synced.
+CREATE TABLE IF NOT EXISTS `sync_ledger` (
+    `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `species_id` SMALLINT UNSIGNED NOT NULL
+        COMMENT 'foreign key to species.id',
+    `changed_since` DATETIME NULL
+        COMMENT 'start of the date window being synced. NULL for everything',
+    `unchanged_since` DATETIME NOT NULL
+        COMMENT 'end of the date window being synced',
+    `next_offset` INT UNSIGNED NOT NULL
+        COMMENT 'number of records in the window already written to the db',
+    `status` ENUM('pending', 'done', 'failed') NOT NULL,
+    `attempts` TINYINT UNSIGNED NOT NULL
+        COMMENT 'number of times syncing this species has failed',
+    `last_error` TEXT NULL,
+
+    INDEX `idx_ledger_species_id` (species_id)
+);
+
+
+-- Performance statistics of each occurrence sync, for spotting regressions
+-- and planning capacity. See bin/ala_sync_report.py
+CREATE TABLE IF NOT EXISTS `sync_runs` (
+    `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    `started_time` DATETIME NOT NULL,
+    `finished_time` DATETIME NOT NULL,
+    `mode` VARCHAR(32) NOT NULL
+        COMMENT 'how occurrences were fetched, e.g. "species" or "global"',
+    `changed_since` DATETIME NULL,
+    `unchanged_since` DATETIME NULL,
+    `completed` TINYINT UNSIGNED NOT NULL
+        COMMENT '0 if the sync stopped early and needs to be resumed',
+    `records` INT UNSIGNED NOT NULL,
+    `bytes` BIGINT UNSIGNED NOT NULL
+        COMMENT 'bytes received over the network, mostly compressed',
+    `pages` INT UNSIGNED NOT NULL,
+    `requests` INT UNSIGNED NOT NULL,
+    `retries` INT UNSIGNED NOT NULL,
+    `failed_fetches` INT UNSIGNED NOT NULL,
+    `latency_p50` FLOAT NULL
+        COMMENT 'seconds until responses started arriving',
+    `latency_p95` FLOAT NULL,
+    `seconds` FLOAT NOT NULL
+        COMMENT 'wall clock time of the whole sync',
+    `db_flush_seconds` FLOAT NOT NULL
+        COMMENT 'time spent writing occurrences to the db',
+    `db_flushes` INT UNSIGNED NOT NULL
+);
+
+-- Per species statistics of each sync in `sync_runs`
+CREATE TABLE IF NOT EXISTS `sync_species_stats` (
+    `run_id` INT UNSIGNED NOT NULL
+        COMMENT 'foreign key to sync_runs.id',
+    `species_id` SMALLINT UNSIGNED NOT NULL
+        COMMENT 'species.id. Kept after the species is deleted',
+    `records` INT UNSIGNED NOT NULL,
+    `bytes` BIGINT UNSIGNED NOT NULL,
+    `pages` INT UNSIGNED NOT NULL,
+    `requests` INT UNSIGNED NOT NULL,
+    `retries` INT UNSIGNED NOT NULL,
+    `failed_fetches` INT UNSIGNED NOT NULL,
+    `fetch_seconds` FLOAT NOT NULL
+        COMMENT 'time fetch workers spent on this species, added up',
+    `latency_p50` FLOAT NULL,
+    `latency_p95` FLOAT NULL,
+    `latency_max` FLOAT NULL,
+
+    PRIMARY KEY (`run_id`, `species_id`),
+    INDEX `idx_stats_species_id` (species_id)
+);
+
+
 -- TODO: add extra info required per user
 CREATE TABLE IF NOT EXISTS `users` (
     `id` INT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
@@ -8,30 +8,87 @@ import pdb
 import tempfile
 import os
 import os.path
+import sys
 import csv
 import shutil
 import zipfile
 import time
 import logging
 import uuid
-from datetime import datetime
+import array
+import struct
+import cStringIO
+import itertools
+import collections
+import httppool
+import httpcache
+import jsonstream
+import governor
+import metrics
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
 
 #occurrence records per request for 'search' strategy
 PAGE_SIZE = 1000
+#max occurrence records per RecordBatch
+BATCH_SIZE = 1000
+#max number of pages fetched at the same time by _json_pages
+PAGE_CONCURRENCY = 1
+#max idle keep-alive connections kept per host, in each process
+HTTP_POOL_SIZE = 4
+#seconds before an idle keep-alive connection is thrown away
+HTTP_IDLE_TIMEOUT = 30.0
+#max seconds to wait for a connection to open, and for each read from it
+CONNECT_TIMEOUT = 15.0
+READ_TIMEOUT = 120.0
+#seconds a download can go without progress before it is given up on
+STALL_TIMEOUT = 60.0
+#if True, a GET that is slower than HEDGE_PERCENTILE of recent responses is
+#sent again, and whichever response comes back first is used
+HEDGE_REQUESTS = False
+HEDGE_PERCENTILE = 95
+#number of response times needed before hedging starts
+HEDGE_MIN_SAMPLES = 20
+#shortest date window that date_shards_for_lsid will split in half
+SHARD_MIN_WINDOW = timedelta(hours=1)
+#start of the first date window when splitting a query with no start date
+SHARD_EPOCH = datetime(2008, 1, 1)
+#sort of occurrence searches that are paged by startIndex. Without one, ALA
+#can return results in a different order each time, so resuming or retrying
+#from a saved startIndex would skip or repeat records
+SEARCH_SORT = {'sort': 'id', 'dir': 'asc'}
 BIE = 'http://bie.ala.org.au/'
 BIOCACHE = 'http://biocache.ala.org.au/'
 
 
 log = logging.getLogger(__name__)
 
+_NIL_UUID_BYTES = '\0' * 16
+#species_id, number of records
+_BATCH_HEADER = struct.Struct('=iI')
+_connection_pool = None
+_connection_pool_pid = None
+_response_cache = None
+_request_governor = None
+_latency_tracker = None
+_latency_tracker_pid = None
+_request_stats = None
+_request_stats_pid = None
+
 
 class OccurrenceRecord(object):
-    '''Plain old data structure for an occurrence record'''
+    '''Plain old data structure for an occurrence record
+
+    `count` is the number of identical records this object stands for. It is
+    always 1, except for weighted records from the 'facet' strategy.'''
 
     def __init__(self):
         self.latitude = None
         self.longitude = None
         self.uuid = None
+        self.count = 1
 
     def __repr__(self):
         return '<record uuid="{uuid}" latLong="{lat}, {lng}" />'.format(
@@ -40,6 +97,165 @@ class OccurrenceRecord(object):
             lng=self.longitude)
 
 
+class RecordBatch(object):
+    '''Column store for a batch of occurrence records from one species.
+
+    Much smaller and faster than one OccurrenceRecord per record. Latitudes
+    and longitudes are arrays of doubles, and `uuids` holds the packed 16
+    byte uuid of every record (16 zero bytes for records without a uuid).
+    `counts` is the same as OccurrenceRecord.count.
+
+    Indexing or iterating gives RecordView objects, which act like
+    OccurrenceRecord objects.
+
+    >>> batch = RecordBatch(species_id=3)
+    >>> batch.append(-19.5, 146.25, uuid.UUID(int=1).bytes)
+    >>> batch.append(-20.0, 147.0, count=4)
+    >>> len(batch), batch.total_count()
+    (2, 5)
+    >>> for record in batch:
+    ...     print record.uuid, record.latitude, record.longitude
+    00000000-0000-0000-0000-000000000001 -19.5 146.25
+    None -20.0 147.0
+    >>> batch[1].count, batch[1].species_id
+    (4, 3)
+    >>> import pickle
+    >>> unpickled = pickle.loads(pickle.dumps(batch))
+    >>> map(repr, unpickled) == map(repr, batch)
+    True
+    >>> decoded = RecordBatch.from_bytes(batch.to_bytes())
+    >>> map(repr, decoded) == map(repr, batch), decoded.species_id
+    (True, 3)
+    '''
+
+    __slots__ = ('latitudes', 'longitudes', 'uuids', 'counts', 'species_id')
+
+    def __init__(self, species_id=None):
+        self.latitudes = array.array('d')
+        self.longitudes = array.array('d')
+        self.uuids = bytearray()
+        self.counts = array.array('I')
+        self.species_id = species_id
+
+    def append(self, latitude, longitude, uuid_bytes=None, count=1):
+        self.latitudes.append(latitude)
+        self.longitudes.append(longitude)
+        self.uuids.extend(_NIL_UUID_BYTES if uuid_bytes is None
+                          else uuid_bytes)
+        self.counts.append(count)
+
+    def extend(self, other):
+        '''Appends all the records from another batch'''
+        self.latitudes.extend(other.latitudes)
+        self.longitudes.extend(other.longitudes)
+        self.uuids.extend(other.uuids)
+        self.counts.extend(other.counts)
+
+    def uuid_bytes(self, idx):
+        '''The packed uuid of a record, or None if it doesn't have one'''
+        b = str(self.uuids[idx * 16:(idx + 1) * 16])
+        return None if b == _NIL_UUID_BYTES else b
+
+    def total_count(self):
+        '''Number of records this batch stands for, counting weights'''
+        return int(sum(self.counts))
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError('RecordBatch index out of range')
+        return RecordView(self, idx)
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield RecordView(self, idx)
+
+    def clear(self):
+        '''Removes all records, but keeps the species_id'''
+        self.__init__(self.species_id)
+
+    def to_bytes(self):
+        '''Packs the batch into a compact binary string, for sending to
+        another process on the same machine. See `from_bytes`.'''
+        species_id = -1 if self.species_id is None else self.species_id
+        return ''.join((
+            _BATCH_HEADER.pack(species_id, len(self)),
+            self.latitudes.tostring(),
+            self.longitudes.tostring(),
+            str(self.uuids),
+            self.counts.tostring()))
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''The opposite of `to_bytes`'''
+        species_id, size = _BATCH_HEADER.unpack_from(data)
+        batch = cls(None if species_id < 0 else species_id)
+
+        pos = _BATCH_HEADER.size
+        columns = ((batch.latitudes, batch.latitudes.itemsize),
+                   (batch.longitudes, batch.longitudes.itemsize),
+                   (batch.uuids, 16),
+                   (batch.counts, batch.counts.itemsize))
+        for column, item_size in columns:
+            end = pos + size * item_size
+            if isinstance(column, array.array):
+                column.fromstring(data[pos:end])
+            else:
+                column.extend(data[pos:end])
+            pos = end
+
+        if pos != len(data):
+            raise ValueError('Invalid RecordBatch data')
+        return batch
+
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        other = RecordBatch.from_bytes(state)
+        for attr in RecordBatch.__slots__:
+            setattr(self, attr, getattr(other, attr))
+
+
+class RecordView(object):
+    '''One record of a RecordBatch, with the same attributes as
+    OccurrenceRecord (plus `species_id`). Read only.'''
+
+    __slots__ = ('batch', 'idx')
+
+    def __init__(self, batch, idx):
+        self.batch = batch
+        self.idx = idx
+
+    @property
+    def latitude(self):
+        return self.batch.latitudes[self.idx]
+
+    @property
+    def longitude(self):
+        return self.batch.longitudes[self.idx]
+
+    @property
+    def uuid(self):
+        b = self.batch.uuid_bytes(self.idx)
+        return None if b is None else uuid.UUID(bytes=b)
+
+    @property
+    def count(self):
+        return int(self.batch.counts[self.idx])
+
+    @property
+    def species_id(self):
+        return self.batch.species_id
+
+    def __repr__(self):
+        return OccurrenceRecord.__repr__.im_func(self)
+
+
 class Species(object):
     '''Plain old data structure for a species'''
 
@@ -58,9 +274,131 @@ class Species(object):
                    lsid=self.lsid)
 
 
+class LatencyTracker(object):
+    '''Thread safe record of the most recent `size` response times
+
+    >>> tracker = LatencyTracker(size=100)
+    >>> for i in range(200):
+    ...     tracker.add(i)
+    >>> tracker.percentile(95)
+    195
+    >>> LatencyTracker().percentile(95) is None
+    True
+    '''
+
+    def __init__(self, size=200):
+        self._times = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._times.append(seconds)
+
+    def percentile(self, pct):
+        '''Returns None until there are HEDGE_MIN_SAMPLES times'''
+        with self._lock:
+            if len(self._times) < HEDGE_MIN_SAMPLES:
+                return None
+            times = sorted(self._times)
+        return percentile(times, pct)
+
+
+class RequestStats(object):
+    '''Thread safe counters for the requests made by one process. See
+    `request_stats`.
+
+    `bytes` is the number of bytes received, before decompression where
+    possible. `cache_hits` is the number of responses read from the
+    response cache, which aren't in `requests` or `bytes`. `pages` is the
+    number of pages of results from paged web services. `latencies` has the
+    seconds until each response started.
+
+    Retries, bytes and pages are also counted in this process' metrics
+    registry (see metrics.registry), which isn't reset per fetch.'''
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.cache_hits = 0
+        self.pages = 0
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def add_request(self, latency):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(latency)
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+        metrics.inc('http_retries_total')
+
+    def add_bytes(self, num_bytes):
+        with self._lock:
+            self.bytes += num_bytes
+        metrics.inc('http_bytes_total', num_bytes)
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+        metrics.inc('http_cache_hits_total')
+
+    def add_page(self):
+        with self._lock:
+            self.pages += 1
+        metrics.inc('pages_total')
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'bytes': self.bytes,
+                'cache_hits': self.cache_hits,
+                'pages': self.pages,
+                'latencies': list(self.latencies),
+            }
+
+
+class StalledDownloadError(IOError):
+    '''Raised when a download is making hardly any progress'''
+    pass
+
+
 def records_for_species(species_lsid, strategy, changed_since=None,
-        unchanged_since=None):
-    '''A generator for OccurrenceRecord objects fetched from ALA'''
+        unchanged_since=None, concurrency=None, ordered=True, weighted=False):
+    '''A generator for OccurrenceRecord-like objects fetched from ALA
+
+    The records are RecordView objects into the batches generated by
+    `record_batches_for_species`. Use that function directly if you can,
+    because it's faster.
+
+    `weighted` only matters for the 'facet' strategy. If True, one record is
+    generated per distinct lat/long, with its `count` attribute set to the
+    number of records at that lat/long. Otherwise the same record is
+    generated `count` times.'''
+
+    batches = record_batches_for_species(species_lsid, strategy,
+            changed_since, unchanged_since, concurrency, ordered)
+    return _records_in_batches(batches, weighted)
+
+
+def record_batches_for_species(species_lsid, strategy, changed_since=None,
+        unchanged_since=None, concurrency=None, ordered=True, start_index=0):
+    '''A generator for RecordBatch objects fetched from ALA
+
+    Batches hold up to BATCH_SIZE records. Records from the 'facet' strategy
+    are weighted (see OccurrenceRecord.count).
+
+    `concurrency` and `ordered` only apply to the 'search' strategy. See
+    `_json_pages` for what they do. `start_index` also only applies to the
+    'search' strategy, and skips that many records from the start of the
+    results, which is useful for resuming an interrupted fetch.'''
+
+    if start_index != 0 and strategy != 'search':
+        raise ValueError('start_index only works with the search strategy')
 
     q = q_param_for_lsid(
             species_lsid,
@@ -68,15 +406,109 @@ def records_for_species(species_lsid, strategy, changed_since=None,
             unchanged_since=unchanged_since)
 
     if strategy == 'search':
-        return _search_records_for_species(q)
+        return _search_batches_for_species(q, concurrency, ordered,
+                start_index)
     elif strategy == 'download':
-        return _downloadzip_records_for_species(q)
+        return _downloadzip_batches_for_species(q)
     elif strategy == 'facet':
-        return _facet_records_for_species(q)
+        return _facet_batches_for_species(q)
     else:
         raise ValueError('Invalid strategy: ' + strategy)
 
 
+def record_uuids_for_species(species_lsid, strategy='facet'):
+    '''A generator for the uuids (as 16 byte strings) of every record of a
+    species, for finding records that have been deleted from ALA.
+
+    The 'facet' strategy downloads one CSV of the distinct record ids, which
+    is the least data ALA can send. The 'search' strategy pages through
+    search results like `record_batches_for_species` does.'''
+
+    q = q_param_for_lsid(species_lsid)
+    if strategy == 'facet':
+        response = _fetch(create_request(
+            BIOCACHE + 'ws/occurrences/facets/download',
+            {
+                'q': q,
+                'facets': 'id',
+                'count': 'true'
+            }))
+        reader = csv.reader(response)
+        if reader.next()[0] != 'id':
+            raise RuntimeError('Unexpected heading for id facet')
+        for row in reader:
+            yield uuid.UUID(row[0]).bytes
+        _add_bytes_received(response, 0)
+    elif strategy == 'search':
+        url = BIOCACHE + 'ws/occurrences/search'
+        params = {
+            'q': q,
+            'fl': 'id',
+            'facet': 'off',
+        }
+        params.update(SEARCH_SORT)
+        occurrences = _json_items(url, params, ('totalRecords',),
+                'startIndex', ('occurrences',))
+        for occ in occurrences:
+            yield uuid.UUID(occ['uuid']).bytes
+    else:
+        raise ValueError('Invalid strategy: ' + strategy)
+
+
+def changed_bird_record_batches(species_ids, changed_since,
+        unchanged_since=None, concurrency=None, ordered=True):
+    '''A generator for RecordBatch objects of the records of every bird
+    species that changed between `changed_since` and `unchanged_since`.
+
+    This is one query for all species, so it only costs as many requests as
+    there are pages of changed records, no matter how many species there
+    are.
+
+    `species_ids` is a dict of species LSID to the `species_id` to give their
+    batches. Records of species that aren't in it are skipped. Each batch only
+    holds the records of one species. See `_json_pages` for what
+    `concurrency` and `ordered` do.'''
+
+    url = BIOCACHE + 'ws/occurrences/search'
+    params = {
+        'q': q_param_for_birds(changed_since=changed_since,
+                               unchanged_since=unchanged_since),
+        'fl': 'id,latitude,longitude,species_guid',
+        'facet': 'off',
+    }
+    params.update(SEARCH_SORT)
+
+    occurrences = _json_items(url, params, ('totalRecords',), 'startIndex',
+            ('occurrences',), concurrency, ordered)
+
+    batches = {}
+    unknown = collections.Counter()
+    for occ in occurrences:
+        species_lsid = occ.get('speciesGuid')
+        species_id = species_ids.get(species_lsid)
+        if species_id is None:
+            unknown[species_lsid] += 1
+            continue
+
+        batch = batches.get(species_id)
+        if batch is None:
+            batch = batches[species_id] = RecordBatch(species_id)
+        batch.append(occ['decimalLatitude'], occ['decimalLongitude'],
+                     uuid.UUID(occ['uuid']).bytes)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            del batches[species_id]
+
+    for batch in batches.itervalues():
+        yield batch
+
+    if len(unknown) > 0:
+        log.warning('Skipped %d changed records of %d unknown species',
+                sum(unknown.itervalues()), len(unknown))
+        for species_lsid, num_records in unknown.most_common(10):
+            log.debug('Skipped %d records of: %s', num_records, species_lsid)
+
+
 def species_for_lsid(species_lsid):
     '''Fetches a Species object by its LSID
 
@@ -90,7 +522,13 @@ def species_for_lsid(species_lsid):
 
     escaped_lsid = urllib.quote(species_lsid)
     url = BIE + 'species/shortProfile/{0}.json'.format(escaped_lsid)
-    info = _fetch_json(create_request(url), check_not_empty=False)
+    try:
+        info = _fetch_json(create_request(url), check_not_empty=False)
+    except urllib2.HTTPError, e:
+        if e.code == 404:
+            return None
+        raise
+
     if not info or len(info) == 0:
         return None
 
@@ -143,25 +581,48 @@ def all_bird_species():
               ('fq', 'idxtype:TAXON'))
     total_key_path = ('searchResults', 'totalRecords')
 
-    for page in _json_pages(url, params, total_key_path, 'start'):
-        for result in page['searchResults']['results']:
-            s = Species()
-            s.lsid = result['guid']
-            s.scientific_name = result['nameComplete'].strip()
-            if result['commonNameSingle'] is not None:
-                s.common_name = result['commonNameSingle'].strip()
+    results = _json_items(url, params, total_key_path, 'start',
+            ('searchResults', 'results'))
+    for result in results:
+        s = Species()
+        s.lsid = result['guid']
+        s.scientific_name = result['nameComplete'].strip()
+        if result['commonNameSingle'] is not None:
+            s.common_name = result['commonNameSingle'].strip()
 
-            yield s
+        yield s
 
 
-def num_records_for_lsid(lsid):
+def num_records_for_lsid(lsid, changed_since=None, unchanged_since=None):
     j = _fetch_json(create_request(BIOCACHE + 'ws/occurrences/search', {
-            'q': q_param_for_lsid(lsid),
+            'q': q_param_for_lsid(lsid, changed_since=changed_since,
+                                  unchanged_since=unchanged_since),
             'facet': 'off',
-            'pageSize': 0}))
+            'pageSize': 0}), check_not_empty=False)
     return j['totalRecords']
 
 
+def date_shards_for_lsid(lsid, changed_since, unchanged_since, max_records):
+    '''Splits the records of a species into date windows (on
+    last_processed_date) of up to about `max_records` records each, so they
+    can be fetched in parallel without deep startIndex offsets.
+
+    Returns a list of (changed_since, unchanged_since, num_records), oldest
+    first, which together cover the given window. Windows aren't split
+    smaller than SHARD_MIN_WINDOW, so a window can still have more than
+    `max_records` records if lots were processed at the same time.
+
+    Date ranges in queries include both ends, so a record processed exactly
+    on the boundary between two windows is fetched twice.'''
+
+    def count(from_date, to_date):
+        return num_records_for_lsid(lsid, from_date, to_date)
+
+    total = count(changed_since, unchanged_since)
+    return _date_shards(changed_since, unchanged_since, total, max_records,
+                        count)
+
+
 def create_request(url, params=None, use_get=True):
     '''URL encodes params and into a GET or POST request'''
     if params is not None:
@@ -174,6 +635,104 @@ def create_request(url, params=None, use_get=True):
     return urllib2.Request(url, params)
 
 
+def connection_pool():
+    '''The httppool.ConnectionPool that all requests go through.
+
+    Each process gets its own pool, because sockets can't be shared safely
+    between forked processes. Call `reset_connection_pool` after changing
+    HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT, CONNECT_TIMEOUT or READ_TIMEOUT.'''
+
+    global _connection_pool, _connection_pool_pid
+    if _connection_pool is None or _connection_pool_pid != os.getpid():
+        _connection_pool = httppool.ConnectionPool(
+                HTTP_POOL_SIZE, HTTP_IDLE_TIMEOUT, CONNECT_TIMEOUT,
+                READ_TIMEOUT)
+        _connection_pool_pid = os.getpid()
+    return _connection_pool
+
+
+def reset_connection_pool():
+    '''Closes all idle connections and creates a new pool for this process'''
+    global _connection_pool
+    if _connection_pool is not None and _connection_pool_pid == os.getpid():
+        _connection_pool.close()
+    _connection_pool = None
+    return connection_pool()
+
+
+def request_governor():
+    '''The governor.Governor that limits the rate and concurrency of all
+    requests. Created with default limits if `set_request_governor` hasn't
+    been called.'''
+    global _request_governor
+    if _request_governor is None:
+        _request_governor = governor.Governor()
+    return _request_governor
+
+
+def latency_tracker():
+    '''The LatencyTracker of recent response times in this process'''
+    global _latency_tracker, _latency_tracker_pid
+    if _latency_tracker is None or _latency_tracker_pid != os.getpid():
+        _latency_tracker = LatencyTracker()
+        _latency_tracker_pid = os.getpid()
+    return _latency_tracker
+
+
+def request_stats():
+    '''The RequestStats of every request made by this process since the last
+    call to `reset_request_stats`'''
+    global _request_stats, _request_stats_pid
+    if _request_stats is None or _request_stats_pid != os.getpid():
+        _request_stats = RequestStats()
+        _request_stats_pid = os.getpid()
+    return _request_stats
+
+
+def reset_request_stats():
+    '''Starts counting requests from zero again, and returns the new
+    RequestStats'''
+    global _request_stats
+    _request_stats = None
+    return request_stats()
+
+
+def set_request_governor(gov):
+    '''Makes every request in this process go through `gov`. To limit
+    several processes together, create the Governor before starting them, and
+    call this in each of them with it.'''
+    global _request_governor
+    _request_governor = gov
+
+
+def enable_response_cache(directory, max_bytes=httpcache.DEFAULT_MAX_BYTES):
+    '''Caches responses from the BIE taxonomy web services on disk, in
+    `directory`. See the httpcache module. The cache directory can be shared
+    by any number of processes.'''
+    global _response_cache
+    _response_cache = httpcache.ResponseCache(directory, max_bytes)
+
+
+def disable_response_cache():
+    global _response_cache
+    _response_cache = None
+
+
+def percentile(sorted_values, pct):
+    '''The value that `pct` percent of `sorted_values` are below, or None if
+    there aren't any values
+
+    >>> percentile(range(1, 101), 95)
+    96
+    >>> percentile([], 50) is None
+    True
+    '''
+    if len(sorted_values) == 0:
+        return None
+    idx = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100.0))
+    return sorted_values[idx]
+
+
 def q_param_for_lsid(species_lsid, kosher_only=True, changed_since=None,
         unchanged_since=None):
     '''The 'q' parameter for ALA web service queries
@@ -205,6 +764,22 @@ def q_param_for_lsid(species_lsid, kosher_only=True, changed_since=None,
     TODO: remove occurrences that happened before 1950?
     '''
 
+    return _q_param('lsid:' + species_lsid, kosher_only, changed_since,
+            unchanged_since)
+
+
+def q_param_for_birds(kosher_only=True, changed_since=None,
+        unchanged_since=None):
+    '''The 'q' parameter for ALA web service queries about the records of
+    every bird species at once. See `q_param_for_lsid`.'''
+
+    return _q_param('speciesGroup:Birds', kosher_only, changed_since,
+            unchanged_since)
+
+
+def _q_param(subject, kosher_only, changed_since, unchanged_since):
+    '''The 'q' parameter for records matching the `subject` query'''
+
     kosher = ''
     if kosher_only:
         kosher = 'geospatial_kosher:true AND'
@@ -215,7 +790,7 @@ def q_param_for_lsid(species_lsid, kosher_only=True, changed_since=None,
         changed_between = 'last_processed_date:' + daterange + ' AND'
 
     return _strip_n_squeeze('''
-        lsid:{lsid} AND
+        {subject} AND
         (rank:species OR subspecies_name:[* TO *])
         {kosher}
         {changed}
@@ -223,7 +798,7 @@ def q_param_for_lsid(species_lsid, kosher_only=True, changed_since=None,
             basis_of_record:HumanObservation OR
             basis_of_record:MachineObservation
         )
-        '''.format(lsid=species_lsid, kosher=kosher, changed=changed_between))
+        '''.format(subject=subject, kosher=kosher, changed=changed_between))
 
 
 def _retry(tries=3, delay=2, backoff=2):
@@ -233,7 +808,12 @@ def _retry(tries=3, delay=2, backoff=2):
     delay sets the initial delay in seconds, and backoff sets the factor by
     which the delay should lengthen after each failure. backoff must be greater
     than 1, or else it isn't really a backoff. tries must be at least 1, and
-    delay greater than 0.'''
+    delay greater than 0.
+
+    Errors that won't go away by trying again (see governor.classify_error),
+    like a 404 response, are raised straight away. The delays are randomised
+    (see governor.backoff_delay), and are at least as long as any Retry-After
+    header the server sent.'''
 
     if backoff <= 1:
         raise ValueError('backoff must be greater than 1')
@@ -247,22 +827,29 @@ def _retry(tries=3, delay=2, backoff=2):
 
     def deco_retry(f):
         def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-
+            attempt = 1
             while True:
                 try:
                     return f(*args, **kwargs)
-                except:
-                    mtries -= 1
-                    if mtries > 0:
-                        time.sleep(mdelay)
-                        mdelay *= backoff
-                    else:
+                except Exception, e:
+                    if attempt >= tries or not _should_retry(e):
                         raise
+                    request_stats().add_retry()
+                    time.sleep(_retry_delay(e, delay, backoff, attempt))
+                    attempt += 1
         return f_retry
     return deco_retry
 
 
+def _should_retry(exc):
+    return governor.classify_error(exc) != governor.FATAL
+
+
+def _retry_delay(exc, delay, backoff, attempt):
+    return max(governor.backoff_delay(delay, backoff, attempt),
+               governor.retry_after(exc) or 0)
+
+
 @_retry()
 def _fetch_json(request, check_not_empty=True):
     '''Fetches and parses the JSON at the given url.
@@ -271,27 +858,305 @@ def _fetch_json(request, check_not_empty=True):
     JSON text that was fetched'''
 
     start_time = time.time()
-    response = urllib2.urlopen(request)
+    response = _open(request)
     response_time = time.time()
     response_str = response.read()
     end_time = time.time()
+    _add_bytes_received(response, len(response_str))
+    metrics.observe('stage_seconds', end_time - response_time,
+                    stage='http_download')
 
     log.debug('Loaded JSON at %f kb/s. %f before response + %f download time.',
             (len(response_str) / 1024.0) / (end_time - start_time),
             response_time - start_time,
             end_time - response_time)
 
-    return_value = json.loads(response_str)
+    with metrics.timer('stage_seconds', stage='json_parse'):
+        return_value = json.loads(response_str)
     if check_not_empty and len(return_value) == 0:
         raise RuntimeError('ALA returned empty response')
     else:
         return return_value
 
 
+def _fetch_json_items(request, items_path, values):
+    '''Generator for the items of the JSON array at `items_path`, parsed
+    one at a time (see jsonstream.ItemStream).
+
+    Every other value in the response is put into the `values` dict, keyed
+    by path, once all the items have been yielded.
+
+    The whole body is read before any items are parsed, so the request's
+    slot in the request governor is released as soon as the download
+    finishes, however slowly the items are consumed. Only the text of the
+    page is held in memory, not all of the parsed items.'''
+
+    body = _fetch_body(request)
+    stream = jsonstream.ItemStream(cStringIO.StringIO(body), items_path)
+    # time spent in the stream, not in whatever consumes the items
+    stream_seconds = 0.0
+    num_yielded = 0
+    t = time.time()
+    for item in stream:
+        stream_seconds += time.time() - t
+        num_yielded += 1
+        yield item
+        t = time.time()
+    stream_seconds += time.time() - t
+    metrics.observe('stage_seconds', stream_seconds, stage='json_parse')
+
+    if num_yielded == 0 and len(stream.values) == 0:
+        raise RuntimeError('ALA returned empty response')
+    values.update(stream.values)
+
+
+@_retry()
+def _fetch_body(request):
+    '''Fetches the whole body of the response to the request'''
+    response = _open(request)
+    with metrics.timer('stage_seconds', stage='http_download'):
+        body = response.read()
+    _add_bytes_received(response, len(body))
+    return body
+
+
+def _add_bytes_received(response, default):
+    '''Counts the bytes of the response that came over the network, or
+    `default` if the response doesn't know. Responses from the cache didn't
+    come over the network at all, so they are counted as cache hits
+    instead.'''
+    if isinstance(response, httpcache.CachedResponse) and \
+            response.raw_bytes_read is None:
+        request_stats().add_cache_hit()
+    else:
+        request_stats().add_bytes(getattr(response, 'raw_bytes_read',
+                                          default))
+
+
 @_retry()
 def _fetch(request):
-    '''Opens the url and returns the result of urllib2.urlopen'''
-    return urllib2.urlopen(request)
+    '''Opens the url and returns a file-like response object'''
+    return _open(request)
+
+
+def _open(request):
+    '''Every request to ALA goes through here'''
+    if _response_cache is not None:
+        return _response_cache.open(request, _open_uncached)
+    else:
+        return _open_uncached(request)
+
+
+def _open_uncached(request):
+    if HEDGE_REQUESTS and request.get_data() is None:
+        return _open_hedged(request)
+    else:
+        return _open_governed(request)
+
+
+def _open_governed(request):
+    '''Sends the request through the request governor, and records how long
+    it took to get a response. The request keeps its slot in the governor
+    until the body has been read (see _GovernedResponse).'''
+    gov = request_governor()
+    wait_start = time.time()
+    start_time = gov.acquire()
+    service = _service_name(request)
+    metrics.observe('stage_seconds', start_time - wait_start,
+                    stage='governor_wait')
+    try:
+        response = connection_pool().urlopen(request)
+    except Exception, e:
+        outcome = governor.classify_error(e)
+        gov.release(start_time, outcome, governor.retry_after(e))
+        metrics.inc('http_requests_total', service=service, outcome=outcome)
+        raise
+
+    latency = time.time() - start_time
+    latency_tracker().add(latency)
+    request_stats().add_request(latency)
+    metrics.inc('http_requests_total', service=service,
+                outcome=governor.SUCCESS)
+    metrics.observe('stage_seconds', latency, stage=service + '_response')
+    return _GovernedResponse(response, gov, start_time)
+
+
+class _GovernedResponse(object):
+    '''Wraps a response, and releases its slot in the governor once the whole
+    body has been read, reading it fails, or it's closed. Most of the time of
+    a big response is spent downloading the body, so the governor has to
+    count that as part of the request.'''
+
+    def __init__(self, response, gov, start_time):
+        self._response = response
+        self._governor = gov
+        self._start_time = start_time
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=-1):
+        chunk = self._call(self._response.read, amt)
+        if amt < 0 or amt > 0 and len(chunk) == 0:
+            self._release(governor.SUCCESS)
+        return chunk
+
+    def readline(self):
+        line = self._call(self._response.readline)
+        if len(line) == 0:
+            self._release(governor.SUCCESS)
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._release(governor.SUCCESS)
+        self._response.close()
+
+    def __del__(self):
+        # an abandoned response mustn't hold its slot forever
+        self._release(governor.SUCCESS)
+
+    def _call(self, method, *args):
+        try:
+            return method(*args)
+        except Exception, e:
+            self._release(governor.classify_error(e), governor.retry_after(e))
+            raise
+
+    def _release(self, outcome, retry_after=None):
+        if self._governor is not None:
+            self._governor.release(self._start_time, outcome, retry_after)
+            self._governor = None
+
+
+def _service_name(request):
+    '''Which web service the request is for, 'bie' or 'biocache', for
+    metrics labels'''
+    if request.get_full_url().startswith(BIE):
+        return 'bie'
+    return 'biocache'
+
+
+def _open_hedged(request):
+    '''Opens the request, and if that takes longer than HEDGE_PERCENTILE of
+    recent responses, sends the same request again. Whichever response
+    arrives first is returned, and the other one is closed. Only use this for
+    idempotent requests.
+
+    A few stalled connections can hold up a whole sync, and sending a second
+    request usually gets a response from a different, healthier server
+    thread much sooner.'''
+
+    threshold = latency_tracker().percentile(HEDGE_PERCENTILE)
+    if threshold is None:
+        return _open_governed(request)
+
+    results = Queue.Queue()
+    lock = threading.Lock()
+    chosen = [False]
+
+    def attempt():
+        try:
+            result = (_open_governed(request), None)
+        except Exception:
+            result = (None, sys.exc_info())
+        with lock:
+            if not chosen[0]:
+                results.put(result)
+                return
+        if result[0] is not None:
+            result[0].close()  # lost the race
+
+    def start_attempt():
+        thread = threading.Thread(target=attempt, name='HedgedRequest')
+        thread.daemon = True
+        thread.start()
+
+    start_attempt()
+    num_attempts = 1
+    try:
+        response, exc_info = results.get(timeout=threshold)
+    except Queue.Empty:
+        log.debug('Hedging request after %0.2fs: %s', threshold,
+                request.get_full_url())
+        start_attempt()
+        num_attempts += 1
+        response, exc_info = results.get()
+
+    # if the first one to finish failed, wait for the other one
+    num_finished = 1
+    while exc_info is not None and num_finished < num_attempts:
+        response, exc_info = results.get()
+        num_finished += 1
+
+    with lock:
+        chosen[0] = True
+    while not results.empty():
+        late_response, late_exc_info = results.get()
+        if late_response is not None:
+            late_response.close()
+
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return response
+
+
+def _date_shards(from_date, to_date, total, max_records, count):
+    '''Bisects the window until each part has at most `max_records`
+    records, where `count(from_date, to_date)` gives the number of records
+    in a window. `total` is the number in the whole window. Neighbouring
+    parts are joined back together if they fit in `max_records`, so empty
+    parts don't become extra queries. Returns a list of (from_date, to_date,
+    num_records).
+
+    >>> times = [datetime(2013, 1, d) for d in (1, 2, 3, 4, 5, 20)]
+    >>> def count(a, b):
+    ...     return len([t for t in times if (a is None or t >= a) and
+    ...                                     (b is None or t <= b)])
+    >>> shards = _date_shards(datetime(2013, 1, 1), datetime(2013, 1, 21),
+    ...                       6, 3, count)
+    >>> for a, b, n in shards: print _q_date(a), _q_date(b), n
+    2013-01-01T00:00:00Z 2013-01-03T12:00:00Z 3
+    2013-01-03T12:00:00Z 2013-01-21T00:00:00Z 3
+    >>> _date_shards(None, None, 3, 3, count)
+    [(None, None, 3)]
+    '''
+
+    shards = []
+    for shard in _bisect_dates(from_date, to_date, total, max_records, count):
+        if len(shards) > 0 and shards[-1][2] + shard[2] <= max_records:
+            shards[-1] = (shards[-1][0], shard[1], shards[-1][2] + shard[2])
+        else:
+            shards.append(shard)
+
+    return shards
+
+
+def _bisect_dates(from_date, to_date, total, max_records, count):
+    '''See `_date_shards`'''
+
+    if total <= max_records:
+        return [(from_date, to_date, total)]
+
+    start = from_date or SHARD_EPOCH
+    end = to_date or datetime.utcnow()
+    if end - start < SHARD_MIN_WINDOW * 2:
+        return [(from_date, to_date, total)]
+
+    mid = start + (end - start) // 2
+    mid = mid.replace(microsecond=0)
+    first_total = count(from_date, mid)
+    return (_bisect_dates(from_date, mid, first_total, max_records, count) +
+            _bisect_dates(mid, to_date, total - first_total, max_records,
+                          count))
 
 
 def _q_date_range(from_date, to_date):
@@ -336,7 +1201,12 @@ def _strip_n_squeeze(q):
 
 def _chunked_read_and_write(infile, outfile):
     '''Reads from infile and writes to outfile in chunks, while logging speed
-    info'''
+    info.
+
+    Raises StalledDownloadError if the download makes no progress for
+    STALL_TIMEOUT seconds (see _StallWatchdog). A server that trickles out a
+    few bytes at a time never trips the read timeout, so would otherwise hold
+    things up forever.'''
 
     chunk_size = 4096
     report_interval = 5.0
@@ -344,26 +1214,71 @@ def _chunked_read_and_write(infile, outfile):
     bytes_read = 0
     bytes_read_this_interval = 0
 
-    while True:
-        chunk = infile.read(chunk_size)
-        if len(chunk) > 0:
-            outfile.write(chunk)
-            bytes_read += len(chunk)
-            bytes_read_this_interval += len(chunk)
-        else:
-            break
-
-        now = time.time()
-        if now - last_report_time > report_interval:
-            kbdown = float(bytes_read_this_interval) / 1024.0
-            log.info('Read %0.0fkb total (at about %0.2f kb/s)',
-                    float(bytes_read) / 1024.0,
-                     kbdown / (now - last_report_time))
-            last_report_time = now
-            bytes_read_this_interval = 0
-
-
-def _downloadzip_records_for_species(q):
+    watchdog = _StallWatchdog(infile, STALL_TIMEOUT)
+    try:
+        while True:
+            try:
+                chunk = infile.read(chunk_size)
+            except Exception:
+                if watchdog.stalled:
+                    raise StalledDownloadError('No progress for {0} seconds '
+                            'after {1} bytes'.format(STALL_TIMEOUT,
+                                                     bytes_read))
+                raise
+
+            if len(chunk) > 0:
+                outfile.write(chunk)
+                bytes_read += len(chunk)
+                bytes_read_this_interval += len(chunk)
+                watchdog.progress()
+            else:
+                break
+
+            now = time.time()
+            if now - last_report_time > report_interval:
+                kbdown = float(bytes_read_this_interval) / 1024.0
+                log.info('Read %0.0fkb total (at about %0.2f kb/s)',
+                        float(bytes_read) / 1024.0,
+                         kbdown / (now - last_report_time))
+                last_report_time = now
+                bytes_read_this_interval = 0
+    finally:
+        watchdog.stop()
+
+
+class _StallWatchdog(object):
+    '''Aborts `response` (see httppool.PooledResponse.abort) if `progress`
+    isn't called for `timeout` seconds. Responses that can't be aborted are
+    left alone.'''
+
+    def __init__(self, response, timeout):
+        self.stalled = False
+        self._response = response
+        self._timeout = timeout
+        self._last_progress = time.time()
+        self._stopped = threading.Event()
+        if hasattr(response, 'abort'):
+            thread = threading.Thread(target=self._run, name='StallWatchdog')
+            thread.daemon = True
+            thread.start()
+
+    def progress(self):
+        self._last_progress = time.time()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(min(1.0, self._timeout)):
+            if time.time() - self._last_progress > self._timeout:
+                log.warning('Download stalled, aborting: %s',
+                        self._response.geturl())
+                self.stalled = True
+                self._response.abort()
+                return
+
+
+def _downloadzip_batches_for_species(q):
     '''This strategy is too slow. The requested file size is small, but ALA
     can't generate the file fast enough so the download speed won't go above
     8kb/s'''
@@ -390,6 +1305,7 @@ def _downloadzip_records_for_species(q):
     t = time.time()
     _chunked_read_and_write(response, temp_zip_file)
     t = time.time() - t
+    _add_bytes_received(response, temp_zip_file.tell())
     zip_file_size_kb = float(temp_zip_file.tell()) / 1024.0
     log.info('Fetched %0.2fkb zip file in %0.2f seconds (%0.2f kb/s)',
             zip_file_size_kb, t, zip_file_size_kb / t)
@@ -400,12 +1316,16 @@ def _downloadzip_records_for_species(q):
     zip_file = zipfile.ZipFile(temp_zip_file)
     reader = csv.DictReader(zip_file.open(file_name + '.csv'))
     num_records = 0
+    batch = RecordBatch()
     for row in reader:
-        record = OccurrenceRecord()
-        record.latitude = float(row['Latitude - processed'])
-        record.longitude = float(row['Longitude - processed'])
-        yield record
+        batch.append(float(row['Latitude - processed']),
+                     float(row['Longitude - processed']))
         num_records += 1
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = RecordBatch()
+    if len(batch) > 0:
+        yield batch
     t = time.time() - t
     log.info('Read %d records in %0.2f seconds (%0.2f records/sec)',
              num_records, t, float(num_records) / t)
@@ -414,13 +1334,16 @@ def _downloadzip_records_for_species(q):
     temp_zip_file.close()
 
 
-def _facet_records_for_species(q):
+def _facet_batches_for_species(q):
     '''Fastest strategy, but each record only contains latitude and longitude.
 
     Using the '/occurrences/faces/download' web service, there is no way to get
     other info about the record, like assertions and the record uuid. If
     bandwidth wasn't an issue, the 'search' strategy may be just as fast as
-    this one.'''
+    this one.
+
+    ALA sends one row per distinct lat/long, with a count, so the records in
+    the batches are weighted (see OccurrenceRecord.count).'''
 
     log.info('Requesting csv..')
     t = time.time()
@@ -441,26 +1364,34 @@ def _facet_records_for_species(q):
         raise RuntimeError('Unexpected heading for count')
 
     num_records = 0
+    next_report = 1000
+    batch = RecordBatch()
     for row in reader:
-        record = OccurrenceRecord()
-        record.latitude = float(row[0])
-        record.longitude = float(row[1])
         count = int(row[2])
-        for i in range(count):
-            yield record
-            num_records += 1
-            if num_records % 1000 == 0:
-                log.info('%d records done...', num_records)
+        batch.append(float(row[0]), float(row[1]), count=count)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = RecordBatch()
 
+        num_records += count
+        if num_records >= next_report:
+            log.info('%d records done...', num_records)
+            next_report = (num_records // 1000 + 1) * 1000
 
-def _search_records_for_species(q):
+    _add_bytes_received(response, 0)
+    if len(batch) > 0:
+        yield batch
+
+
+def _search_batches_for_species(q, concurrency=None, ordered=True,
+        start_index=0):
     '''Currently the best strategy.
 
     Faster than 'download' strategy. More info about each record than 'facet'
     strategy.
 
-    Speed could maybe be improved by fetching every page concurrently, instead
-    of serially.'''
+    Pages are fetched concurrently if `concurrency` is greater than 1,
+    otherwise each page is parsed as it downloads. See `_json_items`.'''
 
     url = BIOCACHE + 'ws/occurrences/search'
     params = {
@@ -468,14 +1399,34 @@ def _search_records_for_species(q):
         'fl': 'id,latitude,longitude',
         'facet': 'off',
     }
-
-    for page in _json_pages(url, params, ('totalRecords',), 'startIndex'):
-        for occ in page['occurrences']:
-            record = OccurrenceRecord()
-            record.latitude = occ['decimalLatitude']
-            record.longitude = occ['decimalLongitude']
-            record.uuid = uuid.UUID(occ['uuid'])
-            yield record
+    params.update(SEARCH_SORT)
+
+    occurrences = _json_items(url, params, ('totalRecords',), 'startIndex',
+            ('occurrences',), concurrency, ordered, start_index)
+    batch = RecordBatch()
+    for occ in occurrences:
+        batch.append(occ['decimalLatitude'], occ['decimalLongitude'],
+                     uuid.UUID(occ['uuid']).bytes)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = RecordBatch()
+
+    if len(batch) > 0:
+        yield batch
+
+
+def _records_in_batches(batches, weighted):
+    '''Generator for the RecordView objects in every batch. Weighted records
+    are repeated `count` times, unless `weighted` is True.'''
+
+    for batch in batches:
+        if weighted:
+            for record in batch:
+                yield record
+        else:
+            for record in batch:
+                for i in xrange(record.count):
+                    yield record
 
 def _json_pages_params_filter(params, offset_key):
     '''Returns filtered_params, page_size
@@ -518,31 +1469,154 @@ def _json_pages_params_filter(params, offset_key):
 
 
 
-def _json_pages(url, params, total_key_path, offset_key):
+def _json_pages(url, params, total_key_path, offset_key, concurrency=None,
+        ordered=True, start_index=0):
+    '''Generator for every page of JSON from a paged web service.
+
+    The first page is always fetched by itself, because the total number of
+    pages isn't known until it arrives. If `concurrency` is greater than 1,
+    the remaining pages are fetched by that many threads at once. If `ordered`
+    is False, pages are yielded in whatever order they arrive instead of page
+    order. `concurrency` defaults to PAGE_CONCURRENCY.
+
+    The first `start_index` results are skipped.'''
+
     assert len(total_key_path) > 0
 
+    if concurrency is None:
+        concurrency = PAGE_CONCURRENCY
+
     params, page_size = _json_pages_params_filter(params, offset_key)
 
-    page_idx = 0
-    total_pages = None
-    while True:
-        params.append((offset_key, page_idx * page_size))
-        response = _fetch_json(create_request(url, params))
-        yield response
+    def request_for_page(page_idx):
+        offset = start_index + page_idx * page_size
+        return create_request(url, params + [(offset_key, offset)])
 
+    first_page = _fetch_json(request_for_page(0))
+    request_stats().add_page()
+    yield first_page
 
-        # calculate total num pages from response (only once)
-        if total_pages is None:
-            total_results = response
-            for key in total_key_path:
-                total_results = total_results[key]
-            total_pages = math.ceil(float(total_results) / float(page_size))
+    total_results = jsonstream.value_at_path(first_page, total_key_path)
+    total_pages = _num_pages(total_results, start_index, page_size)
+
+    requests = (request_for_page(idx) for idx in xrange(1, total_pages))
+    if concurrency > 1:
+        pages = _concurrent_map(_fetch_json, requests, concurrency, ordered)
+    else:
+        pages = (_fetch_json(request) for request in requests)
+
+    for page in pages:
+        request_stats().add_page()
+        yield page
+
+
+def _json_items(url, params, total_key_path, offset_key, items_path,
+        concurrency=None, ordered=True, start_index=0):
+    '''Generator for every item in the array at `items_path`, across every
+    page of JSON from a paged web service.
+
+    When pages are fetched one at a time, each page is parsed one item at a
+    time (see `_fetch_json_items`), so the parsed items of a whole page are
+    never held in memory at once. When `concurrency` is greater than 1 the
+    pages are fetched whole by `_json_pages`. The first `start_index` items
+    are skipped.'''
+
+    if concurrency is None:
+        concurrency = PAGE_CONCURRENCY
+
+    if concurrency > 1:
+        pages = _json_pages(url, params, total_key_path, offset_key,
+                concurrency, ordered, start_index)
+        for page in pages:
+            for item in jsonstream.value_at_path(page, items_path):
+                yield item
+        return
+
+    params, page_size = _json_pages_params_filter(params, offset_key)
+    page_idx = 0
+    total_pages = 1
+    while page_idx < total_pages:
+        request = create_request(url,
+                params + [(offset_key, start_index + page_idx * page_size)])
+        values = {}
+        for item in _fetch_json_items(request, items_path, values):
+            yield item
+        request_stats().add_page()
+
+        # calculate total num pages from the first page
+        if page_idx == 0:
+            total_results = values[tuple(total_key_path)]
+            total_pages = _num_pages(total_results, start_index, page_size)
 
         page_idx += 1
-        if page_idx >= total_pages:
-            break
-        else:
-            params.pop()  # remove offset_key param
+
+
+def _num_pages(total_results, start_index, page_size):
+    '''Number of pages needed to get from `start_index` to the end. Always at
+    least one, because the first page is what says how many results there
+    are.
+
+    >>> _num_pages(2345, 0, 1000), _num_pages(2345, 1500, 1000)
+    (3, 1)
+    >>> _num_pages(0, 0, 1000), _num_pages(10, 20, 1000)
+    (1, 1)
+    '''
+    remaining = max(0, int(total_results) - start_index)
+    return max(1, int(math.ceil(float(remaining) / float(page_size))))
+
+
+def _concurrent_map(func, iterable, concurrency, ordered=True):
+    '''Generator that yields func(item) for each item in iterable, calling
+    func from `concurrency` threads at once.
+
+    At most `concurrency` results are in flight or waiting to be yielded at
+    any time, so a slow consumer doesn't make results pile up in memory. If
+    `ordered` is False, results are yielded as soon as they are ready.
+    Exceptions raised by func are reraised in the caller.
+
+    >>> list(_concurrent_map(lambda x: x * 2, range(5), 3))
+    [0, 2, 4, 6, 8]
+    >>> sorted(_concurrent_map(lambda x: x * 2, range(5), 3, ordered=False))
+    [0, 2, 4, 6, 8]
+    '''
+
+    pool = ThreadPool(concurrency)
+    finished = Queue.Queue()
+    in_flight = collections.deque()
+    items = iter(iterable)
+
+    def submit():
+        for item in items:
+            callback = None if ordered else finished.put
+            in_flight.append(pool.apply_async(_call_capturing_exc,
+                (func, item), callback=callback))
+            return True
+        return False
+
+    try:
+        while len(in_flight) < concurrency and submit():
+            pass
+
+        while len(in_flight) > 0:
+            if ordered:
+                value, exc_info = in_flight.popleft().get()
+            else:
+                value, exc_info = finished.get()
+                in_flight.pop()  # only the number in flight matters here
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            submit()
+            yield value
+    finally:
+        pool.terminate()
+
+
+def _call_capturing_exc(func, arg):
+    '''Returns (func(arg), None), or (None, exc_info) if func raises'''
+    try:
+        return func(arg), None
+    except Exception:
+        return None, sys.exc_info()
 
 
 if __name__ == "__main__":
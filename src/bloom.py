@@ -0,0 +1,78 @@
+'''Compact set membership for huge sets of keys, like record uuids.
+
+A BloomFilter never says a key that was added is missing, but can say a key
+that wasn't added is present, with probability `error_rate`. It holds about
+1.2 bytes per key at a 1% error rate, compared to ~100 bytes per key for a
+Python set of 16 byte strings.
+'''
+
+import hashlib
+import math
+import os
+import struct
+
+_TWO_INTS = struct.Struct('<QQ')
+
+
+class BloomFilter(object):
+    '''Bloom filter sized for `capacity` keys at `error_rate` false
+    positives. More keys can be added, but the error rate goes up.
+
+    `salt` changes which bits each key sets. Defaults to random, so that a
+    key which is a false positive in one filter probably isn't in the next.
+
+    >>> bf = BloomFilter(1000, 0.01)
+    >>> for i in range(1000):
+    ...     bf.add(str(i))
+    >>> all(str(i) in bf for i in range(1000))
+    True
+    >>> sum(1 for i in range(1000, 11000) if str(i) in bf) < 200
+    True
+    >>> len(bf), bf.num_bytes
+    (1000, 1199)
+    '''
+
+    def __init__(self, capacity, error_rate=0.01, salt=None):
+        capacity = max(1, capacity)
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = max(8, int(math.ceil(num_bits)))
+        self.num_hashes = max(1, int(round(
+                self.num_bits / float(capacity) * math.log(2))))
+        self.salt = os.urandom(8) if salt is None else salt
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._count = 0
+
+    @property
+    def num_bytes(self):
+        return len(self._bits)
+
+    def __len__(self):
+        '''Number of keys added'''
+        return self._count
+
+    def add(self, key):
+        bits = self._bits
+        for bit in self._bit_indexes(key):
+            bits[bit >> 3] |= 1 << (bit & 7)
+        self._count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for bit in self._bit_indexes(key):
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def _bit_indexes(self, key):
+        '''Double hashing: one md5 gives two 64 bit hashes, which are
+        combined to make as many hashes as needed'''
+        h1, h2 = _TWO_INTS.unpack(hashlib.md5(self.salt + key).digest())
+        num_bits = self.num_bits
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -4,7 +4,7 @@ from sqlalchemy import \
     PrimaryKeyConstraint, Index
 from sqlalchemy.dialects.mysql import \
     SMALLINT, TINYINT, ENUM, VARCHAR, DATETIME, FLOAT, BINARY, TEXT, \
-    INTEGER
+    INTEGER, BIGINT
 
 engine = None
 metadata = MetaData()
@@ -21,6 +21,8 @@ species = Table('species', metadata,
     Column('id', SMALLINT(unsigned=True), primary_key=True),
     Column('scientific_name', VARCHAR(256), nullable=False),
     Column('common_name', VARCHAR(256), nullable=True),
+    Column('lsid', VARCHAR(256), nullable=True),
+    Column('lsid_verified_time', DATETIME(), nullable=True),
 
     mysql_charset='utf8'
 )
@@ -62,6 +64,60 @@ ratings = Table('ratings', metadata,
         'assumed invalid'), nullable=False)
 )
 
+sync_ledger = Table('sync_ledger', metadata,
+    Column('id', INTEGER(unsigned=True), primary_key=True),
+    Column('species_id', SMALLINT(unsigned=True), ForeignKey('species.id'),
+        nullable=False),
+    Column('changed_since', DATETIME(), nullable=True),
+    Column('unchanged_since', DATETIME(), nullable=False),
+    Column('next_offset', INTEGER(unsigned=True), nullable=False),
+    Column('status', ENUM('pending', 'done', 'failed'), nullable=False),
+    Column('attempts', TINYINT(unsigned=True), nullable=False),
+    Column('last_error', TEXT(), nullable=True),
+
+    Index('idx_ledger_species_id', 'species_id')
+)
+
+sync_runs = Table('sync_runs', metadata,
+    Column('id', INTEGER(unsigned=True), primary_key=True),
+    Column('started_time', DATETIME(), nullable=False),
+    Column('finished_time', DATETIME(), nullable=False),
+    Column('mode', VARCHAR(32), nullable=False),
+    Column('changed_since', DATETIME(), nullable=True),
+    Column('unchanged_since', DATETIME(), nullable=True),
+    Column('completed', TINYINT(unsigned=True), nullable=False),
+    Column('records', INTEGER(unsigned=True), nullable=False),
+    Column('bytes', BIGINT(unsigned=True), nullable=False),
+    Column('pages', INTEGER(unsigned=True), nullable=False),
+    Column('requests', INTEGER(unsigned=True), nullable=False),
+    Column('retries', INTEGER(unsigned=True), nullable=False),
+    Column('failed_fetches', INTEGER(unsigned=True), nullable=False),
+    Column('latency_p50', FLOAT(), nullable=True),
+    Column('latency_p95', FLOAT(), nullable=True),
+    Column('seconds', FLOAT(), nullable=False),
+    Column('db_flush_seconds', FLOAT(), nullable=False),
+    Column('db_flushes', INTEGER(unsigned=True), nullable=False)
+)
+
+sync_species_stats = Table('sync_species_stats', metadata,
+    Column('run_id', INTEGER(unsigned=True), ForeignKey('sync_runs.id'),
+        nullable=False),
+    Column('species_id', SMALLINT(unsigned=True), nullable=False),
+    Column('records', INTEGER(unsigned=True), nullable=False),
+    Column('bytes', BIGINT(unsigned=True), nullable=False),
+    Column('pages', INTEGER(unsigned=True), nullable=False),
+    Column('requests', INTEGER(unsigned=True), nullable=False),
+    Column('retries', INTEGER(unsigned=True), nullable=False),
+    Column('failed_fetches', INTEGER(unsigned=True), nullable=False),
+    Column('fetch_seconds', FLOAT(), nullable=False),
+    Column('latency_p50', FLOAT(), nullable=True),
+    Column('latency_p95', FLOAT(), nullable=True),
+    Column('latency_max', FLOAT(), nullable=True),
+
+    PrimaryKeyConstraint('run_id', 'species_id'),
+    Index('idx_stats_species_id', 'species_id')
+)
+
 occurrences_ratings_bridge = Table('occurrences_ratings_bridge', metadata,
     Column('occurrence_id', INTEGER(unsigned=True), nullable=False),
     Column('rating_id', INTEGER(unsigned=True), nullable=False),
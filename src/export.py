@@ -0,0 +1,464 @@
+'''Exports occurrence records to CSV files, for species distribution models.
+
+Each species is written as `SPPCODE,LATDEC,LONGDEC` rows (plus a COUNT
+column if weighted), where SPPCODE is made from the scientific name by
+`spp_code_for_species_name`.
+
+`BatchExport` writes one file per species into a directory, fetching several
+species at the same time. Files are written to a temporary name and renamed
+into place, so a file is either complete or not there at all. After each
+species, `manifest.json` in the directory is updated with what has been
+exported, so an interrupted export carries on where it stopped when run
+again with the same directory. `DatabaseExport` does the same from the
+local db instead of ALA. Both can write other formats than CSV, like the
+snapshots of the snapshot module.
+'''
+
+import ala
+import csv
+import errno
+import gzip
+import itertools
+import json
+import logging
+import os
+import os.path
+import string
+import tempfile
+import threading
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+#name of the manifest file in the export directory
+MANIFEST_NAME = 'manifest.json'
+#number of species fetched at the same time by default
+SPECIES_CONCURRENCY = 4
+#permissions of exported files. mkstemp makes files only their owner can
+#read, but the exports are for other users' modelling jobs
+FILE_MODE = 0644
+
+log = logging.getLogger(__name__)
+
+
+def spp_code_for_species_name(species_name):
+    '''Uppercase alpha-only name with length <= 8
+
+    Not sure if this is too restrictive, but Jeremy's example uses
+    "GOULFINC" for "Gould Finch"
+
+    >>> spp_code_for_species_name('Falco (Hierofalco) hypoleucos')
+    'FALCHYPO'
+    >>> spp_code_for_species_name('Motacilla')
+    'MOTACILL'
+    '''
+    allowed_chars = frozenset(string.ascii_letters + ' ')
+    filtered = ''.join([c for c in species_name if c in allowed_chars])
+    filtered = filtered.upper()
+    parts = filtered.split(' ')
+    if len(parts) > 1:
+        return parts[0].strip()[:4] + parts[-1].strip()[:4]
+    else:
+        return filtered.strip()[:8]
+
+
+def write_csv(f, spp_code, batches, weighted=False):
+    '''Writes the records in `batches` to the file `f` as CSV rows, with a
+    header row, and returns the number of records written. Weighted records
+    are repeated unless `weighted` is True.
+
+    >>> import sys
+    >>> batch = ala.RecordBatch(1)
+    >>> batch.append(-27.5, 153.0, count=2)
+    >>> write_csv(sys.stdout, 'GYMNTIBI', [batch])
+    SPPCODE,LATDEC,LONGDEC\r
+    GYMNTIBI,-27.5,153.0\r
+    GYMNTIBI,-27.5,153.0\r
+    2
+    '''
+    writer = csv.writer(f)
+    if weighted:
+        writer.writerow(['SPPCODE', 'LATDEC', 'LONGDEC', 'COUNT'])
+    else:
+        writer.writerow(['SPPCODE', 'LATDEC', 'LONGDEC'])
+
+    # batches are weighted, so only expand them here if needed
+    num_records = 0
+    for batch in batches:
+        rows = itertools.izip(itertools.repeat(spp_code), batch.latitudes,
+                batch.longitudes, batch.counts)
+        if weighted:
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                writer.writerows(itertools.repeat(row[:3], row[3]))
+        num_records += batch.total_count()
+    return num_records
+
+
+class CsvWriter(object):
+    '''Writes the CSV files of a BatchExport. See `write_csv`.
+
+    A BatchExport can write other formats with any object that has the same
+    `extension`, `settings` and `write`, like snapshot.SnapshotWriter.'''
+
+    extension = '.csv'
+
+    def __init__(self, weighted=False):
+        self.weighted = weighted
+
+    def settings(self):
+        '''What the contents of a file depend on'''
+        return {
+            'format': 'csv',
+            'weighted': self.weighted,
+        }
+
+    def write(self, f, spp_code, batches):
+        '''Writes the records in `batches` to `f`, and returns the number of
+        records written'''
+        return write_csv(f, spp_code, batches, self.weighted)
+
+
+def is_lsid(name):
+    '''
+    >>> is_lsid('urn:lsid:biodiversity.org.au:afd.taxon:b76f8dcf')
+    True
+    >>> is_lsid('Cracticus tibicen')
+    False
+    '''
+    return name.startswith('urn:lsid:')
+
+
+class BatchExport(object):
+    '''Exports the records of many species into `directory`, one file per
+    species.
+
+    `strategy`, `page_concurrency`, `ordered` and `weighted` are the same as
+    for a single species (see ala.record_batches_for_species).
+    `species_concurrency` species are fetched at the same time, all through
+    the request governor of this process. If `compress` is True the files
+    are gzipped. The files are CSV unless another `writer` is given (see
+    CsvWriter), in which case `weighted` is ignored.'''
+
+    def __init__(self, directory, strategy='search', weighted=False,
+            compress=False, species_concurrency=SPECIES_CONCURRENCY,
+            page_concurrency=1, ordered=True, writer=None):
+        self.directory = directory
+        self.strategy = strategy
+        self.compress = compress
+        self.writer = CsvWriter(weighted) if writer is None else writer
+        self.species_concurrency = species_concurrency
+        self.page_concurrency = page_concurrency
+        self.ordered = ordered
+        self._lock = threading.Lock()
+        self._manifest = None
+        self._used_filenames = set()
+
+    def settings(self):
+        '''What the contents of a file depend on. Files exported with
+        different settings are exported again.'''
+        settings = self.writer.settings()
+        settings.update(strategy=self.strategy, compress=self.compress)
+        return settings
+
+    def run(self, species, resume=True):
+        '''Exports each of `species`, which can be ala.Species objects, LSIDs
+        or scientific names. Names are looked up, and every species is
+        exported once, keyed by its LSID in the manifest. Species that are
+        already in the manifest are skipped if `resume` is True. Returns the
+        manifest, whose 'failed' dict holds the error of each species that
+        couldn't be found or exported.'''
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._remove_temp_files()
+        self._manifest = self._load_manifest() if resume else None
+        if self._manifest is None:
+            self._manifest = {'species': {}}
+        manifest = self._manifest
+        manifest['failed'] = {}
+        manifest['started'] = datetime.utcnow().isoformat()
+        manifest.pop('finished', None)
+        self._used_filenames = set(entry['file'] for entry
+                                   in manifest['species'].itervalues())
+
+        t = time.time()
+        pool = ThreadPool(max(1, self.species_concurrency))
+        try:
+            resolved = pool.map(self._resolve_one, species)
+
+            todo = []
+            done = set()
+            for key, s in filter(None, resolved):
+                if key in done:
+                    continue
+                done.add(key)
+                if s is not None and not self._is_exported(key):
+                    todo.append((key, s))
+            log.info('Exporting %d species, %d already exported', len(todo),
+                     len(done) - len(todo))
+
+            for _ in pool.imap_unordered(self._export_one, todo):
+                pass
+        finally:
+            pool.terminate()
+            pool.join()
+
+        manifest['seconds'] = time.time() - t
+        manifest['finished'] = datetime.utcnow().isoformat()
+        manifest['records'] = sum(entry['records'] for entry
+                                  in manifest['species'].itervalues())
+        self._save_manifest()
+        return manifest
+
+    def _export_one(self, key_and_species):
+        key, species = key_and_species
+        try:
+            entry = self._export_species(key, species)
+        except Exception, e:
+            log.exception('Failed to export %s', key)
+            with self._lock:
+                self._manifest['failed'][key] = str(e) or repr(e)
+                self._save_manifest()
+            return
+
+        log.info('Exported %d records of %s to %s in %0.2fs',
+                 entry['records'], key, entry['file'], entry['seconds'])
+        with self._lock:
+            self._manifest['species'][key] = entry
+            self._save_manifest()
+
+    def _resolve_one(self, species):
+        '''Returns `_resolve(species)`, or None if it fails'''
+        try:
+            return self._resolve(species)
+        except Exception, e:
+            log.exception('Failed to find %s', species)
+            with self._lock:
+                self._manifest['failed'][species] = str(e) or repr(e)
+            return None
+
+    def _resolve(self, species):
+        '''Returns (manifest key, species object) for one of the `species`
+        given to `run`. The species object is None if it wasn't looked up
+        because it's already exported.'''
+        if isinstance(species, ala.Species):
+            return species.lsid, species
+        if is_lsid(species):
+            if self._is_exported(species):
+                return species, None
+            found = ala.species_for_lsid(species)
+        else:
+            found = ala.species_for_scientific_name(species)
+        if found is None:
+            raise ValueError('Species not found: ' + species)
+        return found.lsid, found
+
+    def _record_batches(self, species):
+        return ala.record_batches_for_species(species.lsid, self.strategy,
+                concurrency=self.page_concurrency, ordered=self.ordered)
+
+    def _export_species(self, key, species):
+        t = time.time()
+        spp_code = spp_code_for_species_name(species.scientific_name)
+        filename = self._claim_filename(key, spp_code)
+        path = os.path.join(self.directory, filename)
+        batches = self._record_batches(species)
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if self.compress:
+                    with gzip.GzipFile(filename[:-len('.gz')], 'wb',
+                                       fileobj=f) as gz:
+                        num_records = self.writer.write(gz, spp_code,
+                                                        batches)
+                else:
+                    num_records = self.writer.write(f, spp_code, batches)
+            os.chmod(temp_path, FILE_MODE)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+
+        entry = {
+            'file': filename,
+            'lsid': species.lsid,
+            'scientific_name': species.scientific_name,
+            'common_name': species.common_name,
+            'spp_code': spp_code,
+            'records': num_records,
+            'bytes': os.path.getsize(path),
+            'seconds': time.time() - t,
+            'exported': datetime.utcnow().isoformat(),
+        }
+        entry.update(self.settings())
+        return entry
+
+    def _claim_filename(self, key, spp_code):
+        '''Different species can have the same SPPCODE, so a number is
+        added to the file name of all but the first'''
+        extension = self.writer.extension
+        if self.compress:
+            extension += '.gz'
+        with self._lock:
+            old_entry = self._manifest['species'].get(key)
+            if old_entry is not None and \
+                    old_entry['file'].endswith(extension):
+                return old_entry['file']
+            filename = spp_code + extension
+            num = 1
+            while filename in self._used_filenames:
+                num += 1
+                filename = '{0}_{1}{2}'.format(spp_code, num, extension)
+            self._used_filenames.add(filename)
+            return filename
+
+    def _is_exported(self, key):
+        entry = self._manifest['species'].get(key)
+        if entry is None:
+            return False
+        for name, value in self.settings().iteritems():
+            if entry.get(name) != value:
+                return False
+        return os.path.exists(os.path.join(self.directory, entry['file']))
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST_NAME), 'rb') as f:
+                return json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _save_manifest(self):
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(self._manifest, f, indent=2, sort_keys=True)
+            os.chmod(temp_path, FILE_MODE)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+
+    def _remove_temp_files(self):
+        '''Removes files left half written by an interrupted export'''
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                _remove(os.path.join(self.directory, name))
+
+
+class DatabaseExport(BatchExport):
+    '''Exports the records in the local db (see ala_db_update.py) instead of
+    fetching them from ALA.
+
+    Each species is read on its own connection through an unbuffered
+    server-side cursor, which walks the idx_species_id index, so memory use
+    doesn't grow with the number of records. Every record is exported, like
+    the ALA exports, unless `valid_only` is True, which leaves out the ones
+    rated invalid.
+
+    While a cursor is open MyISAM keeps the occurrences table read locked,
+    so writes by ala_db_update.py wait for the species being exported.'''
+
+    def __init__(self, directory, compress=False,
+            species_concurrency=SPECIES_CONCURRENCY, valid_only=False,
+            writer=None):
+        BatchExport.__init__(self, directory, compress=compress,
+                species_concurrency=species_concurrency, writer=writer)
+        self.valid_only = valid_only
+
+    def settings(self):
+        settings = self.writer.settings()
+        settings.update(source='db', valid_only=self.valid_only,
+                        compress=self.compress)
+        return settings
+
+    def run(self, species=None, resume=True):
+        '''Exports each of `species`, which are scientific names or LSIDs of
+        species in the db, or every species in the db if None. See
+        BatchExport.run.'''
+        import db
+        rows = db.species.select().order_by(db.species.c.id).execute()\
+                .fetchall()
+        if species is not None:
+            by_name = dict((row['scientific_name'], row) for row in rows)
+            by_name.update((row['lsid'], row) for row in rows
+                           if row['lsid'] is not None)
+            missing = [s for s in species if s not in by_name]
+            if missing:
+                raise ValueError('Species not in the db: ' +
+                                 ', '.join(missing))
+            rows = [by_name[s] for s in species]
+        return BatchExport.run(self, rows, resume)
+
+    def _resolve(self, species):
+        return species['scientific_name'], species
+
+    def _record_batches(self, species):
+        import db
+        import MySQLdb.cursors
+
+        sql = '''SELECT latitude, longitude, source_record_id
+                 FROM occurrences FORCE INDEX (idx_species_id)
+                 WHERE species_id = %s'''
+        if self.valid_only:
+            sql += " AND rating IN ('known valid', 'assumed valid')"
+
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            try:
+                cursor.execute(sql, (species['id'],))
+                while True:
+                    rows = cursor.fetchmany(ala.BATCH_SIZE)
+                    if not rows:
+                        break
+                    yield _batch_from_rows(species['id'], rows)
+            finally:
+                # reads the rest of the rows, so the connection can be used
+                # again
+                cursor.close()
+        finally:
+            conn.close()
+
+
+def _batch_from_rows(species_id, rows):
+    '''Returns an ala.RecordBatch of (latitude, longitude, source_record_id)
+    rows from the occurrences table. Records with a NULL source_record_id get
+    no uuid. MySQLdb converts FLOAT columns to Python floats, and the csv
+    writer writes those with repr, which is the shortest decimal that reads
+    back as the same float.
+
+    >>> import sys
+    >>> batch = _batch_from_rows(3, [(-33.8688, 151.209, '\\x01' * 16),
+    ...                              (-27.47, 153.02, None)])
+    >>> n = write_csv(sys.stdout, 'GYMNTIBI', [batch])
+    SPPCODE,LATDEC,LONGDEC\r
+    GYMNTIBI,-33.8688,151.209\r
+    GYMNTIBI,-27.47,153.02\r
+    >>> batch.uuid_bytes(0) == '\\x01' * 16, batch.uuid_bytes(1)
+    (True, None)
+    '''
+    batch = ala.RecordBatch(species_id)
+    for latitude, longitude, source_record_id in rows:
+        batch.append(latitude, longitude, source_record_id)
+    return batch
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,560 @@
+'''A stand-in for the ALA web services, for benchmarks and offline runs.
+
+StandInServer serves the species and records of a Dataset through the same
+urls and response formats that ala.py uses:
+
+    ws/occurrences/search            (biocache, JSON pages)
+    ws/occurrences/facets/download   (biocache, lat_long and id CSVs)
+    ws/occurrences/download          (biocache, zipped CSV)
+    search.json                      (BIE, JSON pages of species)
+    ws/guid/<scientific name>        (BIE)
+    species/shortProfile/<lsid>.json (BIE)
+
+Urls are matched on the end of their path, so one server can stand in for
+both BIE and biocache. Point ala.BIE and ala.BIOCACHE at `server.url`.
+
+Only the parts of the 'q' parameter that ala.py relies on are understood:
+`lsid:<lsid>`, `speciesGroup:Birds` and `last_processed_date:[from TO to]`.
+
+A Dataset is either synthetic (`Dataset.synthetic`, the same for the same
+seed), or a fixture file of real records (`Dataset.record`, `save` and
+`load`). The server can add latency, limit bandwidth and inject errors, to
+see how a change copes with a slow or flaky ALA.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import bisect
+import csv
+import json
+import logging
+import random
+import socket
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+
+#first and last last_processed_date of synthetic records
+SYNTHETIC_START = datetime(2010, 1, 1)
+SYNTHETIC_END = datetime(2013, 1, 1)
+#bytes written at a time when limiting bandwidth
+WRITE_CHUNK_SIZE = 16 * 1024
+#page size when the request doesn't give one, like ALA
+DEFAULT_PAGE_SIZE = 10
+#bytes of rendered responses kept by each StandInServer, so that rendering
+#them doesn't slow down repeated runs
+RESPONSE_CACHE_BYTES = 256 * 1024 * 1024
+#date format of last_processed_date in queries and fixture files
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+log = logging.getLogger(__name__)
+
+
+class FakeSpecies(object):
+    '''A species and its records. `records` is a list of (last processed
+    date, uuid string, latitude, longitude) tuples sorted by date.'''
+
+    def __init__(self, lsid, scientific_name, common_name, records):
+        self.lsid = lsid
+        self.scientific_name = scientific_name
+        self.common_name = common_name
+        self.records = sorted(records)
+        self.dates = [r[0] for r in self.records]
+
+
+class Dataset(object):
+    '''The species and records served by a StandInServer
+
+    >>> ds = Dataset.synthetic(num_species=3, num_records=100, seed=1)
+    >>> [len(s.records) for s in ds.species]
+    [55, 27, 18]
+    >>> ds.num_records
+    100
+    >>> ds.by_lsid[ds.species[1].lsid] is ds.species[1]
+    True
+    '''
+
+    def __init__(self, species):
+        self.species = species
+        self.by_lsid = dict((s.lsid, s) for s in species)
+        self.by_name = dict((s.scientific_name.lower(), s) for s in species)
+
+        # every record with its species' lsid, for queries of all birds
+        self.records = sorted(r + (s.lsid,) for s in species
+                              for r in s.records)
+        self.dates = [r[0] for r in self.records]
+
+    @property
+    def num_records(self):
+        return len(self.records)
+
+    @classmethod
+    def synthetic(cls, num_species=20, num_records=100000, seed=0):
+        '''Makes up `num_species` species with `num_records` records between
+        them. The first species has the most records, and each one after it
+        has fewer (1/n of the records, roughly), like the real birds.
+
+        Records are spread over a quarter as many sites as there are
+        records, so the 'facet' strategy has some weighted rows.'''
+        rng = random.Random(seed)
+        weights = [1.0 / (i + 1) for i in xrange(num_species)]
+        total_weight = sum(weights)
+        counts = [int(num_records * w / total_weight) for w in weights]
+        counts[0] += num_records - sum(counts)
+
+        date_range = int((SYNTHETIC_END - SYNTHETIC_START).total_seconds())
+        species = []
+        for idx, count in enumerate(counts):
+            sites = [(round(rng.uniform(-43.0, -10.0), 2),
+                      round(rng.uniform(113.0, 153.0), 2))
+                     for _ in xrange(max(1, count // 4))]
+            records = []
+            for _ in xrange(count):
+                lat, lon = rng.choice(sites)
+                date = SYNTHETIC_START + timedelta(
+                        seconds=rng.randint(0, date_range))
+                records.append((date, str(uuid.UUID(int=rng.getrandbits(128))),
+                                lat, lon))
+            species.append(FakeSpecies(
+                    'urn:lsid:fake.ala.org.au:taxon:{0:04d}'.format(idx),
+                    'Fakeus species{0}'.format(idx),
+                    'Fake Bird {0}'.format(idx),
+                    records))
+        return cls(species)
+
+    @classmethod
+    def load(cls, path):
+        '''Loads a fixture file written by `save`'''
+        with open(path, 'rb') as f:
+            fixture = json.load(f)
+        species = []
+        for s in fixture['species']:
+            records = [(datetime.strptime(date, DATE_FORMAT), uuid_str,
+                        lat, lon)
+                       for uuid_str, lat, lon, date in s['records']]
+            species.append(FakeSpecies(s['lsid'], s['scientificName'],
+                                       s.get('commonName'), records))
+        return cls(species)
+
+    def save(self, path):
+        fixture = {'species': [{
+            'lsid': s.lsid,
+            'scientificName': s.scientific_name,
+            'commonName': s.common_name,
+            'records': [(uuid_str, lat, lon, date.strftime(DATE_FORMAT))
+                        for date, uuid_str, lat, lon in s.records],
+        } for s in self.species]}
+        with open(path, 'wb') as f:
+            json.dump(fixture, f)
+
+    @classmethod
+    def record(cls, lsids):
+        '''Fetches the species and records with the given LSIDs from ALA,
+        using ala.py's current settings. ALA doesn't send when records were
+        last processed, so they all get the current time.'''
+        import ala
+        now = datetime.utcnow().replace(microsecond=0)
+        species = []
+        for lsid in lsids:
+            s = ala.species_for_lsid(lsid)
+            if s is None:
+                log.warning('Not a species at ALA: %s', lsid)
+                continue
+            records = []
+            for batch in ala.record_batches_for_species(lsid, 'search'):
+                for record in batch:
+                    records.append((now, str(record.uuid), record.latitude,
+                                    record.longitude))
+            log.info('Recorded %d records of %s', len(records),
+                     s.scientific_name)
+            species.append(FakeSpecies(lsid, s.scientific_name,
+                                       s.common_name, records))
+        return cls(species)
+
+    def select(self, q):
+        '''Returns the records matching the 'q' parameter of a biocache
+        query. Records of one species are (date, uuid, lat, lon) tuples, and
+        records of all birds have the species' lsid on the end.'''
+        lsid, from_date, to_date = parse_q(q)
+        if lsid is None:
+            records, dates = self.records, self.dates
+        else:
+            s = self.by_lsid.get(lsid)
+            if s is None:
+                return []
+            records, dates = s.records, s.dates
+
+        start = 0 if from_date is None else bisect.bisect_left(dates,
+                                                               from_date)
+        end = len(dates) if to_date is None else bisect.bisect_right(dates,
+                                                                     to_date)
+        return records[start:end]
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Serves `dataset` like ALA does (see the module docstring).
+
+    `latency` is the seconds before each response starts, plus up to
+    `latency_jitter` more. `bandwidth` limits each response to that many
+    bytes per second. A random `error_rate` fraction of requests fail with
+    HTTP status `error_status`. Responses are gzipped when the client asks,
+    unless `gzip` is False.
+
+    Give `port` 0 to use any free port, and find it in `url`.'''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dataset, host='127.0.0.1', port=0, latency=0.0,
+            latency_jitter=0.0, bandwidth=None, error_rate=0.0,
+            error_status=503, gzip=True, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           _StandInHandler)
+        self.dataset = dataset
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.gzip = gzip
+        self.num_requests = 0
+        self.num_errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connections = set()
+        self._responses = {}
+        self._response_bytes = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def start(self):
+        '''Serves on a background thread until `stop` is called'''
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='StandInServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        # wakes up handler threads waiting on keep-alive connections
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        '''Clients hanging up on keep-alive connections isn't worth a
+        traceback'''
+        log.debug('Error handling request from %s', client_address,
+                  exc_info=True)
+
+    def response(self, path, query, gzip):
+        '''Returns (status, content type, body, content encoding) of the
+        response to a request. Successful responses are cached.'''
+        key = (path, query, gzip and self.gzip)
+        with self._lock:
+            cached = self._responses.get(key)
+        if cached is not None:
+            return cached
+
+        status, content_type, body = respond(self.dataset, path, query)
+        encoding = None
+        if key[2] and status == 200:
+            compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            encoding = 'gzip'
+
+        response = (status, content_type, body, encoding)
+        if status == 200:
+            with self._lock:
+                if self._response_bytes + len(body) <= RESPONSE_CACHE_BYTES:
+                    self._responses[key] = response
+                    self._response_bytes += len(body)
+        return response
+
+    def next_request(self):
+        '''Counts a request, and returns (seconds to wait, whether it should
+        fail)'''
+        with self._lock:
+            self.num_requests += 1
+            delay = self.latency
+            if self.latency_jitter:
+                delay += self._rng.uniform(0, self.latency_jitter)
+            fail = self.error_rate and self._rng.random() < self.error_rate
+            if fail:
+                self.num_errors += 1
+        return delay, fail
+
+
+class _StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server._lock:
+            self.server._connections.add(self.connection)
+
+    def finish(self):
+        with self.server._lock:
+            self.server._connections.discard(self.connection)
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self._handle(url.path, url.query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._handle(urlparse.urlparse(self.path).path,
+                     self.rfile.read(length))
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def _handle(self, path, query):
+        delay, fail = self.server.next_request()
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            self._send(self.server.error_status, 'text/plain',
+                       'Injected error', None, {'Retry-After': '1'})
+            return
+
+        accepts_gzip = 'gzip' in (self.headers.getheader('Accept-Encoding')
+                                  or '')
+        self._send(*self.server.response(path, query, accepts_gzip))
+
+    def _send(self, status, content_type, body, encoding, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+
+        start = time.time()
+        for offset in xrange(0, len(body), WRITE_CHUNK_SIZE):
+            chunk = body[offset:offset + WRITE_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            ahead = start + (offset + len(chunk)) / float(bandwidth) - \
+                    time.time()
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+def respond(dataset, path, query):
+    '''Returns (status, content type, body) of the response to a GET of
+    `path`?`query`'''
+    params = urlparse.parse_qs(query)
+    try:
+        if path.endswith('/ws/occurrences/search'):
+            return 200, 'application/json', occurrence_search(dataset, params)
+        elif path.endswith('/ws/occurrences/facets/download'):
+            return 200, 'text/csv', facet_download(dataset, params)
+        elif path.endswith('/ws/occurrences/download'):
+            return 200, 'application/zip', occurrence_download(dataset, params)
+        elif path.endswith('/search.json'):
+            return 200, 'application/json', species_search(dataset, params)
+        elif '/ws/guid/' in path:
+            name = urllib.unquote(path.split('/ws/guid/', 1)[1])
+            return 200, 'application/json', guid(dataset, name)
+        elif '/species/shortProfile/' in path and path.endswith('.json'):
+            lsid = urllib.unquote(
+                    path.split('/species/shortProfile/', 1)[1][:-5])
+            body = short_profile(dataset, lsid)
+            if body is not None:
+                return 200, 'application/json', body
+        return 404, 'text/plain', 'Not found'
+    except (KeyError, ValueError), e:
+        return 400, 'text/plain', 'Bad request: {0}'.format(e)
+
+
+def occurrence_search(dataset, params):
+    '''Body of a ws/occurrences/search response. Only the fields in 'fl'
+    are sent.
+
+    >>> ds = Dataset.synthetic(num_species=2, num_records=30, seed=1)
+    >>> page = json.loads(occurrence_search(ds, {
+    ...     'q': ['lsid:' + ds.species[1].lsid + ' AND rank:species'],
+    ...     'fl': ['id,latitude,longitude'], 'pageSize': ['4'],
+    ...     'startIndex': ['8']}))
+    >>> page['totalRecords'], page['startIndex'], len(page['occurrences'])
+    (10, 8, 2)
+    >>> sorted(page['occurrences'][0].keys())
+    [u'decimalLatitude', u'decimalLongitude', u'uuid']
+    '''
+    records = dataset.select(params['q'][0])
+    page_size = int(params.get('pageSize', [DEFAULT_PAGE_SIZE])[0])
+    start = int(params.get('startIndex', [0])[0])
+    fields = set(params.get('fl', ['id,latitude,longitude'])[0].split(','))
+
+    occurrences = []
+    for record in records[start:start + page_size]:
+        occ = {}
+        if 'id' in fields:
+            occ['uuid'] = record[1]
+        if 'latitude' in fields:
+            occ['decimalLatitude'] = record[2]
+        if 'longitude' in fields:
+            occ['decimalLongitude'] = record[3]
+        if 'species_guid' in fields and len(record) > 4:
+            occ['speciesGuid'] = record[4]
+        occurrences.append(occ)
+
+    return json.dumps({
+        'pageSize': page_size,
+        'startIndex': start,
+        'totalRecords': len(records),
+        'sort': params.get('sort', ['score'])[0],
+        'dir': params.get('dir', ['asc'])[0],
+        'status': 'OK',
+        'occurrences': occurrences,
+    })
+
+
+def facet_download(dataset, params):
+    '''Body of a ws/occurrences/facets/download response, for the
+    'lat_long' or 'id' facet. Like ALA, lat_long values aren't quoted, so
+    rows have one more column than the heading.
+
+    >>> ds = Dataset.synthetic(num_species=1, num_records=8, seed=1)
+    >>> print facet_download(ds, {'q': ['lsid:' + ds.species[0].lsid],
+    ...                           'facets': ['lat_long']}),
+    lat_long,Count
+    -38.57,146.9,7
+    -17.8,123.2,1
+    '''
+    records = dataset.select(params['q'][0])
+    facet = params['facets'][0]
+    out = StringIO.StringIO()
+    if facet == 'lat_long':
+        counts = {}
+        for record in records:
+            key = (record[2], record[3])
+            counts[key] = counts.get(key, 0) + 1
+        out.write('lat_long,Count\n')
+        for (lat, lon), count in sorted(counts.iteritems()):
+            out.write('{0!r},{1!r},{2}\n'.format(lat, lon, count))
+    elif facet == 'id':
+        out.write('id,Count\n')
+        for record in records:
+            out.write('{0},1\n'.format(record[1]))
+    else:
+        raise ValueError('Unsupported facet: ' + facet)
+    return out.getvalue()
+
+
+def occurrence_download(dataset, params):
+    '''Body of a ws/occurrences/download response: a zip file holding
+    `<file>.csv`'''
+    records = dataset.select(params['q'][0])
+    file_name = params.get('file', ['data'])[0]
+    rows = StringIO.StringIO()
+    writer = csv.writer(rows)
+    writer.writerow(['Latitude - processed', 'Longitude - processed'])
+    for record in records:
+        writer.writerow([repr(record[2]), repr(record[3])])
+
+    out = StringIO.StringIO()
+    zip_file = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    zip_file.writestr(file_name + '.csv', rows.getvalue())
+    zip_file.close()
+    return out.getvalue()
+
+
+def species_search(dataset, params):
+    '''Body of a BIE search.json response, listing every species'''
+    page_size = int(params.get('pageSize', [DEFAULT_PAGE_SIZE])[0])
+    start = int(params.get('start', [0])[0])
+    results = [{
+        'guid': s.lsid,
+        'nameComplete': s.scientific_name,
+        'commonNameSingle': s.common_name,
+        'rank': 'species',
+    } for s in dataset.species[start:start + page_size]]
+    return json.dumps({'searchResults': {
+        'totalRecords': len(dataset.species),
+        'startIndex': start,
+        'pageSize': page_size,
+        'results': results,
+    }})
+
+
+def guid(dataset, scientific_name):
+    '''Body of a BIE ws/guid response'''
+    s = dataset.by_name.get(scientific_name.lower())
+    if s is None:
+        return '[]'
+    return json.dumps([{'identifier': s.lsid, 'name': s.scientific_name}])
+
+
+def short_profile(dataset, lsid):
+    '''Body of a BIE species/shortProfile response, or None for a 404'''
+    s = dataset.by_lsid.get(lsid)
+    if s is None:
+        return None
+    profile = {'rank': 'species', 'scientificName': s.scientific_name}
+    if s.common_name is not None:
+        profile['commonName'] = s.common_name
+    return json.dumps(profile)
+
+
+def parse_q(q):
+    '''Returns (lsid, from date, to date) from the 'q' parameter of a
+    biocache query. lsid is None for queries of all birds, and the dates are
+    None when they're '*' or missing.
+
+    >>> import ala
+    >>> parse_q(ala.q_param_for_lsid('urn:lsid:x.org:taxon:1',
+    ...     changed_since=datetime(2012, 3, 4)))
+    ('urn:lsid:x.org:taxon:1', datetime.datetime(2012, 3, 4, 0, 0), None)
+    >>> parse_q(ala.q_param_for_birds())
+    (None, None, None)
+    '''
+    lsid = None
+    from_date = to_date = None
+    terms = q.replace('(', ' ').replace(')', ' ').split()
+    for idx, term in enumerate(terms):
+        if term.startswith('lsid:'):
+            lsid = term[len('lsid:'):]
+        elif term.startswith('last_processed_date:['):
+            from_date = _parse_date(term[len('last_processed_date:['):])
+            to_date = _parse_date(terms[idx + 2].rstrip(']'))
+    return lsid, from_date, to_date
+
+
+def _parse_date(value):
+    if value == '*':
+        return None
+    return datetime.strptime(value, DATE_FORMAT)
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,296 @@
+'''Adaptive rate and concurrency limits for requests, shared between processes.
+
+Without coordination, every fetch worker sends requests as fast as it can,
+so they all overload the server together, and then all back off together. A
+Governor is a token bucket (a limit on requests per second) combined with a
+limit on the number of requests in flight at once. Both limits are adjusted
+with AIMD (additive increase, multiplicative decrease): they creep up while
+requests succeed quickly, and are cut in half when the server shows signs of
+overload, like HTTP 429/503 responses, timeouts or slow responses.
+
+The state lives in shared memory, so a Governor created before starting a
+multiprocessing.Pool limits the requests of all the worker processes at once
+(pass it to the workers through the pool initializer).
+
+`classify_error` decides whether a failed request is worth retrying.
+'''
+
+import httplib
+import logging
+import multiprocessing
+import random
+import socket
+import time
+import urllib2
+
+#default requests per second, to start with and at most
+INITIAL_RATE = 5.0
+MAX_RATE = 20.0
+MIN_RATE = 0.2
+#default requests in flight at once, to start with and at most. Starts at
+#sync.FETCH_WORKERS, so none of the fetch workers wait from the start.
+INITIAL_CONCURRENCY = 8
+MAX_CONCURRENCY = 16
+MIN_CONCURRENCY = 1
+#responses slower than this (in seconds), including reading the body,
+#count as a sign of overload
+LATENCY_TARGET = 20.0
+#limits are multiplied by this when the server is overloaded
+DECREASE_FACTOR = 0.5
+#seconds to stop sending requests after being throttled, if the server
+#doesn't say how long with a Retry-After header
+THROTTLE_PAUSE = 5.0
+#seconds between checks while waiting for a free slot
+POLL_INTERVAL = 0.05
+
+#HTTP status codes that mean the server is overloaded
+THROTTLE_STATUSES = frozenset([429, 502, 503, 504])
+
+#outcomes of a request, see Governor.release and classify_error
+SUCCESS = 'success'
+THROTTLED = 'throttled'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+
+#indexes into Governor._state
+_TOKENS = 0
+_REFILL_TIME = 1
+_RATE = 2
+_CONCURRENCY = 3
+_IN_FLIGHT = 4
+_PAUSED_UNTIL = 5
+_LAST_DECREASE = 6
+_NUM_REQUESTS = 7
+_NUM_THROTTLED = 8
+_NUM_ERRORS = 9
+_NUM_WAITS = 10
+_WAIT_SECONDS = 11
+_STATE_SIZE = 12
+
+
+log = logging.getLogger(__name__)
+
+
+class Governor(object):
+    '''Token bucket plus AIMD concurrency limit, see the module docstring.
+
+    Call `acquire` before every request, and `release` with the outcome
+    after it. Burst size of the token bucket is one second's worth of
+    requests.'''
+
+    def __init__(self, initial_rate=INITIAL_RATE, max_rate=MAX_RATE,
+            min_rate=MIN_RATE, initial_concurrency=INITIAL_CONCURRENCY,
+            max_concurrency=MAX_CONCURRENCY, min_concurrency=MIN_CONCURRENCY,
+            latency_target=LATENCY_TARGET):
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.max_concurrency = float(max_concurrency)
+        self.min_concurrency = float(min_concurrency)
+        self.latency_target = latency_target
+
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray('d', _STATE_SIZE)
+        self._state[_TOKENS] = 1.0
+        self._state[_REFILL_TIME] = time.time()
+        self._state[_RATE] = min(float(initial_rate), self.max_rate)
+        self._state[_CONCURRENCY] = min(float(initial_concurrency),
+                                        self.max_concurrency)
+
+    @property
+    def rate(self):
+        return self._state[_RATE]
+
+    @property
+    def concurrency(self):
+        return int(self._state[_CONCURRENCY])
+
+    @property
+    def in_flight(self):
+        return int(self._state[_IN_FLIGHT])
+
+    def stats(self):
+        '''Dict of counters, summed over every process'''
+        with self._lock:
+            return {
+                'requests': int(self._state[_NUM_REQUESTS]),
+                'throttled': int(self._state[_NUM_THROTTLED]),
+                'errors': int(self._state[_NUM_ERRORS]),
+                'waits': int(self._state[_NUM_WAITS]),
+                'wait_seconds': self._state[_WAIT_SECONDS],
+                'rate': self._state[_RATE],
+                'concurrency': int(self._state[_CONCURRENCY]),
+            }
+
+    def acquire(self):
+        '''Blocks until a request can be sent. Returns the time it was
+        allowed, to pass to `release`.'''
+
+        waited = None
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                wait = self._wait_time(now)
+                if wait <= 0:
+                    self._state[_TOKENS] -= 1.0
+                    self._state[_IN_FLIGHT] += 1
+                    self._state[_NUM_REQUESTS] += 1
+                    if waited is not None:
+                        self._state[_NUM_WAITS] += 1
+                        self._state[_WAIT_SECONDS] += now - waited
+                    return now
+
+            if waited is None:
+                waited = now
+            time.sleep(min(wait, POLL_INTERVAL))
+
+    def release(self, start_time, outcome, retry_after=None):
+        '''Records the outcome of a request started by `acquire`. `outcome`
+        is one of SUCCESS, THROTTLED, RETRYABLE or FATAL (see
+        `classify_error`). A THROTTLED outcome pauses all requests for
+        `retry_after` seconds (default THROTTLE_PAUSE).'''
+
+        with self._lock:
+            now = time.time()
+            self._state[_IN_FLIGHT] = max(0, self._state[_IN_FLIGHT] - 1)
+            latency = now - start_time
+
+            if outcome == THROTTLED:
+                self._state[_NUM_THROTTLED] += 1
+                pause = THROTTLE_PAUSE if retry_after is None else retry_after
+                self._state[_PAUSED_UNTIL] = max(self._state[_PAUSED_UNTIL],
+                                                 now + pause)
+                self._decrease(now, start_time)
+            elif outcome == RETRYABLE:
+                # timeouts and dropped connections are likely overload
+                self._state[_NUM_ERRORS] += 1
+                self._decrease(now, start_time)
+            elif outcome == FATAL:
+                # the request was bad, which says nothing about the server
+                self._state[_NUM_ERRORS] += 1
+            elif latency > self.latency_target:
+                self._decrease(now, start_time)
+            else:
+                self._increase()
+
+    def reset_in_flight(self):
+        '''Forgets about requests in flight. Call this after killing
+        processes that were in the middle of requests, which will never
+        release them.'''
+        with self._lock:
+            self._state[_IN_FLIGHT] = 0
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._state[_REFILL_TIME])
+        rate = self._state[_RATE]
+        self._state[_TOKENS] = min(max(rate, 1.0),
+                                   self._state[_TOKENS] + elapsed * rate)
+        self._state[_REFILL_TIME] = now
+
+    def _wait_time(self, now):
+        '''Seconds until a request might be allowed, or 0 if it is now'''
+        if now < self._state[_PAUSED_UNTIL]:
+            return self._state[_PAUSED_UNTIL] - now
+        if self._state[_IN_FLIGHT] >= int(self._state[_CONCURRENCY]):
+            return POLL_INTERVAL
+        if self._state[_TOKENS] < 1.0:
+            return (1.0 - self._state[_TOKENS]) / self._state[_RATE]
+        return 0.0
+
+    def _increase(self):
+        '''Additive increase: about one more request in flight, and one more
+        request per second, for every full round of successful requests'''
+        concurrency = self._state[_CONCURRENCY]
+        self._state[_CONCURRENCY] = min(self.max_concurrency,
+                                        concurrency + 1.0 / concurrency)
+        rate = self._state[_RATE]
+        self._state[_RATE] = min(self.max_rate, rate + 1.0 / rate)
+
+    def _decrease(self, now, start_time):
+        '''Multiplicative decrease. When lots of requests fail at once, only
+        the first failure counts, and the others are ignored if they were
+        sent before the limits were last cut, so one overload doesn't cut the
+        limits to the minimum.'''
+        if start_time < self._state[_LAST_DECREASE]:
+            return
+        self._state[_LAST_DECREASE] = now
+        self._state[_CONCURRENCY] = max(self.min_concurrency,
+                self._state[_CONCURRENCY] * DECREASE_FACTOR)
+        self._state[_RATE] = max(self.min_rate,
+                self._state[_RATE] * DECREASE_FACTOR)
+        log.info('Backing off to %d concurrent requests, %0.2f requests/s',
+                 int(self._state[_CONCURRENCY]), self._state[_RATE])
+
+
+def classify_error(exc):
+    '''Returns THROTTLED, RETRYABLE or FATAL for an exception raised by a
+    request.
+
+    >>> classify_error(urllib2.HTTPError('http://x', 404, 'Not Found', {},
+    ...                                  None))
+    'fatal'
+    >>> classify_error(urllib2.HTTPError('http://x', 503, 'Busy', {}, None))
+    'throttled'
+    >>> classify_error(urllib2.HTTPError('http://x', 500, 'Oops', {}, None))
+    'retryable'
+    >>> classify_error(socket.timeout('timed out'))
+    'retryable'
+    >>> classify_error(ValueError('No JSON object could be decoded'))
+    'retryable'
+    >>> classify_error(KeyError('totalRecords'))
+    'fatal'
+    '''
+
+    if isinstance(exc, urllib2.HTTPError):
+        if exc.code in THROTTLE_STATUSES:
+            return THROTTLED
+        elif exc.code >= 500:
+            return RETRYABLE
+        else:
+            return FATAL
+    elif isinstance(exc, (urllib2.URLError, httplib.HTTPException,
+            socket.error, EnvironmentError)):
+        return RETRYABLE
+    elif isinstance(exc, ValueError):
+        # truncated or garbled JSON
+        return RETRYABLE
+    elif isinstance(exc, RuntimeError):
+        # e.g. ALA returned an empty response
+        return RETRYABLE
+    else:
+        return FATAL
+
+
+def retry_after(exc):
+    '''Seconds from the Retry-After header of an HTTPError, or None
+
+    >>> retry_after(urllib2.HTTPError('http://x', 429, 'Slow down',
+    ...                               {'Retry-After': '7'}, None))
+    7.0
+    >>> retry_after(ValueError()) is None
+    True
+    '''
+    headers = getattr(exc, 'hdrs', None)
+    if headers is None:
+        return None
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(delay, backoff, attempt):
+    '''Seconds to wait before retry number `attempt` (starting at 1). That
+    is up to `delay` * `backoff` ** (`attempt` - 1), with "full jitter" so that
+    workers that failed together don't all retry together.
+
+    >>> 0 <= backoff_delay(2, 2, 3) <= 8
+    True
+    '''
+    return random.uniform(0, delay * backoff ** (attempt - 1))
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
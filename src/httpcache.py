@@ -0,0 +1,271 @@
+'''On-disk cache of HTTP responses, for web services that rarely change.
+
+Only GET requests are cached. Each response is stored in its own file, named
+after the SHA-1 of the url. The file holds one line of JSON metadata (when it
+was stored, ETag and Last-Modified headers) followed by the response body.
+
+How long a response stays fresh depends on the url (see ResponseCache.ttls).
+Empty responses (see EMPTY_BODIES) aren't cached, so a glitch that makes a
+web service say it has nothing doesn't stick around for the whole TTL.
+Once stale, the next request is sent with If-None-Match/If-Modified-Since
+headers, so the body doesn't have to be downloaded again if it hasn't
+changed.
+
+Files are written to a temporary name and renamed into place, so any number
+of processes can share the same cache directory. The least recently used
+files are deleted when the cache grows bigger than `max_bytes`. Finding them
+means listing the whole cache, so each process only checks after every
+EVICT_INTERVAL writes, or once it has written EVICT_FRACTION of `max_bytes`.
+The cache can grow a bit past `max_bytes` in between.
+'''
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import StringIO
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+#seconds each kind of response stays fresh, matched against the url path
+DEFAULT_TTLS = (
+    ('/species/shortProfile/', 7 * 24 * 60 * 60),
+    ('/ws/guid/', 7 * 24 * 60 * 60),
+    ('/search.json', 24 * 60 * 60),
+)
+#response bodies that mean nothing was found, which aren't cached
+EMPTY_BODIES = frozenset(['', '[]', '{}', 'null'])
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+#each process checks the size of the cache after this many writes
+EVICT_INTERVAL = 100
+#or after writing this fraction of max_bytes, whichever comes first
+EVICT_FRACTION = 0.05
+#temporary files younger than this many seconds are being written by some
+#process, so eviction leaves them alone. Older ones were left by a crash.
+TEMP_FILE_GRACE = 60 * 60
+
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache(object):
+    '''`ttls` is a sequence of (url path substring, seconds) pairs. The first
+    one that matches a url decides how long its responses are fresh for. Urls
+    that don't match any are not cached.'''
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES,
+            ttls=DEFAULT_TTLS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self._lock = threading.Lock()
+        self._writes_since_evict = 0
+        self._bytes_since_evict = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def ttl_for(self, url):
+        '''Seconds responses from `url` stay fresh, or None if not cached'''
+        return _ttl_for(url, self.ttls)
+
+    def open(self, request, opener):
+        '''Returns a file-like response for `request` (a urllib2.Request),
+        from the cache if possible. `opener` is called with the request to
+        fetch it if not.'''
+
+        url = request.get_full_url()
+        ttl = self.ttl_for(url)
+        if ttl is None or request.get_data() is not None:
+            return opener(request)
+
+        path = self._path_for(url)
+        meta, body = self._read(path)
+        if meta is not None:
+            if time.time() - meta['stored'] < ttl:
+                log.debug('Cache hit: %s', url)
+                self._touch(path)
+                return CachedResponse(body, url)
+
+            # stale, so check if it has changed
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = opener(request)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or meta is None:
+                raise
+            response = e
+
+        if response.getcode() == 304 and meta is not None:
+            log.debug('Cache revalidated: %s', url)
+            response.close()
+            meta['stored'] = time.time()
+            self._write(path, meta, body)
+            return CachedResponse(body, url)
+
+        body = response.read()
+        raw_bytes_read = getattr(response, 'raw_bytes_read', len(body))
+        if body.strip() in EMPTY_BODIES:
+            log.debug('Not caching empty response: %s', url)
+            return CachedResponse(body, url, raw_bytes_read)
+
+        headers = response.info()
+        self._write(path, {
+            'url': url,
+            'stored': time.time(),
+            'etag': headers.get('etag'),
+            'last_modified': headers.get('last-modified'),
+        }, body)
+        if self._should_evict(len(body)):
+            self._evict()
+        return CachedResponse(body, url, raw_bytes_read)
+
+    def clear(self):
+        for path, size, mtime in self._entries():
+            _remove(path)
+
+    def _path_for(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def _read(self, path):
+        '''Returns (meta, body), or (None, None) if not cached'''
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                body = f.read()
+        except (IOError, ValueError):
+            return None, None
+
+        if len(body) != meta.get('size'):
+            return None, None  # partly written by something else
+        return meta, body
+
+    def _write(self, path, meta, body):
+        meta['size'] = len(body)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(meta) + '\n')
+                f.write(body)
+            os.rename(temp_path, path)
+        except:
+            _remove(temp_path)
+            raise
+
+    def _touch(self, path):
+        '''Marks the entry as recently used, for LRU eviction'''
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _entries(self):
+        '''Yields (path, size, mtime) for every cached file, and temporary
+        files older than TEMP_FILE_GRACE'''
+        temp_cutoff = time.time() - TEMP_FILE_GRACE
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # deleted by another process
+                if filename.endswith('.tmp') and st.st_mtime > temp_cutoff:
+                    continue  # still being written by another process
+                yield path, st.st_size, st.st_mtime
+
+    def _should_evict(self, num_bytes):
+        '''Counts a write of `num_bytes`, and returns True if it's time to
+        check the size of the cache'''
+        with self._lock:
+            self._writes_since_evict += 1
+            self._bytes_since_evict += num_bytes
+            if self._writes_since_evict < EVICT_INTERVAL and \
+                    self._bytes_since_evict < self.max_bytes * EVICT_FRACTION:
+                return False
+            self._writes_since_evict = 0
+            self._bytes_since_evict = 0
+            return True
+
+    def _evict(self):
+        '''Deletes least recently used entries until the cache is no bigger
+        than max_bytes'''
+        entries = list(self._entries())
+        total = sum(size for path, size, mtime in entries)
+        if total <= self.max_bytes:
+            return
+
+        entries.sort(key=lambda entry: entry[2])
+        for path, size, mtime in entries:
+            if total <= self.max_bytes:
+                break
+            _remove(path)
+            total -= size
+
+
+class CachedResponse(StringIO.StringIO):
+    '''File-like response body from the cache. `raw_bytes_read` is the
+    number of bytes downloaded for it, or None if it came from the cache.'''
+
+    def __init__(self, body, url, raw_bytes_read=None):
+        StringIO.StringIO.__init__(self, body)
+        self.url = url
+        self.raw_bytes_read = raw_bytes_read
+
+    def info(self):
+        return {}
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return 200
+
+
+def _ttl_for(url, ttls):
+    '''
+    >>> _ttl_for('http://bie.ala.org.au/ws/guid/Falco', DEFAULT_TTLS)
+    604800
+    >>> _ttl_for('http://biocache.ala.org.au/ws/occurrences/search',
+    ...          DEFAULT_TTLS) is None
+    True
+    '''
+    path = urlparse.urlsplit(url).path
+    for path_part, ttl in ttls:
+        if path_part in path:
+            return ttl
+    return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
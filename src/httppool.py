@@ -0,0 +1,363 @@
+'''Keep-alive HTTP connections with gzip/deflate decoding.
+
+urllib2 opens a new TCP connection for every request and never asks for
+compressed responses. A ConnectionPool keeps idle connections around per host
+so the next request to the same host can reuse them, and transparently
+decompresses gzip/deflate response bodies while they are being read.
+
+A pool is not shared between processes. Create one per process (ala does this
+automatically, see ala.connection_pool).
+'''
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import zlib
+
+READ_CHUNK_SIZE = 16 * 1024
+MAX_REDIRECTS = 5
+
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    '''Thread safe pool of keep-alive connections, keyed by scheme and host.
+
+    `size` is the maximum number of idle connections kept per host. More
+    connections than that can be open at once, but the extras are closed
+    instead of being returned to the pool. Idle connections that haven't been
+    used for `idle_timeout` seconds are closed instead of being reused.
+
+    `connect_timeout` is the most seconds to wait for a connection to open,
+    and `read_timeout` the most seconds to wait for each read from the
+    server. Both raise socket.timeout. None waits forever.'''
+
+    def __init__(self, size=4, idle_timeout=30.0, connect_timeout=None,
+            read_timeout=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, request):
+        '''Like urllib2.urlopen, but reuses connections.
+
+        `request` is a urllib2.Request. Returns a file-like PooledResponse.
+        Raises urllib2.HTTPError for 4xx and 5xx responses, like urllib2
+        does. Redirects are followed.'''
+
+        url = request.get_full_url()
+        if _proxy_for(url) is not None:
+            # let urllib2 deal with proxies
+            if self.read_timeout is None:
+                return urllib2.urlopen(request)
+            return urllib2.urlopen(request, timeout=self.read_timeout)
+
+        method = request.get_method()
+        data = request.get_data()
+        headers = dict(request.header_items())
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+
+        for redirect_num in range(MAX_REDIRECTS + 1):
+            key, path = _split_url(url)
+            conn, response = self._send(key, method, path, data, headers)
+
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307) and location:
+                response.read()
+                self._release(key, conn, response)
+                url = urlparse.urljoin(url, location)
+                if response.status != 307:
+                    method, data = 'GET', None
+                log.debug('Redirected to: %s', url)
+                continue
+
+            pooled = PooledResponse(self, key, conn, response, url)
+            if response.status >= 400:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                        response.msg, pooled)
+            return pooled
+
+        raise urllib2.URLError('Too many redirects for: ' +
+                               request.get_full_url())
+
+    def close(self):
+        '''Closes all idle connections'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for conn, last_used in conns:
+                conn.close()
+
+    def _send(self, key, method, path, data, headers):
+        '''Sends the request and returns (connection, httplib response).
+
+        A reused connection may have been closed by the server since it was
+        last used, so the request is tried once more on a fresh connection if
+        that happens.'''
+
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, data, headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+
+        log.debug('Stale keep-alive connection to %s, reconnecting', key[1])
+        conn = self._connect(key)
+        try:
+            conn.request(method, path, data, headers)
+            return conn, conn.getresponse()
+        except:
+            conn.close()
+            raise
+
+    def _acquire(self, key):
+        '''Returns (connection, was_reused)'''
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key, [])
+            while len(conns) > 0:
+                conn, last_used = conns.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        return self._connect(key), False
+
+    def _connect(self, key):
+        '''Opens a new connection, with the timeouts set'''
+        conn = _new_connection(key, self.connect_timeout)
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def _release(self, key, conn, response):
+        '''Returns the connection to the pool, or closes it if it can't be
+        reused'''
+        if response.will_close:
+            conn.close()
+            return
+
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append((conn, time.time()))
+                return
+        conn.close()
+
+
+class PooledResponse(object):
+    '''File-like response body that decompresses as it is read.
+
+    The connection goes back into the pool once the whole body has been read.
+    Closing the response before then closes the connection.'''
+
+    def __init__(self, pool, key, conn, response, url):
+        self.code = response.status
+        self.msg = response.reason
+        self.url = url
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._buffer = ''
+        self._pos = 0
+        self._raw_bytes_read = 0
+        self._aborted = False
+        self._decompressor = _decompressor_for(
+                response.getheader('content-encoding', ''))
+
+    @property
+    def raw_bytes_read(self):
+        '''Number of bytes read off the wire, before decompression'''
+        return self._raw_bytes_read
+
+    def info(self):
+        return self._response.msg
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def read(self, amt=-1):
+        while amt < 0 or len(self._buffer) - self._pos < amt:
+            if not self._fill():
+                break
+
+        end = len(self._buffer)
+        if amt >= 0:
+            end = min(end, self._pos + amt)
+        chunk = self._buffer[self._pos:end]
+        self._pos = end
+        return chunk
+
+    def readline(self):
+        end = self._buffer.find('\n', self._pos)
+        while end < 0:
+            # _fill moves the unread data to the start of the buffer
+            searched = len(self._buffer) - self._pos
+            if not self._fill():
+                end = len(self._buffer) - 1
+                break
+            end = self._buffer.find('\n', self._pos + searched)
+
+        line = self._buffer[self._pos:end + 1]
+        self._pos = end + 1
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._buffer = ''
+        self._pos = 0
+
+    def abort(self):
+        '''Can be called from another thread to make a read that is stuck
+        waiting on the server raise IOError. The connection is thrown away.'''
+        self._aborted = True
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _fill(self):
+        '''Reads and decodes another chunk into the buffer. Returns False once
+        the whole body has been read.'''
+        if self._conn is None:
+            return False
+
+        # throw away the part of the buffer that has already been read
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+        raw = self._response.read(READ_CHUNK_SIZE)
+        if self._aborted:
+            self.close()
+            raise IOError('Response was aborted')
+        self._raw_bytes_read += len(raw)
+        if len(raw) > 0:
+            self._buffer += self._decompressor.decompress(raw)
+            return True
+
+        self._buffer += self._decompressor.flush()
+        self._pool._release(self._key, self._conn, self._response)
+        self._conn = None
+        return len(self._buffer) > 0
+
+
+class _IdentityDecompressor(object):
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return ''
+
+
+class _DeflateDecompressor(object):
+    '''Some servers send raw deflate data for "Content-Encoding: deflate"
+    instead of zlib wrapped data, so this handles both'''
+
+    def __init__(self):
+        self._decompressor = None
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return ''
+        return self._decompressor.flush()
+
+
+def _decompressor_for(content_encoding):
+    '''
+    >>> d = _decompressor_for('gzip')
+    >>> gzipped = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    >>> gzipped = gzipped.compress('hello') + gzipped.flush()
+    >>> d.decompress(gzipped) + d.flush()
+    'hello'
+    >>> d = _decompressor_for('deflate')
+    >>> d.decompress(zlib.compress('hello')) + d.flush()
+    'hello'
+    >>> _decompressor_for('').decompress('hello')
+    'hello'
+    '''
+    content_encoding = content_encoding.strip().lower()
+    if content_encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        return _DeflateDecompressor()
+    else:
+        return _IdentityDecompressor()
+
+
+def _split_url(url):
+    '''Returns ((scheme, host), path)
+
+    >>> _split_url('http://bie.ala.org.au/search.json?q=x')
+    (('http', 'bie.ala.org.au'), '/search.json?q=x')
+    >>> _split_url('https://biocache.ala.org.au')
+    (('https', 'biocache.ala.org.au'), '/')
+    '''
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    return (parts.scheme.lower(), parts.netloc.lower()), path
+
+
+def _new_connection(key, timeout=None):
+    scheme, host = key
+    log.debug('Opening new connection to %s://%s', scheme, host)
+    if scheme == 'https':
+        return httplib.HTTPSConnection(host, timeout=timeout)
+    elif scheme == 'http':
+        return httplib.HTTPConnection(host, timeout=timeout)
+    else:
+        raise urllib2.URLError('Unsupported url scheme: ' + scheme)
+
+
+def _proxy_for(url):
+    scheme = urlparse.urlsplit(url).scheme.lower()
+    return urllib.getproxies().get(scheme)
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
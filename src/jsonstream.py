@@ -0,0 +1,169 @@
+'''Incremental parsing of large JSON responses.
+
+json.loads needs the whole response in memory before it returns anything.
+ItemStream instead reads a file-like object a chunk at a time, and yields the
+items of one array (for example the 'occurrences' array of a biocache search
+page) as soon as each one has arrived. Only one item, plus one chunk of
+unparsed text, is held in memory at a time.
+'''
+
+import json
+
+CHUNK_SIZE = 16 * 1024
+WHITESPACE = ' \t\n\r'
+
+
+class ItemStream(object):
+    '''Iterable over the items of the JSON array at `items_path`.
+
+    `items_path` is a tuple of object keys leading to the array, for example
+    ('searchResults', 'results'). Every other value in the objects along that
+    path is put into `values` (keyed by its path) as it is parsed. Values that
+    come after the array in the JSON text are only available once iteration
+    has finished.
+
+    >>> import StringIO
+    >>> f = StringIO.StringIO('{"a": {"total": 2, "items": [1, {"x": "y"}]},'
+    ...                       ' "b": [3]}')
+    >>> stream = ItemStream(f, ('a', 'items'), chunk_size=3)
+    >>> list(stream)
+    [1, {u'x': u'y'}]
+    >>> stream.values[('a', 'total')], stream.values[('b',)]
+    (2, [3])
+    >>> list(ItemStream(StringIO.StringIO('{"items": []}'), ('items',)))
+    []
+    '''
+
+    def __init__(self, fileobj, items_path, chunk_size=CHUNK_SIZE):
+        assert len(items_path) > 0
+        self.values = {}
+        self.items_path = tuple(items_path)
+        self._file = fileobj
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+        self._started = False
+
+    def __iter__(self):
+        if self._started:
+            raise RuntimeError('ItemStream can only be iterated once')
+        self._started = True
+
+        if self._peek() != '{':
+            raise ValueError('Expected JSON object at start of stream')
+        for item in self._object_items(()):
+            yield item
+
+        if self._peek() != '':
+            raise ValueError('Unexpected data after JSON object')
+
+    def _object_items(self, prefix):
+        '''Parses an object, yielding the items of the array at items_path
+        if it is inside this object'''
+
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self._value()
+            self._expect(':')
+            path = prefix + (key,)
+
+            if path == self.items_path:
+                for item in self._array_items():
+                    yield item
+            elif path == self.items_path[:len(path)] and self._peek() == '{':
+                for item in self._object_items(path):
+                    yield item
+            else:
+                self.values[path] = self._value()
+
+            if self._peek() == ',':
+                self._pos += 1
+            else:
+                self._expect('}')
+                return
+
+    def _array_items(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield self._value()
+            if self._peek() == ',':
+                self._pos += 1
+            else:
+                self._expect(']')
+                return
+
+    def _value(self):
+        '''Parses and returns the next complete JSON value'''
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._read_more()
+                continue
+
+            # a number at the end of the buffer might be cut off, so make
+            # sure there's something after it
+            if end == len(self._buffer) and not self._eof:
+                self._read_more()
+                continue
+
+            self._pos = end
+            return value
+
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError('Expected "{0}" at position {1}'.format(
+                    char, self._pos))
+        self._pos += 1
+
+    def _peek(self):
+        '''Skips whitespace and returns the next char, or '' at the end'''
+        while True:
+            while self._pos < len(self._buffer):
+                if self._buffer[self._pos] not in WHITESPACE:
+                    return self._buffer[self._pos]
+                self._pos += 1
+            if self._eof:
+                return ''
+            self._read_more()
+
+    def _read_more(self):
+        '''Drops the parsed part of the buffer, and reads another chunk.
+        Values bigger than a chunk are read in exponentially bigger pieces so
+        they don't get reparsed too many times.'''
+
+        unparsed = self._buffer[self._pos:]
+        chunk = self._file.read(max(self._chunk_size, len(unparsed)))
+        if len(chunk) == 0:
+            self._eof = True
+        self._buffer = unparsed + chunk
+        self._pos = 0
+
+
+def value_at_path(obj, path):
+    '''
+    >>> value_at_path({'a': {'b': 1}}, ('a', 'b'))
+    1
+    '''
+    for key in path:
+        obj = obj[key]
+    return obj
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,375 @@
+'''Counters and histograms of where a sync spends its time.
+
+Each process has one Registry (see `registry`). The stages of a sync are
+timed into the `stage_seconds` histogram with `timer`:
+
+    with metrics.timer('stage_seconds', stage='db_flush'):
+        ...
+
+Fetch workers can't share their registry with the main process, so they
+send it through the record queue every now and then with `drain`, and the
+main process adds it to its own with `merge`.
+
+A Registry can be written as a JSON summary (`write_json`), or in the
+Prometheus text format (`write_prometheus`) for node_exporter's textfile
+collector. `TextfileWriter` rewrites the Prometheus file every few seconds
+while a sync runs.
+
+Each observation is a dict lookup and a few additions under a lock, so only
+time things that happen per page or per batch, not per record.
+'''
+
+import errno
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+#upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+#prepended to every metric name in the Prometheus output
+PREFIX = 'ala_sync_'
+#seconds between rewrites of the Prometheus textfile
+TEXTFILE_INTERVAL = 15.0
+#permissions of the written files. node_exporter usually runs as its own
+#user, and mkstemp makes files that only their owner can read
+FILE_MODE = 0644
+
+log = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    '''Counts of observations in BUCKETS, like a Prometheus histogram, plus
+    their sum and maximum.
+
+    >>> h = Histogram()
+    >>> for v in (0.002, 0.003, 0.004, 0.02, 0.5):
+    ...     h.observe(v)
+    >>> h.count, round(h.sum, 3), h.max
+    (5, 0.529, 0.5)
+    >>> h.quantile(0.5)
+    0.004375
+    >>> h.quantile(0.99) <= h.max
+    True
+    >>> Histogram().quantile(0.5) is None
+    True
+    '''
+
+    __slots__ = ('buckets', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        idx = 0
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+            idx += 1
+        self.buckets[idx] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for idx, count in enumerate(other.buckets):
+            self.buckets[idx] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        '''Estimates the `q` quantile (0 to 1) by linear interpolation within
+        its bucket, like Prometheus' histogram_quantile. Never more than the
+        maximum observation.'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for idx, count in enumerate(self.buckets):
+            upper = BUCKETS[idx] if idx < len(BUCKETS) else self.max
+            if count > 0 and seen + count >= rank:
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(value, self.max)
+            seen += count
+            lower = upper
+        return self.max
+
+    def __getstate__(self):
+        return (self.buckets, self.count, self.sum, self.max)
+
+    def __setstate__(self, state):
+        self.buckets, self.count, self.sum, self.max = state
+
+
+class Registry(object):
+    '''Named counters and histograms. Metrics can have labels, given as
+    keyword arguments, which become Prometheus labels.
+
+    >>> r = Registry()
+    >>> r.inc('pages_total', 2)
+    >>> r.observe('stage_seconds', 0.02, stage='json_parse')
+    >>> other = Registry()
+    >>> other.inc('pages_total')
+    >>> other.observe('stage_seconds', 0.2, stage='json_parse')
+    >>> r.merge(other.drain())
+    >>> other.drain()
+    ({}, {})
+    >>> r.counter('pages_total')
+    3.0
+    >>> print r.prometheus_text(),
+    # TYPE ala_sync_pages_total counter
+    ala_sync_pages_total 3.0
+    # TYPE ala_sync_stage_seconds histogram
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.001"} 0
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.0025"} 0
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.005"} 0
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.01"} 0
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.025"} 1
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.05"} 1
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.1"} 1
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.25"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="0.5"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="1.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="2.5"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="5.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="10.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="30.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="60.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="120.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="300.0"} 2
+    ala_sync_stage_seconds_bucket{stage="json_parse",le="+Inf"} 2
+    ala_sync_stage_seconds_sum{stage="json_parse"} 0.22
+    ala_sync_stage_seconds_count{stage="json_parse"} 2
+    >>> r.summary()['histograms']['stage_seconds{stage="json_parse"}']['count']
+    2
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        '''Context manager that observes how many seconds its body took'''
+        return _Timer(self, name, labels)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, _label_key(labels)), 0.0)
+
+    def drain(self):
+        '''Returns everything observed since the last drain, as a picklable
+        value for `merge`, and starts again from zero'''
+        with self._lock:
+            drained = (self._counters, self._histograms)
+            self._counters = {}
+            self._histograms = {}
+        return drained
+
+    def merge(self, drained):
+        '''Adds the metrics from another registry's `drain`'''
+        counters, histograms = drained
+        with self._lock:
+            for key, value in counters.iteritems():
+                self._counters[key] = self._counters.get(key, 0.0) + value
+            for key, other in histograms.iteritems():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.merge(other)
+
+    def summary(self):
+        '''Returns a dict of every counter, and the count, sum, mean, p50,
+        p95 and max of every histogram, for dumping as JSON'''
+        with self._lock:
+            counters = dict((_format_name(name, labels), value)
+                            for (name, labels), value
+                            in self._counters.iteritems())
+            histograms = {}
+            for (name, labels), h in self._histograms.iteritems():
+                histograms[_format_name(name, labels)] = {
+                    'count': h.count,
+                    'sum': h.sum,
+                    'mean': h.sum / h.count if h.count else None,
+                    'p50': h.quantile(0.5),
+                    'p95': h.quantile(0.95),
+                    'max': h.max,
+                }
+        return {'counters': counters, 'histograms': histograms}
+
+    def prometheus_text(self):
+        '''Returns every metric in the Prometheus text exposition format'''
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.iteritems())
+            histograms = sorted((key, h.__getstate__())
+                                for key, h in self._histograms.iteritems())
+
+        last_name = None
+        for (name, labels), value in counters:
+            if name != last_name:
+                lines.append('# TYPE {0}{1} counter'.format(PREFIX, name))
+                last_name = name
+            lines.append('{0} {1!r}'.format(
+                    _format_name(PREFIX + name, labels), value))
+
+        last_name = None
+        for (name, labels), (buckets, count, total, _) in histograms:
+            if name != last_name:
+                lines.append('# TYPE {0}{1} histogram'.format(PREFIX, name))
+                last_name = name
+            cumulative = 0
+            for idx, bucket_count in enumerate(buckets):
+                cumulative += bucket_count
+                bound = repr(BUCKETS[idx]) if idx < len(BUCKETS) else '+Inf'
+                lines.append('{0} {1}'.format(_format_name(
+                        PREFIX + name + '_bucket', labels + (('le', bound),)),
+                        cumulative))
+            lines.append('{0} {1!r}'.format(
+                    _format_name(PREFIX + name + '_sum', labels), total))
+            lines.append('{0} {1}'.format(
+                    _format_name(PREFIX + name + '_count', labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path):
+        _write_atomically(path, json.dumps(self.summary(), indent=2,
+                                           sort_keys=True) + '\n')
+
+    def write_prometheus(self, path):
+        '''The file is renamed into place, so the textfile collector never
+        reads half of it'''
+        _write_atomically(path, self.prometheus_text())
+
+
+class TextfileWriter(object):
+    '''Rewrites a Prometheus textfile with the contents of `registry` every
+    `interval` seconds, on a background thread, until `close` is called.'''
+
+    def __init__(self, registry, path, interval=TEXTFILE_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='MetricsTextfileWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        '''Stops the thread, and writes the file one last time'''
+        self._stopped.set()
+        self._thread.join()
+        self._write()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.registry.write_prometheus(self.path)
+        except Exception:
+            log.exception('Failed to write metrics to %s', self.path)
+
+
+class _Timer(object):
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.start,
+                              **self.labels)
+
+
+_registry = Registry()
+
+
+def registry():
+    '''The Registry of this process'''
+    return _registry
+
+
+def inc(name, amount=1, **labels):
+    _registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    return _registry.timer(name, **labels)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_name(name, labels):
+    '''
+    >>> _format_name('pages_total', ())
+    'pages_total'
+    >>> _format_name('stage_seconds', (('stage', 'db_flush'), ('le', '0.5')))
+    'stage_seconds{stage="db_flush",le="0.5"}'
+    '''
+    if not labels:
+        return name
+    return '{0}{{{1}}}'.format(name, ','.join(
+            '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+            for k, v in labels))
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(text)
+        os.chmod(temp_path, FILE_MODE)
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.remove(temp_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        raise
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,230 @@
+'''cProfile for scripts that fetch with lots of threads and processes.
+
+`python -m cProfile` only sees the main thread of the main process, which
+mostly waits for the fetch workers. Once `enable` is called:
+
+- every thread started afterwards is profiled, including the threads of
+  fetch workers and the db writer thread.
+- `profile_call` runs a function under the profiler and dumps its stats,
+  plus the stats of every thread of this process that has finished since
+  the last dump, to a .prof file in the profile directory. The fetch
+  workers call it for each task, and the scripts call it for everything
+  else.
+- `write_reports` merges every .prof file of the run into a report sorted
+  by time, and a file of collapsed stacks for flamegraph.pl.
+
+Daemon threads that are still running when the process exits are lost.
+
+cProfile only records which function called which, not whole stacks, so the
+collapsed stacks are rebuilt from the call graph: a function's time is
+split between its callers in proportion to the time they spent calling it.
+That is exact for functions that are only called from one place.
+'''
+
+import cProfile
+import os
+import os.path
+import pstats
+import threading
+import time
+import logging
+
+#number of functions listed in each section of the report
+REPORT_LIMIT = 60
+#call paths with less time than this (in seconds) are left out of the
+#collapsed stacks
+MIN_STACK_SECONDS = 0.0001
+#collapsed stacks are cut off at this depth, in case of deep recursion
+MAX_STACK_DEPTH = 100
+
+log = logging.getLogger(__name__)
+
+_directory = None
+_run_id = None
+_lock = threading.Lock()
+_thread_stats = None
+_thread_stats_pid = None
+_num_dumps = 0
+_original_thread_run = threading.Thread.run
+
+
+def enable(directory):
+    '''Starts profiling, writing .prof files into `directory`. Call before
+    starting any threads or processes that should be profiled.'''
+    global _directory, _run_id
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _directory = directory
+    # files from earlier runs in the same directory aren't merged
+    _run_id = '{0}-{1}'.format(time.strftime('%Y%m%d%H%M%S'), os.getpid())
+    threading.Thread.run = _profiled_thread_run
+
+
+def is_enabled():
+    return _directory is not None
+
+
+def profile_call(name, func, *args, **kwargs):
+    '''Returns func(*args, **kwargs). If profiling is enabled, the call is
+    profiled and dumped along with any finished threads, even if it
+    raises.'''
+    if _directory is None:
+        return func(*args, **kwargs)
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        _dump(name, profile)
+
+
+def write_reports(directory=None):
+    '''Merges the .prof files of this run into `report.txt` and
+    `stacks.collapsed` in `directory` (the profile directory by default).
+    Returns the paths of the two files, or None if there was nothing to
+    merge.'''
+    if directory is None:
+        directory = _directory
+    paths = sorted(os.path.join(directory, name)
+                   for name in os.listdir(directory)
+                   if name.startswith(_run_id + '-') and
+                   name.endswith('.prof'))
+    if len(paths) == 0:
+        log.warning('No profiles to merge in %s', directory)
+        return None
+
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+
+    report_path = os.path.join(directory, 'report.txt')
+    with open(report_path, 'wb') as f:
+        f.write('Merged {0} profiles from {1} processes\n\n'.format(
+                len(paths), len(set(_pid_of(p) for p in paths))))
+        stats.stream = f
+        stats.sort_stats('cumulative').print_stats(REPORT_LIMIT)
+        stats.sort_stats('time').print_stats(REPORT_LIMIT)
+        stats.print_callers(REPORT_LIMIT)
+
+    stacks_path = os.path.join(directory, 'stacks.collapsed')
+    with open(stacks_path, 'wb') as f:
+        for stack, seconds in sorted(collapsed_stacks(stats.stats)):
+            f.write('{0} {1}\n'.format(';'.join(stack),
+                                       int(round(seconds * 1e6))))
+
+    log.info('Wrote profile report to %s and collapsed stacks to %s',
+             report_path, stacks_path)
+    return report_path, stacks_path
+
+
+def collapsed_stacks(stats):
+    '''Returns a list of (stack, seconds) pairs from the `stats` dict of a
+    pstats.Stats object, where stack is a tuple of function names from the
+    outermost call in, and seconds is the time spent in the innermost
+    function itself along that path.
+
+    >>> a, b, c = ('a.py', 1, 'a'), ('b.py', 2, 'b'), ('~', 0, '<len>')
+    >>> stats = {
+    ...     a: (1, 1, 1.0, 4.0, {}),
+    ...     b: (2, 2, 2.0, 3.0, {a: (2, 2, 2.0, 3.0)}),
+    ...     c: (9, 9, 1.0, 1.0, {b: (9, 9, 1.0, 1.0)}),
+    ... }
+    >>> for stack, seconds in sorted(collapsed_stacks(stats)):
+    ...     print ';'.join(stack), seconds
+    a.py:a 1.0
+    a.py:a;b.py:b 2.0
+    a.py:a;b.py:b;<len> 1.0
+    '''
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.iteritems():
+        for caller, edge in callers.iteritems():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    roots = [func for func, row in stats.iteritems() if not row[4]]
+    result = []
+
+    def visit(func, stack, path_seconds, on_stack):
+        total_seconds = stats[func][3]
+        if total_seconds <= 0 or path_seconds < MIN_STACK_SECONDS:
+            return
+        fraction = min(1.0, path_seconds / total_seconds)
+        stack = stack + (_frame_name(func),)
+
+        self_seconds = stats[func][2] * fraction
+        if self_seconds >= MIN_STACK_SECONDS:
+            result.append((stack, self_seconds))
+
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        on_stack.add(func)
+        for callee, edge_seconds in callees.get(func, ()):
+            if callee not in on_stack:
+                visit(callee, stack, edge_seconds * fraction, on_stack)
+        on_stack.remove(func)
+
+    for root in roots:
+        visit(root, (), stats[root][3], set())
+    return result
+
+
+def _profiled_thread_run(self):
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(_original_thread_run, self)
+    finally:
+        _add_thread_profile(profile)
+
+
+def _add_thread_profile(profile):
+    global _thread_stats, _thread_stats_pid
+    profile.create_stats()
+    with _lock:
+        # stats of a parent process are copied into forked children
+        if _thread_stats is None or _thread_stats_pid != os.getpid():
+            _thread_stats = pstats.Stats(profile)
+            _thread_stats_pid = os.getpid()
+        else:
+            _thread_stats.add(profile)
+
+
+def _dump(name, profile):
+    global _thread_stats, _num_dumps
+    profile.create_stats()
+    stats = pstats.Stats(profile)
+    with _lock:
+        if _thread_stats is not None and _thread_stats_pid == os.getpid():
+            stats.add(_thread_stats)
+        _thread_stats = None
+        _num_dumps += 1
+        num_dumps = _num_dumps
+
+    path = os.path.join(_directory, '{0}-{1}-{2}-{3}.prof'.format(
+            _run_id, os.getpid(), name, num_dumps))
+    # renamed into place so write_reports never reads half a file
+    stats.dump_stats(path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+
+def _pid_of(path):
+    return os.path.basename(path)[len(_run_id) + 1:].split('-')[0]
+
+
+def _frame_name(func):
+    '''
+    >>> _frame_name(('/x/src/sync.py', 870, '_mp_fetch'))
+    'sync.py:_mp_fetch'
+    >>> _frame_name(('~', 0, "<method 'read' of 'file' objects>"))
+    "<method 'read' of 'file' objects>"
+    '''
+    filename, _, funcname = func
+    if filename == '~':
+        name = funcname
+    else:
+        name = '{0}:{1}'.format(os.path.basename(filename), funcname)
+    return name.replace(';', ',')
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
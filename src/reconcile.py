@@ -0,0 +1,180 @@
+'''Finds occurrences that have been deleted from ALA, and deletes them locally.
+
+ALA can't be asked which records have been deleted (see ala-record-info.txt),
+so the only way to find them is to download the uuid of every record of a
+species, and look for local occurrences that aren't in that list.
+
+The uuids from ALA are added to a bloom.BloomFilter as they download, then
+the local occurrences of the species are read in pages and checked against
+it. That needs about 1.2 bytes per record instead of holding every uuid in
+a set, and no query per uuid. Bloom filters have false positives, so about
+ERROR_RATE of the deleted records are missed in each run. Each filter gets a
+random salt, so a record missed in one run will most likely be found in the
+next.
+'''
+
+import db
+import ala
+import bloom
+import array
+import logging
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import func, select
+
+#fraction of deleted records missed each run, because of bloom filter false
+#positives
+ERROR_RATE = 0.01
+#number of local occurrences read from the db at a time
+LOCAL_PAGE_SIZE = 10000
+#number of occurrences deleted per DELETE statement
+DELETE_CHUNK_SIZE = 1000
+#number of species whose uuids are downloaded at the same time
+CONCURRENCY = 4
+#species with more than this fraction of their occurrences missing from ALA
+#are skipped, in case something went wrong at ALA
+MAX_DELETE_FRACTION = 0.5
+#species are skipped if ALA sends fewer than this fraction of the records it
+#says it has, because the download was probably cut short
+MIN_COMPLETENESS = 0.99
+
+log = logging.getLogger(__name__)
+
+
+class Reconciler(object):
+    '''Deletes local occurrences that no longer exist at ALA. See the module
+    docstring.
+
+    `strategy` is passed to ala.record_uuids_for_species. If `dry_run` is
+    True, deleted records are counted but not deleted.'''
+
+    def __init__(self, strategy='facet', dry_run=False,
+            max_delete_fraction=MAX_DELETE_FRACTION):
+        row = db.sources.select('id')\
+                .where(db.sources.c.name == 'ALA')\
+                .execute().fetchone()
+
+        if row is None:
+            raise RuntimeError('ALA row missing from sources table in db')
+
+        self.source_row_id = row['id']
+        self.strategy = strategy
+        self.dry_run = dry_run
+        self.max_delete_fraction = max_delete_fraction
+        self.num_checked = 0
+        self.num_deleted = 0
+        self.num_skipped_species = 0
+
+    def reconcile(self, species_ids):
+        '''Reconciles every species in `species_ids`, a dict of LSID to local
+        species_id (see sync.Syncer.species_ids_by_lsid). Returns the number
+        of occurrences deleted (or that would be deleted, for a dry run).'''
+
+        local_counts = self._local_counts()
+        tasks = [(lsid, species_id, local_counts.get(species_id, 0))
+                 for lsid, species_id in species_ids.iteritems()
+                 if local_counts.get(species_id, 0) > 0]
+
+        pool = ThreadPool(CONCURRENCY)
+        try:
+            # uuids download on the pool's threads, the db is only used here
+            for result in pool.imap_unordered(self._remote_uuids, tasks):
+                self._reconcile_species(*result)
+        finally:
+            pool.terminate()
+
+        log.info('Checked %d occurrences, %s %d, skipped %d species',
+                 self.num_checked,
+                 'found' if self.dry_run else 'deleted',
+                 self.num_deleted, self.num_skipped_species)
+        return self.num_deleted
+
+    def _remote_uuids(self, task):
+        '''Returns (species_id, local count, BloomFilter of uuids at ALA, or
+        None if they couldn't all be fetched)'''
+
+        lsid, species_id, local_count = task
+        try:
+            expected = ala.num_records_for_lsid(lsid)
+            uuids = bloom.BloomFilter(max(expected, local_count), ERROR_RATE)
+            for uuid_bytes in ala.record_uuids_for_species(lsid,
+                    self.strategy):
+                uuids.add(uuid_bytes)
+        except Exception, e:
+            log.warning('Failed to fetch uuids for %s: %s', lsid, e)
+            return species_id, local_count, None
+
+        if len(uuids) < expected * MIN_COMPLETENESS:
+            log.warning('Only got %d of %d uuids for %s', len(uuids),
+                        expected, lsid)
+            return species_id, local_count, None
+
+        return species_id, local_count, uuids
+
+    def _reconcile_species(self, species_id, local_count, uuids):
+        if uuids is None:
+            self.num_skipped_species += 1
+            return
+
+        orphan_ids = self._local_orphans(species_id, uuids)
+        self.num_checked += local_count
+        if len(orphan_ids) == 0:
+            return
+
+        if len(orphan_ids) > local_count * self.max_delete_fraction:
+            log.warning('%d of %d occurrences of species %d are missing from '
+                        'ALA, which is too many to be believable. Skipping.',
+                        len(orphan_ids), local_count, species_id)
+            self.num_skipped_species += 1
+            return
+
+        log.info('%d of %d occurrences of species %d are no longer at ALA',
+                 len(orphan_ids), local_count, species_id)
+        self.num_deleted += len(orphan_ids)
+        if not self.dry_run:
+            self._delete(orphan_ids)
+
+    def _local_counts(self):
+        '''Returns a dict of species_id to number of occurrences from ALA'''
+        occ = db.occurrences.c
+        query = select([occ.species_id, func.count()])\
+                .where(occ.source_id == self.source_row_id)\
+                .group_by(occ.species_id)
+        return dict((row[0], row[1]) for row in query.execute())
+
+    def _local_orphans(self, species_id, uuids):
+        '''Returns an array of the ids of local occurrences of the species
+        with uuids that aren't in `uuids`.
+
+        Pages through the occurrences in id order, so only LOCAL_PAGE_SIZE
+        rows are in memory at a time.'''
+
+        occ = db.occurrences.c
+        orphan_ids = array.array('I')
+        last_id = -1
+        while True:
+            query = select([occ.id, occ.source_record_id])\
+                    .where(occ.species_id == species_id)\
+                    .where(occ.source_id == self.source_row_id)\
+                    .where(occ.id > last_id)\
+                    .order_by(occ.id)\
+                    .limit(LOCAL_PAGE_SIZE)
+            rows = query.execute().fetchall()
+            for row_id, uuid_bytes in rows:
+                if uuid_bytes is not None and uuid_bytes not in uuids:
+                    orphan_ids.append(row_id)
+
+            if len(rows) < LOCAL_PAGE_SIZE:
+                return orphan_ids
+            last_id = rows[-1][0]
+
+    def _delete(self, orphan_ids):
+        '''Deletes occurrences, and their links to user ratings'''
+        for start in xrange(0, len(orphan_ids), DELETE_CHUNK_SIZE):
+            chunk = orphan_ids[start:start + DELETE_CHUNK_SIZE].tolist()
+            db.occurrences_ratings_bridge.delete()\
+                    .where(db.occurrences_ratings_bridge.c.occurrence_id
+                           .in_(chunk))\
+                    .execute()
+            db.occurrences.delete()\
+                    .where(db.occurrences.c.id.in_(chunk))\
+                    .execute()
@@ -0,0 +1,257 @@
+'''Performance statistics of occurrence syncs.
+
+Every sync saves one row in the sync_runs table, and one row per species in
+the sync_species_stats table, with the number of records, bytes, pages,
+requests and retries, request latencies, and time spent fetching and
+writing to the db. bin/ala_sync_report.py uses them to show throughput
+trends, find species that have got slower to fetch, and estimate how long a
+full load would take.
+'''
+
+import db
+import ala
+import time
+import logging
+from datetime import datetime
+from sqlalchemy import select
+
+#species are only checked for regressions if they fetched at least this
+#many records, because small fetches are dominated by request latency
+REGRESSION_MIN_RECORDS = 1000
+#a species has regressed if its fetch rate drops below this fraction of its
+#median rate in previous runs
+REGRESSION_FACTOR = 0.67
+#number of previous runs a species' fetch rate is compared against
+REGRESSION_HISTORY = 10
+#fewest previous runs needed to say whether a species has regressed
+REGRESSION_MIN_HISTORY = 3
+
+log = logging.getLogger(__name__)
+
+
+class RunStats(object):
+    '''Collects the statistics of one sync, see `save`.
+
+    `mode` is a short description of how the sync was done, e.g. 'species'
+    or 'global'.'''
+
+    def __init__(self, mode, changed_since=None, unchanged_since=None):
+        self.mode = mode
+        self.changed_since = changed_since
+        self.unchanged_since = unchanged_since
+        self.started_time = datetime.utcnow()
+        self.species = {}
+        self.requests = _empty_fetch()
+        self._start = time.time()
+
+    def add_fetch(self, species_id, fetch):
+        '''Adds the stats of fetching (part of) the records of a species.
+        `fetch` is a dict like ala.RequestStats.to_dict, plus 'records',
+        'seconds', and 'failed' items.'''
+        _add_fetch(self.species.setdefault(species_id, _empty_fetch()),
+                   fetch)
+
+    def add_records(self, species_id, num_records):
+        '''Counts records of a species that weren't fetched on their own,
+        e.g. by ala.changed_bird_record_batches'''
+        totals = self.species.setdefault(species_id, _empty_fetch())
+        totals['records'] += num_records
+
+    def add_requests(self, stats):
+        '''Adds requests that weren't for any one species. `stats` is from
+        ala.RequestStats.to_dict.'''
+        _add_fetch(self.requests, stats)
+
+    def totals(self):
+        '''Returns a dict of the totals over every species and request'''
+        totals = _empty_fetch()
+        _add_fetch(totals, self.requests)
+        for fetch in self.species.itervalues():
+            _add_fetch(totals, fetch)
+        return totals
+
+    def save(self, completed, db_flush_seconds=0.0, db_flushes=0):
+        '''Saves the stats to the db. Returns the id of the sync_runs row.'''
+
+        totals = self.totals()
+        latencies = sorted(totals['latencies'])
+        result = db.sync_runs.insert().execute(
+            started_time=self.started_time,
+            finished_time=datetime.utcnow(),
+            mode=self.mode,
+            changed_since=self.changed_since,
+            unchanged_since=self.unchanged_since,
+            completed=completed,
+            records=totals['records'],
+            bytes=totals['bytes'],
+            pages=totals['pages'],
+            requests=totals['requests'],
+            retries=totals['retries'],
+            failed_fetches=totals['failed'],
+            latency_p50=ala.percentile(latencies, 50),
+            latency_p95=ala.percentile(latencies, 95),
+            seconds=time.time() - self._start,
+            db_flush_seconds=db_flush_seconds,
+            db_flushes=db_flushes)
+        run_id = result.inserted_primary_key[0]
+
+        for species_id, fetch in self.species.iteritems():
+            latencies = sorted(fetch['latencies'])
+            db.sync_species_stats.insert().execute(
+                run_id=run_id,
+                species_id=species_id,
+                records=fetch['records'],
+                bytes=fetch['bytes'],
+                pages=fetch['pages'],
+                requests=fetch['requests'],
+                retries=fetch['retries'],
+                failed_fetches=fetch['failed'],
+                fetch_seconds=fetch['seconds'],
+                latency_p50=ala.percentile(latencies, 50),
+                latency_p95=ala.percentile(latencies, 95),
+                latency_max=latencies[-1] if latencies else None)
+
+        return run_id
+
+
+def recent_runs(limit=20):
+    '''Rows of the most recent sync_runs, newest first'''
+    return db.sync_runs.select()\
+            .order_by(db.sync_runs.c.id.desc())\
+            .limit(limit)\
+            .execute().fetchall()
+
+
+def species_regressions(run_id):
+    '''Returns a list of (species_id, scientific_name, rate, median_rate) for
+    every species that was fetched slower in the given run than usual. Rates
+    are in records per second of fetching.'''
+
+    stats = db.sync_species_stats.c
+    query = select([stats.species_id, stats.records, stats.fetch_seconds,
+                    db.species.c.scientific_name])\
+            .where(stats.run_id == run_id)\
+            .where(stats.species_id == db.species.c.id)
+    current = query.execute().fetchall()
+
+    regressions = []
+    for species_id, records, seconds, name in current:
+        rate = _rate(records, seconds)
+        if rate is None:
+            continue
+
+        history = select([stats.records, stats.fetch_seconds])\
+                .where(stats.species_id == species_id)\
+                .where(stats.run_id < run_id)\
+                .order_by(stats.run_id.desc())\
+                .limit(REGRESSION_HISTORY)\
+                .execute().fetchall()
+        median_rate = regressed_from(rate,
+                [_rate(r, s) for r, s in history])
+        if median_rate is not None:
+            regressions.append((species_id, name, rate, median_rate))
+
+    return regressions
+
+
+def species_records_per_day(history=REGRESSION_HISTORY):
+    '''Returns a dict of the most records per day of sync window that each
+    species had in the last `history` runs with a start and end date, for
+    estimating how big an incremental sync of it will be'''
+
+    runs = db.sync_runs.c
+    run_rows = select([runs.id, runs.changed_since, runs.unchanged_since])\
+            .where(runs.changed_since != None)\
+            .where(runs.unchanged_since != None)\
+            .order_by(runs.id.desc())\
+            .limit(history)\
+            .execute().fetchall()
+    days = dict((run_id, window_days(changed_since, unchanged_since))
+                for run_id, changed_since, unchanged_since in run_rows)
+    if len(days) == 0:
+        return {}
+
+    stats = db.sync_species_stats.c
+    rates = {}
+    query = select([stats.run_id, stats.species_id, stats.records])\
+            .where(stats.run_id.in_(days.keys()))
+    for run_id, species_id, records in query.execute():
+        rate = records / days[run_id]
+        rates[species_id] = max(rates.get(species_id, 0.0), rate)
+    return rates
+
+
+def window_days(changed_since, unchanged_since):
+    '''Length of a sync window in days, at least an hour so that tiny
+    windows don't give huge rates
+
+    >>> window_days(datetime(2013, 1, 1), datetime(2013, 1, 3, 12))
+    2.5
+    >>> window_days(datetime(2013, 1, 1), datetime(2013, 1, 1))
+    0.041666666666666664
+    '''
+    seconds = (unchanged_since - changed_since).total_seconds()
+    return max(seconds, 3600.0) / 86400.0
+
+
+def regressed_from(rate, past_rates):
+    '''Returns the median of `past_rates` if `rate` is a regression from it,
+    otherwise None. None values in `past_rates` are ignored.
+
+    >>> regressed_from(40.0, [100.0, 90.0, None, 110.0])
+    100.0
+    >>> regressed_from(80.0, [100.0, 90.0, 110.0]) is None
+    True
+    >>> regressed_from(1.0, [100.0]) is None
+    True
+    '''
+    past_rates = sorted(r for r in past_rates if r is not None)
+    if len(past_rates) < REGRESSION_MIN_HISTORY:
+        return None
+    median_rate = ala.percentile(past_rates, 50)
+    if rate < median_rate * REGRESSION_FACTOR:
+        return median_rate
+    return None
+
+
+def projected_hours(num_records, records_per_second):
+    '''
+    >>> projected_hours(16000000, 2000)
+    2.2222222222222223
+    '''
+    if not records_per_second:
+        return None
+    return num_records / float(records_per_second) / 3600.0
+
+
+def _rate(records, seconds):
+    if records < REGRESSION_MIN_RECORDS or not seconds:
+        return None
+    return records / float(seconds)
+
+
+def _empty_fetch():
+    return {
+        'records': 0,
+        'bytes': 0,
+        'pages': 0,
+        'requests': 0,
+        'retries': 0,
+        'seconds': 0.0,
+        'failed': 0,
+        'latencies': [],
+    }
+
+
+def _add_fetch(totals, fetch):
+    for key in ('records', 'bytes', 'pages', 'requests', 'retries',
+                'seconds'):
+        totals[key] += fetch.get(key, 0)
+    totals['failed'] += int(fetch.get('failed', 0))
+    totals['latencies'].extend(fetch.get('latencies', ()))
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,240 @@
+'''Columnar snapshots of the occurrence records of a species, which load
+without any parsing.
+
+A snapshot file holds each species' records as fixed-width little-endian
+columns, each starting at a multiple of ALIGNMENT bytes:
+
+- a HEADER_SIZE byte header: MAGIC, VERSION, the size of the floats (4 or
+  8), the number of records, and the offsets of the four columns
+- latitudes, as float32 or float64
+- longitudes, the same
+- uuids, 16 bytes each, all zeros for records without one
+- counts, as uint32 (see ala.OccurrenceRecord.count)
+
+`SnapshotWriter` writes them with export.BatchExport or
+export.DatabaseExport, so a directory of snapshots has the same
+manifest.json as a directory of CSV files, which serves as the index of the
+species in it. `Snapshot` reads one. With numpy, the columns are numpy
+arrays backed by a memory map of the file, so nothing is copied or parsed
+until it's used.
+'''
+
+import export
+import array
+import json
+import mmap
+import os.path
+import shutil
+import struct
+import sys
+import tempfile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'OCCSNAP\0'
+VERSION = 1
+#columns start at a multiple of this many bytes
+ALIGNMENT = 64
+HEADER_SIZE = 64
+#the float types that latitudes and longitudes can be stored as
+FLOAT_SIZES = {'float32': 4, 'float64': 8}
+
+#magic, version, float size, number of records, then the offsets of the
+#latitude, longitude, uuid and count columns
+_HEADER = struct.Struct('<8sIIQ4Q')
+_FLOAT_TYPECODES = {4: 'f', 8: 'd'}
+_UUID_SIZE = 16
+_NIL_UUID_BYTES = '\0' * _UUID_SIZE
+
+
+class SnapshotWriter(object):
+    '''Writes snapshot files for an export.BatchExport, with latitudes and
+    longitudes stored as `float_type` (see FLOAT_SIZES). The file has to be
+    seekable, so it can't be compressed.'''
+
+    extension = '.snap'
+
+    def __init__(self, float_type='float32'):
+        if float_type not in FLOAT_SIZES:
+            raise ValueError('Invalid float type: ' + float_type)
+        self.float_type = float_type
+
+    def settings(self):
+        '''What the contents of a file depend on'''
+        return {
+            'format': 'snapshot',
+            'float_type': self.float_type,
+        }
+
+    def write(self, f, spp_code, batches):
+        '''Writes the records in `batches` to `f`, and returns the number of
+        records they stand for. The latitudes go straight into `f`, and the
+        other columns into temporary files until the number of records is
+        known.'''
+        float_size = FLOAT_SIZES[self.float_type]
+        num_rows = 0
+        num_records = 0
+        start = f.tell()
+        f.write('\0' * HEADER_SIZE)
+        columns = [tempfile.TemporaryFile() for _ in xrange(3)]
+        try:
+            longitudes, uuids, counts = columns
+            for batch in batches:
+                f.write(_column_bytes(batch.latitudes, float_size))
+                longitudes.write(_column_bytes(batch.longitudes, float_size))
+                uuids.write(str(batch.uuids))
+                counts.write(_column_bytes(batch.counts))
+                num_rows += len(batch)
+                num_records += batch.total_count()
+
+            offsets = [HEADER_SIZE]
+            for column in columns:
+                f.write('\0' * _padding(f.tell() - start))
+                offsets.append(f.tell() - start)
+                column.seek(0)
+                shutil.copyfileobj(column, f)
+        finally:
+            for column in columns:
+                column.close()
+
+        end = f.tell()
+        f.seek(start)
+        f.write(_HEADER.pack(MAGIC, VERSION, float_size, num_rows, *offsets))
+        f.seek(end)
+        return num_records
+
+
+class Snapshot(object):
+    '''The columns of a snapshot file: `latitudes`, `longitudes`, `counts`
+    and `uuids`.
+
+    With numpy (unless `use_numpy` is False) the columns are read-only numpy
+    arrays over a memory map of the file, and `uuids` has a row of 16 bytes
+    per record. Without it, the columns are copied into array.array objects,
+    and `uuids` is a str of all the uuids.
+
+    >>> path = _write_example()
+    >>> s = Snapshot(path, use_numpy=False)
+    >>> len(s), s.float_size, list(s.latitudes), list(s.counts)
+    (2, 8, [-27.5, -33.25], [1L, 3L])
+    >>> s.uuid_bytes(0) == '1234567890abcdef', s.uuid_bytes(1)
+    (True, None)
+    >>> os.remove(path)
+    '''
+
+    def __init__(self, path, use_numpy=None):
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE or \
+                    header[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not a snapshot file: ' + path)
+            (_, version, self.float_size, self.num_records, lat_offset,
+             lng_offset, uuid_offset, count_offset) = _HEADER.unpack(
+                    header[:_HEADER.size])
+            if version > VERSION:
+                raise ValueError('Snapshot file {0} is version {1}, newer '
+                                 'than this code'.format(path, version))
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        n = self.num_records
+        if use_numpy:
+            float_dtype = '<f{0}'.format(self.float_size)
+            self.latitudes = self._numpy_column(lat_offset, float_dtype, n)
+            self.longitudes = self._numpy_column(lng_offset, float_dtype, n)
+            self.uuids = self._numpy_column(uuid_offset, 'u1',
+                    n * _UUID_SIZE).reshape((n, _UUID_SIZE))
+            self.counts = self._numpy_column(count_offset, '<u4', n)
+        else:
+            typecode = _FLOAT_TYPECODES[self.float_size]
+            self.latitudes = self._array_column(lat_offset, typecode, n)
+            self.longitudes = self._array_column(lng_offset, typecode, n)
+            self.uuids = self._map[uuid_offset:uuid_offset + n * _UUID_SIZE]
+            self.counts = self._array_column(count_offset, 'I', n)
+
+    def __len__(self):
+        return self.num_records
+
+    def uuid_bytes(self, idx):
+        '''The packed uuid of a record, or None if it doesn't have one'''
+        if isinstance(self.uuids, str):
+            b = self.uuids[idx * _UUID_SIZE:(idx + 1) * _UUID_SIZE]
+        else:
+            b = self.uuids[idx].tostring()
+        return None if b == _NIL_UUID_BYTES else b
+
+    def total_count(self):
+        '''Number of records this snapshot stands for, counting weights'''
+        return int(sum(self.counts))
+
+    def _numpy_column(self, offset, dtype, count):
+        if count == 0:
+            return numpy.zeros(0, dtype)
+        return numpy.frombuffer(self._map, dtype, count, offset)
+
+    def _array_column(self, offset, typecode, count):
+        column = array.array(typecode)
+        column.fromstring(self._map[offset:offset + count * column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+
+def load_species(directory, name, use_numpy=None):
+    '''Returns the Snapshot of a species in a directory of snapshots, found
+    by its scientific name, LSID or SPPCODE in the manifest'''
+    with open(os.path.join(directory, export.MANIFEST_NAME), 'rb') as f:
+        manifest = json.load(f)
+    for key, entry in sorted(manifest['species'].iteritems()):
+        if entry.get('format') != 'snapshot':
+            continue
+        if name in (key, entry['scientific_name'], entry['lsid'],
+                    entry['spp_code']):
+            return Snapshot(os.path.join(directory, entry['file']),
+                            use_numpy)
+    raise KeyError('No snapshot of {0} in {1}'.format(name, directory))
+
+
+def _column_bytes(values, float_size=None):
+    '''Packs an array.array as a little-endian column, converting it to
+    floats of `float_size` bytes if given
+
+    >>> _column_bytes(array.array('d', [1.5]), 4) == struct.pack('<f', 1.5)
+    True
+    '''
+    if float_size is not None and values.itemsize != float_size:
+        values = array.array(_FLOAT_TYPECODES[float_size], values)
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _padding(offset):
+    '''
+    >>> _padding(0), _padding(1), _padding(64), _padding(100)
+    (0, 63, 0, 28)
+    '''
+    return -offset % ALIGNMENT
+
+
+def _write_example():
+    import ala
+    batch = ala.RecordBatch(1)
+    batch.append(-27.5, 153.0, '1234567890abcdef')
+    batch.append(-33.25, 151.0, count=3)
+    fd, path = tempfile.mkstemp(suffix=SnapshotWriter.extension)
+    with os.fdopen(fd, 'wb') as f:
+        SnapshotWriter('float64').write(f, 'GYMNTIBI', [batch])
+    return path
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
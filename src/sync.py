@@ -1,19 +1,68 @@
 import db
 import ala
+import runstats
+import metrics
+import profiling
 import logging
 import multiprocessing
 import binascii
+import time
+import tempfile
+import sys
+import threading
+import Queue
+import heapq
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
 from sqlalchemy import func, select
 
+#max records per message sent from a fetch worker to the parent process
+IPC_BATCH_SIZE = 5000
+#max seconds fetched records wait in a worker before being sent anyway
+IPC_FLUSH_INTERVAL = 1.0
+#seconds between fetch workers sending their metrics to the main process
+METRICS_SEND_INTERVAL = 10.0
+
+#default number of upserts cached before flushing, for each write mode
+FLUSH_THRESHOLDS = {
+    'insert': 1000,
+    'load': 100000,
+}
+
+#cached species LSIDs older than this are looked up again by name
+LSID_TTL = timedelta(days=7)
+#records fetched between saves of sync ledger progress
+LEDGER_CHECKPOINT_INTERVAL = 50000
+#species with more records than this are fetched as several date windows
+SHARD_MAX_RECORDS = 200000
+#number of processes fetching records at the same time
+FETCH_WORKERS = 8
+#number of species counted at the same time while splitting them up
+SHARD_CONCURRENCY = 8
+#pages fetched at the same time by the all-birds query of changed records
+GLOBAL_PAGE_CONCURRENCY = 4
+
+#hex of the uuid that ala.RecordBatch stores for records without one
+_NIL_UUID_HEX = '0' * 32
+
 log = logging.getLogger(__name__)
 
 
 class Syncer:
 
-    def __init__(self):
-        '''TODO: might pass db into here for unit testing purposes instead of
+    def __init__(self, write_mode='insert', flush_threshold=None):
+        '''`write_mode` is how cached upserts are written to the db when they
+        are flushed. 'insert' uses one big INSERT ... ON DUPLICATE KEY UPDATE
+        statement. 'load' bulk loads through a staging table, which is faster
+        for big updates. `flush_threshold` is how many upserts are cached
+        before they are flushed, and defaults to FLUSH_THRESHOLDS[write_mode].
+
+        TODO: might pass db into here for unit testing purposes instead of
         using the module directly. Might also do the same for ala module.'''
 
+        if write_mode not in FLUSH_THRESHOLDS:
+            raise ValueError('Invalid write mode: ' + write_mode)
+
         row = db.sources.select('id')\
                 .where(db.sources.c.name == 'ALA')\
                 .execute().fetchone()
@@ -22,7 +71,14 @@ class Syncer:
             raise RuntimeError('ALA row missing from sources table in db')
 
         self.source_row_id = row['id']
+        self.write_mode = write_mode
+        self.flush_threshold = flush_threshold or FLUSH_THRESHOLDS[write_mode]
         self.cached_upserts = []
+        self.flush_seconds = 0.0
+        self.num_flushes = 0
+        self.run_stats = None
+        self._load_connection = None
+        self._remote_species = None
 
     def local_species(self):
         '''Returns all species in the local db in a dict. Scientific name is the
@@ -35,12 +91,16 @@ class Syncer:
 
     def remote_species(self):
         '''Returns all species available at ALA in a dict. Scientific name is the
-        key, the ala.Species object is the value.'''
+        key, the ala.Species object is the value.
 
-        species = {}
-        for bird in ala.all_bird_species():
-            species[bird.scientific_name] = bird
-        return species
+        Only fetched from ALA once per Syncer.'''
+
+        if self._remote_species is None:
+            species = {}
+            for bird in ala.all_bird_species():
+                species[bird.scientific_name] = bird
+            self._remote_species = species
+        return self._remote_species
 
     def added_and_deleted_species(self):
         '''Returns (added, deleted) where `added` is an iterable of ala.Species
@@ -68,13 +128,60 @@ class Syncer:
         log.info('Adding new species "%s"', species.scientific_name)
         db.species.insert().execute(
             scientific_name=species.scientific_name,
-            common_name=species.common_name)
+            common_name=species.common_name,
+            lsid=species.lsid,
+            lsid_verified_time=datetime.utcnow())
+
+    def refresh_species_lsids(self):
+        '''Stores the current LSID of every local species that is also at ALA
+        (see `remote_species`), so the fetch workers don't have to look them
+        up by name.'''
+
+        remote = self.remote_species()
+        now = datetime.utcnow()
+        for row in db.species.select().execute():
+            species = remote.get(row['scientific_name'])
+            if species is not None:
+                self.set_species_lsid(row['id'], species.lsid, now)
+
+    def species_ids_by_lsid(self):
+        '''Returns a dict of LSID to species_id, for every local species.
+        LSIDs older than LSID_TTL are refreshed first.'''
+
+        now = datetime.utcnow()
+        for row in db.species.select().execute():
+            if row['lsid'] is None or row['lsid_verified_time'] is None or \
+                    now - row['lsid_verified_time'] >= LSID_TTL:
+                self.refresh_species_lsids()
+                break
+
+        species_ids = {}
+        for row in db.species.select().execute():
+            if row['lsid'] is not None:
+                species_ids[row['lsid']] = row['id']
+            else:
+                log.warning('No LSID for "%s", so its changed records will '
+                            'be skipped', row['scientific_name'])
+        return species_ids
+
+    def set_species_lsid(self, species_id, lsid, verified_time=None):
+        '''Stores `lsid` as the cached LSID of a species in the local db'''
+
+        if verified_time is None:
+            verified_time = datetime.utcnow()
+        db.species.update()\
+                .where(db.species.c.id == species_id)\
+                .values(lsid=lsid, lsid_verified_time=verified_time)\
+                .execute()
 
     def delete_species(self, row):
         '''Deletes `row` from the local db, where `s` is a row from the
         db.species table'''
 
         log.info('Deleting species "%s"', row['scientific_name'])
+        db.sync_ledger.delete()\
+                .where(db.sync_ledger.c.species_id == row['id'])\
+                .execute()
         db.species.delete().where(db.species.c.id == row['id']).execute()
 
     def upsert_occurrence(self, occurrence, species_id):
@@ -87,24 +194,103 @@ class Syncer:
         obtainable from `occurrence`
 
         The inserts/updates are cached for performance reasons. The cache is
-        flushed every 1000 occurrences. YOU MUST CALL `flush_upserts` AFTER YOU
-        HAVE CALLED THIS METHOD FOR THE FINAL TIME.'''
+        flushed every `flush_threshold` occurrences. YOU MUST CALL
+        `flush_upserts` AFTER YOU HAVE CALLED THIS METHOD FOR THE FINAL
+        TIME.'''
 
-        if len(self.cached_upserts) > 1000:
+        if len(self.cached_upserts) >= self.flush_threshold:
             self.flush_upserts()
 
-        # these should be escaped strings ready for insertion into the SQL
-        cols = (str(float(occurrence.latitude)),
-                str(float(occurrence.longitude)),
-                '"assumed valid"',  # TODO: determine rating
-                str(int(species_id)),
-                str(int(self.source_row_id)),
-                _mysql_encode_binary(occurrence.uuid.bytes))
+        self.cached_upserts.append((
+                float(occurrence.latitude),
+                float(occurrence.longitude),
+                int(species_id),
+                None if occurrence.uuid is None
+                    else binascii.hexlify(occurrence.uuid.bytes)))
 
-        self.cached_upserts.append('(' + ','.join(cols) + ')')
+    def upsert_batch(self, batch):
+        '''Same as `upsert_occurrence`, but for every record in `batch` (an
+        ala.RecordBatch). The batch's `species_id` must be set.
+
+        YOU MUST CALL `flush_upserts` AFTER YOU HAVE CALLED THIS METHOD FOR THE
+        FINAL TIME.'''
+
+        if batch.species_id is None:
+            raise ValueError('RecordBatch has no species_id')
+
+        species_id = int(batch.species_id)
+        uuids_hex = binascii.hexlify(batch.uuids)
+
+        for idx in xrange(len(batch)):
+            if len(self.cached_upserts) >= self.flush_threshold:
+                self.flush_upserts()
+
+            # records without a uuid get a NULL source_record_id, so they
+            # don't collide on UNIQUE(source_id, source_record_id)
+            uuid_hex = uuids_hex[idx * 32:(idx + 1) * 32]
+            self.cached_upserts.append((
+                    batch.latitudes[idx],
+                    batch.longitudes[idx],
+                    species_id,
+                    None if uuid_hex == _NIL_UUID_HEX else uuid_hex))
 
     def flush_upserts(self):
-        query = '''INSERT INTO occurrences(
+        '''Writes the cached upserts to the db'''
+
+        if len(self.cached_upserts) > 0:
+            t = time.time()
+            if self.write_mode == 'load':
+                self._flush_upserts_by_load()
+            else:
+                self._flush_upserts_by_insert()
+            seconds = time.time() - t
+            self.flush_seconds += seconds
+            self.num_flushes += 1
+            metrics.observe('stage_seconds', seconds, stage='db_flush')
+            metrics.inc('records_written_total', len(self.cached_upserts))
+
+        self.cached_upserts = []
+
+    def start_run(self, mode, changed_since=None, unchanged_since=None):
+        '''Starts collecting performance stats of a sync, which are saved by
+        `finish_run`. See runstats.RunStats.'''
+        self.run_stats = runstats.RunStats(mode, changed_since,
+                unchanged_since)
+        self.flush_seconds = 0.0
+        self.num_flushes = 0
+        ala.reset_request_stats()
+
+    def finish_run(self, completed):
+        '''Saves the stats of the sync started by `start_run`. Call after
+        everything has been flushed.'''
+        stats = self.run_stats
+        self.run_stats = None
+        stats.add_requests(ala.request_stats().to_dict())
+        totals = stats.totals()
+        log.info('Synced %d records (%0.1fMB) in %d requests, %d retries. '
+                 '%0.2fs writing to the db',
+                 totals['records'], totals['bytes'] / 1048576.0,
+                 totals['requests'], totals['retries'], self.flush_seconds)
+        return stats.save(completed, self.flush_seconds, self.num_flushes)
+
+    def close(self):
+        '''Flushes the cached upserts, and releases the db connection used
+        by the 'load' write mode'''
+        self.flush_upserts()
+        if self._load_connection is not None:
+            self._load_connection.close()
+            self._load_connection = None
+
+    def _flush_upserts_by_insert(self):
+        # TODO: determine rating
+        row_format = "({0!r},{1!r},\"assumed valid\",{2},{3},{4})"
+        source_id = int(self.source_row_id)
+        values = ','.join([row_format.format(lat, lng, species_id, source_id,
+                                             _mysql_hex_literal(uuid_hex))
+                           for lat, lng, species_id, uuid_hex
+                           in self.cached_upserts])
+
+        db.engine.execute('''INSERT INTO occurrences(
                         latitude, longitude, rating, species_id, source_id,
                         source_record_id)
 
@@ -116,88 +302,813 @@ class Syncer:
                         longitude=VALUES(longitude),
                         rating=VALUES(rating),
                         species_id=VALUES(species_id)
-                '''.format(','.join(self.cached_upserts))
+                '''.format(values))
 
-        db.engine.execute(query)
+    def _flush_upserts_by_load(self):
+        '''Writes the cached upserts into a TSV file, bulk loads it into a
+        temporary staging table with LOAD DATA LOCAL INFILE, then merges the
+        staging table into the occurrences table with one statement.
 
-        self.cached_upserts = []
+        The db connection needs local_infile enabled (add "local_infile=1" to
+        the query string of the db url).'''
+
+        conn = self._load_connection
+        if conn is None:
+            conn = self._load_connection = db.engine.connect()
+            conn.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS
+                            occurrences_staging LIKE occurrences''')
+
+        with tempfile.NamedTemporaryFile(suffix='.tsv') as tsv:
+            for lat, lng, species_id, uuid_hex in self.cached_upserts:
+                tsv.write('{0!r}\t{1!r}\t{2}\t{3}\n'.format(
+                        lat, lng, species_id,
+                        '\\N' if uuid_hex is None else uuid_hex))
+            tsv.flush()
+
+            # REPLACE so that the last of any duplicate uuids wins
+            conn.execute('''LOAD DATA LOCAL INFILE %s
+                            REPLACE INTO TABLE occurrences_staging
+                            (latitude, longitude, species_id, @uuid_hex)
+                            SET rating = "assumed valid",
+                                source_id = %s,
+                                source_record_id = UNHEX(@uuid_hex)''',
+                         tsv.name, int(self.source_row_id))
+
+        conn.execute('''INSERT INTO occurrences(
+                            latitude, longitude, rating, species_id,
+                            source_id, source_record_id)
+
+                        SELECT
+                            latitude, longitude, rating, species_id,
+                            source_id, source_record_id
+                        FROM occurrences_staging
 
+                        ON DUPLICATE KEY UPDATE
+                            latitude=VALUES(latitude),
+                            longitude=VALUES(longitude),
+                            rating=VALUES(rating),
+                            species_id=VALUES(species_id)''')
+        conn.execute('TRUNCATE TABLE occurrences_staging')
+
+
+    def write(self, item):
+        '''Writes an item generated by `ledger_updates` to the db: either
+        an ala.RecordBatch to upsert, or a LedgerCheckpoint to save once the
+        upserts before it have been flushed.'''
+
+        if isinstance(item, LedgerCheckpoint):
+            self.flush_upserts()
+            self.save_checkpoint(item)
+        else:
+            self.upsert_batch(item)
+
+    def start_ledger(self, changed_since, unchanged_since):
+        '''Prepares the sync ledger, which tracks how far the occurrences of
+        each species have been synced, so an interrupted sync can be resumed.
+
+        If the ledger is empty, a row is added for every species with the
+        given date window. Rows for species with lots of records are split
+        into more rows later, see `_shard_tasks`. If the ledger already has
+        rows, then a sync was interrupted and it will be resumed with its
+        original window instead. Any species without a row (e.g. newly added
+        species) get one.
+
+        Returns (changed_since, unchanged_since) of the sync.'''
+
+        window = self._ledger_window()
+        if window is not None:
+            changed_since, unchanged_since = window
+            log.info('Resuming interrupted sync of changes between %s and %s',
+                     changed_since, unchanged_since)
+
+        in_ledger = frozenset(row['species_id'] for row in
+                select([db.sync_ledger.c.species_id]).execute())
+        for row in db.species.select().execute():
+            if row['id'] not in in_ledger:
+                db.sync_ledger.insert().execute(
+                    species_id=row['id'],
+                    changed_since=changed_since,
+                    unchanged_since=unchanged_since,
+                    next_offset=0,
+                    status='pending',
+                    attempts=0)
+
+        return changed_since, unchanged_since
+
+    def _ledger_window(self):
+        '''Returns the (changed_since, unchanged_since) window of the sync in
+        the ledger, or None if the ledger is empty. Sharded rows only cover
+        part of the window (see `_save_shards`), so the window is the union of
+        every row's window. A changed_since of None means the beginning of
+        time.'''
+        ledger = db.sync_ledger.c
+        row = select([func.count(),
+                      func.count(ledger.changed_since),
+                      func.min(ledger.changed_since),
+                      func.max(ledger.unchanged_since)])\
+                .execute().fetchone()
+        num_rows, num_with_start, changed_since, unchanged_since = row
+        if num_rows == 0:
+            return None
+        if num_with_start < num_rows:
+            changed_since = None
+        return changed_since, unchanged_since
+
+    def ledger_is_empty(self):
+        '''True if there is no interrupted sync to resume'''
+        return db.sync_ledger.select().execute().fetchone() is None
+
+    def ledger_is_complete(self):
+        '''True if every species in the ledger has been synced'''
+        row = select([func.count()])\
+                .where(db.sync_ledger.c.status != 'done')\
+                .execute().fetchone()
+        return row[0] == 0
+
+    def clear_ledger(self):
+        '''Call after a completed sync, so the next one starts fresh'''
+        db.sync_ledger.delete().execute()
+
+    def save_checkpoint(self, checkpoint):
+        '''Records a LedgerCheckpoint in the ledger. The records before the
+        checkpoint must already be in the db.'''
+
+        values = {
+            'next_offset': checkpoint.next_offset,
+            'status': checkpoint.status,
+        }
+        if checkpoint.status == 'failed':
+            values['attempts'] = db.sync_ledger.c.attempts + 1
+            values['last_error'] = checkpoint.error
+
+        db.sync_ledger.update()\
+                .where(db.sync_ledger.c.id == checkpoint.ledger_id)\
+                .values(**values)\
+                .execute()
+
+    def ledger_updates(self, max_passes=2):
+        '''Generator for ala.RecordBatch and LedgerCheckpoint objects, for
+        every unfinished species in the sync ledger (see `start_ledger`).
+        Pass everything it generates to `write`, in order.
+
+        Species are fetched from where the last sync of them got up to.
+        Species that fail are tried again from where they failed, up to
+        `max_passes` times. Species that still fail stay unfinished in the
+        ledger, to be tried again next time.'''
+
+        tasks = []
+        query = select([db.sync_ledger, db.species])\
+                .where(db.sync_ledger.c.species_id == db.species.c.id)\
+                .where(db.sync_ledger.c.status != 'done')\
+                .apply_labels()
+        for row in query.execute():
+            tasks.append(FetchTask(
+                species_id=row['species_id'],
+                scientific_name=row['species_scientific_name'],
+                lsid=row['species_lsid'],
+                lsid_verified_time=row['species_lsid_verified_time'],
+                changed_since=row['sync_ledger_changed_since'],
+                unchanged_since=row['sync_ledger_unchanged_since'],
+                start_offset=row['sync_ledger_next_offset'],
+                ledger_id=row['sync_ledger_id']))
+
+        tasks = self._shard_tasks(tasks)
+
+        for pass_num in range(max_passes):
+            if len(tasks) == 0:
+                break
+            if pass_num > 0:
+                log.info('Retrying %d failed fetches', len(tasks))
+
+            failed = []
+            for event in self._fetch_tasks(tasks):
+                if event[0] == 'batch':
+                    yield event[1]
+                    continue
+
+                kind, task, offset, error = event
+                if kind == 'progress':
+                    yield LedgerCheckpoint(task.ledger_id, offset, 'pending')
+                elif error is None:
+                    yield LedgerCheckpoint(task.ledger_id, offset, 'done')
+                else:
+                    task.start_offset = offset
+                    failed.append(task)
+                    yield LedgerCheckpoint(task.ledger_id, offset, 'failed',
+                                           error)
+            tasks = failed
+
+        if len(tasks) > 0:
+            log.warning('%d fetches failed, so some species are only '
+                        'partly synced', len(tasks))
 
     def occurrences_changed_since(self, since_date):
-        '''Generator for ala.OccurrenceRecord objects.
+        '''Generator for ala.RecordView objects, which act like
+        ala.OccurrenceRecord objects with a `species_id` attribute.
+
+        Prefer `occurrence_batches_changed_since`, which is faster.'''
+
+        for batch in self.occurrence_batches_changed_since(since_date):
+            for record in batch:
+                yield record
+
+    def global_occurrence_batches_changed_since(self, since_date,
+            unchanged_since=None):
+        '''Generator for ala.RecordBatch objects, with `species_id` set, for
+        every record of a local species that changed between `since_date` and
+        `unchanged_since`.
+
+        Unlike `occurrence_batches_changed_since`, this asks ALA for the
+        changed records of all birds in one query, instead of one query per
+        species. That is much cheaper when only a few species have changed
+        (e.g. a nightly update), but much slower than fetching species in
+        parallel when lots of records have changed (e.g. the first sync).'''
+
+        species_ids = self.species_ids_by_lsid()
+        batches = ala.changed_bird_record_batches(species_ids, since_date,
+                unchanged_since, concurrency=GLOBAL_PAGE_CONCURRENCY)
+        for batch in batches:
+            metrics.inc('records_fetched_total', len(batch))
+            if self.run_stats is not None:
+                self.run_stats.add_records(batch.species_id, len(batch))
+            yield batch
+
+    def occurrence_batches_changed_since(self, since_date):
+        '''Generator for ala.RecordBatch objects, with `species_id` set.
 
         Will use whatever is in the species table of the database, so call
         update the species table before calling this function.
 
+        Doesn't use the sync ledger, so nothing is resumable. See
+        `ledger_updates`.'''
+
+        tasks = [FetchTask(row['id'], row['scientific_name'], row['lsid'],
+                           row['lsid_verified_time'], since_date)
+                 for row in db.species.select().execute()]
+        tasks = self._shard_tasks(tasks)
+
+        for event in self._fetch_tasks(tasks):
+            if event[0] == 'batch':
+                yield event[1]
+
+    def _shard_tasks(self, tasks, max_records=None):
+        '''Splits tasks for species with more than `max_records` records
+        (default SHARD_MAX_RECORDS) into tasks for smaller date windows, which
+        the pool can fetch in parallel. Without this, one huge species keeps
+        a single worker busy long after the others have finished, fetching
+        pages with slow, deep startIndex offsets.
+
+        Splitting costs at least one count request per task, so only tasks
+        that might be big are counted: tasks without a start date (i.e. a
+        first or full sync), and tasks whose species has fetched enough
+        records per day in past syncs (see runstats.species_records_per_day)
+        to go over `max_records` in the task's window. Only tasks that
+        haven't been started and have a cached LSID are split. Tasks in the
+        sync ledger have their new windows saved in the ledger, so a resumed
+        sync carries on with the same windows.
+
+        Also sets the `expected_records` of tasks, from the count or the
+        estimate, for `schedule_tasks`.
+
+        Returns the new list of tasks.'''
+
+        if max_records is None:
+            max_records = SHARD_MAX_RECORDS
+
+        rates = {}
+        if any(task.changed_since is not None for task in tasks):
+            rates = runstats.species_records_per_day()
+        now = datetime.utcnow()
+        to_count = []
+        for task in tasks:
+            if task.changed_since is not None:
+                rate = rates.get(task.species_id)
+                if rate is None:
+                    continue
+                task.expected_records = int(rate * runstats.window_days(
+                        task.changed_since, task.unchanged_since or now))
+                if task.expected_records <= max_records:
+                    continue
+            if task.lsid is not None:
+                to_count.append(task)
+
+        def windows_for_task(task):
+            try:
+                if task.start_offset != 0:
+                    # already started, so just count what's left
+                    total = ala.num_records_for_lsid(task.lsid,
+                            task.changed_since, task.unchanged_since)
+                    return [(task.changed_since, task.unchanged_since,
+                             max(0, total - task.start_offset))]
+                return ala.date_shards_for_lsid(task.lsid, task.changed_since,
+                        task.unchanged_since, max_records)
+            except Exception, e:
+                log.warning('Failed to count records for "%s", fetching it '
+                            'as one query: %s', task.scientific_name, e)
+                return None
+
+        log.info('Counting the records of %d of %d species, to split up the '
+                 'big ones', len(to_count), len(tasks))
+        pool = ThreadPool(SHARD_CONCURRENCY)
+        try:
+            counted = dict(zip(map(id, to_count),
+                               pool.map(windows_for_task, to_count)))
+        finally:
+            pool.terminate()
+        all_windows = [counted.get(id(task)) for task in tasks]
+
+        sharded = []
+        for task, windows in zip(tasks, all_windows):
+            if windows is None:
+                sharded.append(task)
+                continue
+            if len(windows) == 1:
+                task.expected_records = windows[0][2]
+                sharded.append(task)
+                continue
+
+            log.info('Splitting "%s" into %d date windows',
+                     task.scientific_name, len(windows))
+            shards = [FetchTask(task.species_id, task.scientific_name,
+                                task.lsid, task.lsid_verified_time,
+                                changed_since, unchanged_since,
+                                expected_records=num_records)
+                      for changed_since, unchanged_since, num_records
+                      in windows]
+            if task.ledger_id is not None:
+                self._save_shards(task, shards)
+            sharded.extend(shards)
+
+        return sharded
+
+    def _save_shards(self, task, shards):
+        '''Saves the windows of `shards`, oldest first, which were split off
+        the ledger row of `task`, and sets their `ledger_id`. The first shard
+        reuses the row, the rest get new rows.
+
+        It's all one transaction, and the original row is narrowed last, so
+        even if the table engine ignores transactions, a crash part way
+        through can only make some records get fetched twice, and never
+        leaves part of the window out of the ledger.'''
+
+        conn = db.engine.connect()
+        trans = conn.begin()
+        try:
+            for shard in shards[1:]:
+                result = conn.execute(db.sync_ledger.insert(),
+                        species_id=shard.species_id,
+                        changed_since=shard.changed_since,
+                        unchanged_since=shard.unchanged_since,
+                        next_offset=0,
+                        status='pending',
+                        attempts=0)
+                shard.ledger_id = result.inserted_primary_key[0]
+
+            conn.execute(db.sync_ledger.update()
+                    .where(db.sync_ledger.c.id == task.ledger_id)
+                    .values(unchanged_since=shards[0].unchanged_since))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+        shards[0].ledger_id = task.ledger_id
+
+    def _fetch_tasks(self, tasks, ipc_batch_size=None,
+            ipc_flush_interval=None):
+        '''Generator for the events of fetching every FetchTask in `tasks`:
+
+            ('batch', ala.RecordBatch)
+            ('progress', task, next_offset, None)
+            ('finished', task, next_offset, error_message_or_None)
+
+        A 'progress' event comes after the batches it covers.
+
         Uses a pool of processes to fetch occurrence records. The subprocesses
-        feed the records into a queue which the original process reads and
-        yields. This should let the main process access the database at full
-        speed while the subprocesses are waiting for more records to arrive
-        over the network.'''
+        feed batches of records into a queue which the original process reads
+        and yields. This should let the main process access the database at
+        full speed while the subprocesses are waiting for more records to
+        arrive over the network.
 
-        record_q = multiprocessing.Queue(10000)
-        pool = multiprocessing.Pool(8, _mp_init, [record_q])
+        Records are sent through the queue in packed batches of up to
+        `ipc_batch_size` records (default IPC_BATCH_SIZE). A worker sends what
+        it has after `ipc_flush_interval` seconds (default
+        IPC_FLUSH_INTERVAL) even if the batch isn't full.'''
+
+        if ipc_batch_size is None:
+            ipc_batch_size = IPC_BATCH_SIZE
+        if ipc_flush_interval is None:
+            ipc_flush_interval = IPC_FLUSH_INTERVAL
+
+        # each message is up to ipc_batch_size records
+        record_q = multiprocessing.Queue(max(2, 10000 // ipc_batch_size))
+        # all the workers share one set of request limits
+        gov = ala.request_governor()
+        pool = multiprocessing.Pool(FETCH_WORKERS, _mp_init,
+                [record_q, ipc_batch_size, ipc_flush_interval, gov])
         active_workers = 0
 
-        # fill the pool full with every species
-        for row in db.species.select().execute():
-            args = (row['scientific_name'], row['id'], since_date)
-            pool.apply_async(_mp_fetch, args)
+        # fill the pool full with every task. The workers take the next one
+        # whenever they finish one, so the biggest go first (see
+        # schedule_tasks).
+        tasks = schedule_tasks(tasks, FETCH_WORKERS)
+        for task_idx, task in enumerate(tasks):
+            pool.apply_async(_mp_fetch, (task_idx, task))
             active_workers += 1
 
         pool.close()
 
         # keep reading from the queue until all the subprocesses are finished
-        while active_workers > 0:
-            record = record_q.get()
-            if record is None:
-                active_workers -= 1
-            else:
-                yield record
+        resolved_lsids = {}
+        try:
+            while active_workers > 0:
+                with metrics.timer('stage_seconds', stage='ipc_wait'):
+                    message = record_q.get()
+                if isinstance(message, str):
+                    with metrics.timer('stage_seconds', stage='ipc_receive'):
+                        batch = ala.RecordBatch.from_bytes(message)
+                    yield ('batch', batch)
+                elif message[0] == 'lsid':
+                    resolved_lsids[message[1]] = message[2]
+                elif message[0] == 'stats':
+                    if self.run_stats is not None:
+                        self.run_stats.add_fetch(
+                                tasks[message[1]].species_id, message[2])
+                elif message[0] == 'metrics':
+                    metrics.registry().merge(message[1])
+                else:
+                    kind, task_idx, offset, error = message
+                    if kind == 'finished':
+                        active_workers -= 1
+                    yield (kind, tasks[task_idx], offset, error)
+        except:
+            # the workers would block forever on the full queue
+            pool.terminate()
+            raise
+        finally:
+            if active_workers > 0:
+                pool.terminate()
+                # killed workers never finish their requests
+                gov.reset_in_flight()
 
         # all the subprocesses should be dead by now
         pool.join()
 
+        for species_id, lsid in resolved_lsids.iteritems():
+            self.set_species_lsid(species_id, lsid)
+
+
+class FetchTask(object):
+    '''Plain old data structure for a unit of work for the fetch workers:
+    the records of one species that changed between `changed_since` and
+    `unchanged_since`, skipping the first `start_offset` records.
+
+    `ledger_id` is the id of the sync_ledger row, if there is one.
+    `expected_records` is roughly how many records will be fetched, or None
+    if that isn't known.'''
+
+    def __init__(self, species_id, scientific_name, lsid=None,
+            lsid_verified_time=None, changed_since=None, unchanged_since=None,
+            start_offset=0, ledger_id=None, expected_records=None):
+        self.species_id = species_id
+        self.scientific_name = scientific_name
+        self.lsid = lsid
+        self.lsid_verified_time = lsid_verified_time
+        self.changed_since = changed_since
+        self.unchanged_since = unchanged_since
+        self.start_offset = start_offset
+        self.ledger_id = ledger_id
+        self.expected_records = expected_records
+
+    def __repr__(self):
+        return '<FetchTask {0} {1} expected={2}>'.format(
+                self.species_id, self.scientific_name, self.expected_records)
+
+
+class LedgerCheckpoint(object):
+    '''Plain old data structure for progress made on a sync_ledger row.
+    `status` is 'pending', 'done' or 'failed'. See Syncer.ledger_updates.'''
+
+    def __init__(self, ledger_id, next_offset, status, error=None):
+        self.ledger_id = ledger_id
+        self.next_offset = next_offset
+        self.status = status
+        self.error = error
+
+
+class BackgroundWriter(object):
+    '''Upserts ala.RecordBatch objects through a Syncer on a separate thread,
+    so that fetching records and writing them to the db happen at the same
+    time. LedgerCheckpoint objects can be written too (see Syncer.write).
+
+    Up to `max_pending` batches wait for the writer thread. While the thread
+    flushes one batch, the caller can keep reading more. If the queue is
+    full, `write` blocks, which holds up reading from the fetch workers
+    (backpressure). The time spent blocked on each side is logged by `close`,
+    to show whether fetching or writing is the bottleneck.
+
+    The Syncer must not be used by anything else until `close` returns.'''
+
+    def __init__(self, syncer, max_pending=2):
+        self.syncer = syncer
+        self.records_written = 0
+        self.batches_written = 0
+        # time the caller spent waiting for the writer to make room
+        self.blocked_seconds = 0.0
+        # time the writer spent waiting for the caller to supply a batch
+        self.idle_seconds = 0.0
+        # time the writer spent upserting and flushing
+        self.write_seconds = 0.0
+        self.max_queue_depth = 0
+
+        self._queue = Queue.Queue(max_pending)
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run,
+                name='BackgroundWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, batch):
+        '''Queues `batch` to be upserted. Raises the writer thread's
+        exception if it has failed.'''
+
+        self._raise_if_failed()
+        t = time.time()
+        self._queue.put(batch)
+        self.blocked_seconds += time.time() - t
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def close(self):
+        '''Waits for every queued batch to be written, then flushes and
+        closes the Syncer. Call this even if an error happens.'''
+
+        self._queue.put(None)
+        self._thread.join()
+        log.info('Wrote %d records in %d batches. %0.2fs writing, writer '
+                 'idle for %0.2fs, reader blocked for %0.2fs, max queue '
+                 'depth %d',
+                 self.records_written, self.batches_written,
+                 self.write_seconds, self.idle_seconds, self.blocked_seconds,
+                 self.max_queue_depth)
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self._exc_info is not None:
+            exc_info = self._exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _run(self):
+        while True:
+            t = time.time()
+            batch = self._queue.get()
+            self.idle_seconds += time.time() - t
+            if batch is None:
+                break
+            if self._exc_info is not None:
+                continue  # just drain the queue
 
-def _mp_init(record_q):
-    '''Called when a subprocess is started. See
-    Syncer.occurrences_changed_since'''
+            t = time.time()
+            try:
+                self.syncer.write(batch)
+                if not isinstance(batch, LedgerCheckpoint):
+                    self.records_written += len(batch)
+                    self.batches_written += 1
+            except Exception:
+                log.exception('Background writer failed')
+                self._exc_info = sys.exc_info()
+            self.write_seconds += time.time() - t
+
+        t = time.time()
+        try:
+            self.syncer.close()
+        except Exception:
+            if self._exc_info is None:
+                self._exc_info = sys.exc_info()
+        self.write_seconds += time.time() - t
+
+
+def schedule_tasks(tasks, num_workers):
+    '''Returns the FetchTask objects sorted biggest first (by
+    `expected_records`), which keeps the time until the last worker finishes
+    close to the best possible, as long as each worker takes the next task as
+    soon as it is free. Tasks of unknown size are treated as average sized.
+
+    >>> tasks = [FetchTask(i, str(i), expected_records=n)
+    ...          for i, n in enumerate([10, None, 500, 40, 1000])]
+    >>> [t.expected_records for t in schedule_tasks(tasks, 2)]
+    [1000, 500, None, 40, 10]
+    '''
+
+    known = [t.expected_records for t in tasks
+             if t.expected_records is not None]
+    if len(known) == 0:
+        return list(tasks)
+    average = sum(known) / float(len(known))
+
+    def cost(task):
+        if task.expected_records is None:
+            return average
+        return task.expected_records
+
+    ordered = sorted(tasks, key=cost, reverse=True)
+
+    total = sum(cost(t) for t in ordered)
+    log.info('Fetching about %d records in %d tasks. Biggest task is %d '
+             'records, and the estimated busiest worker gets %d records '
+             '(%d would be perfect)', total, len(ordered), cost(ordered[0]),
+             _busiest_worker(map(cost, ordered), num_workers),
+             total / num_workers)
+    return ordered
+
+
+def _busiest_worker(costs, num_workers):
+    '''Total cost given to the busiest worker, if each cost goes to the
+    least busy worker in order
+
+    >>> _busiest_worker([5, 4, 3, 3, 3], 2)
+    10
+    '''
+    loads = [0] * num_workers
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+def _mp_init(record_q, ipc_batch_size, ipc_flush_interval, gov):
+    '''Called when a subprocess is started. See Syncer._fetch_tasks'''
     _mp_init.record_q = record_q
+    _mp_init.ipc_batch_size = ipc_batch_size
+    _mp_init.ipc_flush_interval = ipc_flush_interval
     _mp_init.log = multiprocessing.log_to_stderr()
+    _mp_init.metrics_sent_time = time.time()
+    # each worker gets its own keep-alive connections
+    ala.reset_connection_pool()
+    ala.set_request_governor(gov)
+    # the metrics recorded by the main process before forking were copied
+    # into this one, and must not be sent back to it again
+    metrics.registry().drain()
 
 
-def _mp_fetch(species_sname, species_id, since_date):
-    '''Gets all relevant records for the given species from ALA, and pumps the
-    records into _mp_init.record_q. Puts None into the queue when finished.
+def _mp_fetch(task_idx, task):
+    '''Gets all relevant records for the given FetchTask from ALA, and pumps
+    them into _mp_init.record_q as packed ala.RecordBatch objects (see
+    _BatchSender), with their `species_id` set.
 
-    Adds a `species_id` attribute to each species object set to the argument
-    given to this function.'''
+    Every LEDGER_CHECKPOINT_INTERVAL records, puts ('progress', task_idx,
+    next_offset, None) into the queue. When finished, puts ('finished',
+    task_idx, next_offset, error) into the queue, where error is None if the
+    task succeeded.
+
+    The LSID cached in the local db is used if it was verified within
+    LSID_TTL. Otherwise the LSID is looked up by scientific name, and sent
+    back to the main process as ('lsid', species_id, lsid).
+
+    Just before finishing, puts ('stats', task_idx, stats) into the queue,
+    where stats is a dict for runstats.RunStats.add_fetch. Also puts
+    ('metrics', drained) into the queue every now and then (see
+    `_send_metrics`).'''
+
+    stats = ala.reset_request_stats()
+    start_time = time.time()
+    progress = [task.start_offset]
+    error = None
     try:
-        _mp_fetch_inner(species_sname, species_id, since_date)
+        # does nothing special unless profiling.enable was called
+        profiling.profile_call('fetch', _mp_fetch_inner, task_idx, task,
+                progress)
     except Exception, e:
         _mp_init.log.critical('mp process failed with expection: ' + str(e))
+        error = '{0}: {1}'.format(type(e).__name__, e)
 
-    _mp_init.record_q.put(None)
+    fetch = stats.to_dict()
+    fetch['records'] = progress[0] - task.start_offset
+    fetch['seconds'] = time.time() - start_time
+    fetch['failed'] = error is not None
+    _mp_init.record_q.put(('stats', task_idx, fetch))
+    _send_metrics(force=True)
+    _mp_init.record_q.put(('finished', task_idx, progress[0], error))
 
-def _mp_fetch_inner(species_sname, species_id, since_date):
-    species = ala.species_for_scientific_name(species_sname)
-    if species is None:
-        _mp_init.log.warning('Species not found at ALA: %s', species_sname)
-        return
+def _mp_fetch_inner(task_idx, task, progress):
+    lsid = task.lsid
+    lsid_is_cached = lsid is not None and \
+            task.lsid_verified_time is not None and \
+            datetime.utcnow() - task.lsid_verified_time < LSID_TTL
 
-    num_records = 0
-    for record in ala.records_for_species(species.lsid, 'search', since_date):
-        record.species_id = species_id
-        _mp_init.record_q.put(record)
-        num_records += 1
+    if not lsid_is_cached:
+        lsid = _resolve_lsid(task)
+        if lsid is None:
+            return
+
+    num_records = _fetch_records(task_idx, task, lsid, progress)
+
+    # A cached LSID might have changed since it was verified. Only a full
+    # fetch is expected to find records, so only check after one of those.
+    if num_records == 0 and lsid_is_cached and task.changed_since is None:
+        new_lsid = _resolve_lsid(task)
+        if new_lsid is not None and new_lsid != lsid:
+            num_records = _fetch_records(task_idx, task, new_lsid, progress)
 
     if num_records > 0:
         _mp_init.log.info('Found %d records for "%s"',
-            num_records, species_sname)
+            num_records, task.scientific_name)
+
+def _resolve_lsid(task):
+    '''Looks up the LSID of a species by name, and sends it to the main
+    process to be cached'''
+    with metrics.timer('stage_seconds', stage='lsid_lookup'):
+        species = ala.species_for_scientific_name(task.scientific_name)
+    if species is None:
+        _mp_init.log.warning('Species not found at ALA: %s',
+                task.scientific_name)
+        return None
+
+    _mp_init.record_q.put(('lsid', task.species_id, species.lsid))
+    return species.lsid
+
+def _fetch_records(task_idx, task, lsid, progress):
+    '''Sends all the records for the task to the main process, and returns
+    the number of records sent. progress[0] is kept up to date with the
+    offset of the next record to fetch.'''
+    num_records = 0
+    last_checkpoint = 0
+    sender = _BatchSender(_mp_init.record_q, task.species_id,
+            _mp_init.ipc_batch_size, _mp_init.ipc_flush_interval)
+    batches = ala.record_batches_for_species(lsid, 'search',
+            task.changed_since, task.unchanged_since,
+            start_index=task.start_offset)
+    try:
+        for batch in batches:
+            sender.add(batch)
+            num_records += len(batch)
+            if num_records - last_checkpoint >= LEDGER_CHECKPOINT_INTERVAL:
+                sender.flush()
+                progress[0] = task.start_offset + num_records
+                last_checkpoint = num_records
+                _mp_init.record_q.put(
+                        ('progress', task_idx, progress[0], None))
+    finally:
+        # whatever was fetched before an error is still good
+        sender.flush()
+        progress[0] = task.start_offset + num_records
+    return num_records
+
+class _BatchSender(object):
+    '''Collects records for one species and puts them into a queue as packed
+    batches (see ala.RecordBatch.to_bytes). Sending one big string is much
+    cheaper than pickling lots of small objects.
+
+    A batch is sent once it has `batch_size` records, or once records have
+    been waiting for `flush_interval` seconds. The interval is only checked
+    when more records arrive, so call `flush` at the end.'''
 
-def _mysql_encode_binary(binstr):
+    def __init__(self, queue, species_id, batch_size, flush_interval):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = ala.RecordBatch(species_id)
+        self.pending_since = None
+
+    def add(self, batch):
+        if len(self.pending) == 0:
+            self.pending_since = time.time()
+        self.pending.extend(batch)
+
+        if len(self.pending) >= self.batch_size or \
+                time.time() - self.pending_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) > 0:
+            # includes time blocked on a full queue, i.e. backpressure
+            with metrics.timer('stage_seconds', stage='ipc_send'):
+                self.queue.put(self.pending.to_bytes())
+            metrics.inc('records_fetched_total', len(self.pending))
+            self.pending.clear()
+            _send_metrics()
+
+
+def _send_metrics(force=False):
+    '''Sends this worker's metrics to the main process, if it has been
+    METRICS_SEND_INTERVAL seconds since they were last sent'''
+    now = time.time()
+    if force or now - _mp_init.metrics_sent_time >= METRICS_SEND_INTERVAL:
+        _mp_init.metrics_sent_time = now
+        _mp_init.record_q.put(('metrics', metrics.registry().drain()))
+
+
+def _mysql_hex_literal(uuid_hex):
     '''
-    >>> _mysql_encode_binary('hello')
-    "x'68656c6c6f'"
+    >>> _mysql_hex_literal('68656c6c6f'), _mysql_hex_literal(None)
+    ("x'68656c6c6f'", 'NULL')
     '''
-    return "x'" + binascii.hexlify(binstr) + "'"
+    if uuid_hex is None:
+        return 'NULL'
+    return "x'" + uuid_hex + "'"
+
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,363 @@
+'''Benchmarks of writing occurrences to the db, for choosing write settings.
+
+A Trial writes a synthetic stream of occurrences through a Syncer into a
+freshly created occurrences table, with one storage engine, write path and
+flush threshold, and measures:
+
+- rows per second, overall and while flushing
+- how long each flush takes
+- lock waits, from MySQL's status counters, optionally with threads reading
+  the table at the same time like the web site does
+- how much the table's data and indexes grow
+
+`update_fraction` of the stream has the uuid of a row that was already
+written, and the rest are new rows. Uuids are the md5 of the seed and a
+counter, so they land all over the unique index like ALA's uuids do, but
+the same seed always gives the same stream.
+
+Only use a scratch database. The occurrences table is dropped and created
+again, from database_structure.sql, for every trial.
+'''
+
+import db
+import ala
+import sync
+import metrics
+import hashlib
+import logging
+import os.path
+import random
+import re
+import struct
+import threading
+import time
+
+#the occurrences table is created from the definition in here
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           os.pardir, 'database_structure.sql')
+#ways of writing upserts that can be compared. 'insert' and 'load' are the
+#Syncer write modes, 'executemany' is a parameterised alternative to
+#'insert' (see ExecutemanySyncer)
+WRITE_PATHS = ('insert', 'load', 'executemany')
+#rows written by the untimed preload, per flush
+PRELOAD_FLUSH_THRESHOLD = 5000
+#seconds a reader thread waits between queries
+READER_PAUSE = 0.01
+#rows a reader thread fetches per query
+READER_LIMIT = 1000
+
+log = logging.getLogger(__name__)
+
+
+class ExecutemanySyncer(sync.Syncer):
+    '''Syncer that flushes with one parameterised INSERT ... ON DUPLICATE
+    KEY UPDATE through DBAPI executemany, instead of formatting every row
+    into one big SQL string. MySQLdb turns it into a multi-row insert.'''
+
+    def __init__(self, flush_threshold=None):
+        sync.Syncer.__init__(self, 'insert', flush_threshold)
+
+    def _flush_upserts_by_insert(self):
+        source_id = int(self.source_row_id)
+        db.engine.execute('''INSERT INTO occurrences(
+                                 latitude, longitude, rating, species_id,
+                                 source_id, source_record_id)
+                             VALUES
+                                 (%s, %s, 'assumed valid', %s, %s, UNHEX(%s))
+                             ON DUPLICATE KEY UPDATE
+                                 latitude=VALUES(latitude),
+                                 longitude=VALUES(longitude),
+                                 rating=VALUES(rating),
+                                 species_id=VALUES(species_id)''',
+                          [(lat, lng, species_id, source_id, uuid_hex)
+                           for lat, lng, species_id, uuid_hex
+                           in self.cached_upserts])
+
+
+class Trial(object):
+    '''One combination of storage `engine` ('MyISAM' or 'InnoDB'),
+    `write_path` (see WRITE_PATHS) and `flush_threshold` (None for the
+    Syncer default).'''
+
+    def __init__(self, engine, write_path, flush_threshold=None):
+        if write_path not in WRITE_PATHS:
+            raise ValueError('Invalid write path: ' + write_path)
+        self.engine = engine
+        self.write_path = write_path
+        self.flush_threshold = flush_threshold
+
+    def __repr__(self):
+        return '<Trial {0} {1} {2}>'.format(self.engine, self.write_path,
+                                            self.flush_threshold)
+
+    def run(self, num_rows, update_fraction=0.1, num_species=800,
+            initial_rows=0, num_readers=0, num_samples=4, seed=0):
+        '''Writes `num_rows` occurrences after preloading `initial_rows`
+        (untimed), with `num_readers` threads querying the table at the same
+        time. The table size is sampled `num_samples` times along the way.
+        Returns a dict of the results.'''
+
+        create_occurrences_table(self.engine)
+        ensure_ala_source()
+        if initial_rows > 0:
+            log.info('Preloading %d rows', initial_rows)
+            preloader = sync.Syncer('insert', PRELOAD_FLUSH_THRESHOLD)
+            for batch in occurrence_stream(initial_rows, 0.0, num_species,
+                                           seed):
+                preloader.upsert_batch(batch)
+            preloader.close()
+
+        samples = [self._sample(0)]
+        locks_before = lock_status()
+        metrics.registry().drain()
+        syncer = make_syncer(self.write_path, self.flush_threshold)
+        readers = [_Reader(num_species) for _ in xrange(num_readers)]
+
+        stream = occurrence_stream(num_rows, update_fraction, num_species,
+                                   seed, num_existing=initial_rows)
+        next_sample = _next_sample(0, num_rows, num_samples)
+        rows_written = 0
+        # only time spent writing counts, not making up the stream or
+        # sampling the table size
+        seconds = 0.0
+        start_time = time.time()
+        try:
+            for batch in stream:
+                t = time.time()
+                syncer.upsert_batch(batch)
+                rows_written += len(batch)
+                if rows_written >= next_sample and rows_written < num_rows:
+                    syncer.flush_upserts()
+                    seconds += time.time() - t
+                    samples.append(self._sample(rows_written))
+                    next_sample = _next_sample(rows_written, num_rows,
+                                               num_samples)
+                else:
+                    seconds += time.time() - t
+            t = time.time()
+            syncer.close()
+            seconds += time.time() - t
+        finally:
+            for reader in readers:
+                reader.stop()
+        wall_seconds = time.time() - start_time
+
+        samples.append(self._sample(rows_written))
+        locks = dict((name, value - locks_before.get(name, 0))
+                     for name, value in lock_status().iteritems())
+        counters, histograms = metrics.registry().drain()
+        flushes = histograms.get(('stage_seconds', (('stage', 'db_flush'),)),
+                                 metrics.Histogram())
+        reads = metrics.Histogram()
+        for reader in readers:
+            reads.merge(reader.latencies)
+
+        first, last = samples[0], samples[-1]
+        new_rows = max(1, last['rows_in_table'] - first['rows_in_table'])
+        return {
+            'engine': self.engine,
+            'write_path': self.write_path,
+            'flush_threshold': syncer.flush_threshold,
+            'rows': rows_written,
+            'update_fraction': update_fraction,
+            'initial_rows': initial_rows,
+            'seconds': seconds,
+            'rows_per_second': rows_written / seconds,
+            'flush_rows_per_second': rows_written / flushes.sum
+                                     if flushes.sum else None,
+            'flushes': flushes.count,
+            'flush_p50': flushes.quantile(0.5),
+            'flush_p95': flushes.quantile(0.95),
+            'flush_max': flushes.max,
+            'table_locks_waited': locks.get('Table_locks_waited'),
+            'innodb_row_lock_waits': locks.get('Innodb_row_lock_waits'),
+            'innodb_row_lock_ms': locks.get('Innodb_row_lock_time'),
+            'readers': num_readers,
+            'reads_per_second': reads.count / wall_seconds,
+            'read_p95': reads.quantile(0.95),
+            'index_bytes_per_new_row': (last['index_bytes'] -
+                                        first['index_bytes']) /
+                                       float(new_rows),
+            'samples': samples,
+        }
+
+    def _sample(self, rows_written):
+        data_bytes, index_bytes, rows_in_table = table_size(
+                analyze=self.engine.lower() == 'innodb')
+        return {
+            'rows_written': rows_written,
+            'rows_in_table': rows_in_table,
+            'data_bytes': data_bytes,
+            'index_bytes': index_bytes,
+        }
+
+
+class _Reader(object):
+    '''Thread that keeps fetching the occurrences of random species, like
+    the web site does, until stopped'''
+
+    def __init__(self, num_species):
+        self.num_species = num_species
+        self.latencies = metrics.Histogram()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='Reader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        rng = random.Random()
+        conn = db.engine.connect()
+        try:
+            while not self._stopped.wait(READER_PAUSE):
+                t = time.time()
+                conn.execute('''SELECT latitude, longitude FROM occurrences
+                                WHERE species_id = %s LIMIT %s''',
+                             rng.randint(1, self.num_species),
+                             READER_LIMIT).fetchall()
+                self.latencies.observe(time.time() - t)
+        finally:
+            conn.close()
+
+
+def make_syncer(write_path, flush_threshold=None):
+    if write_path == 'executemany':
+        return ExecutemanySyncer(flush_threshold)
+    return sync.Syncer(write_path, flush_threshold)
+
+
+def occurrence_stream(num_rows, update_fraction, num_species, seed=0,
+        num_existing=0, batch_size=None):
+    '''Generator for ala.RecordBatch objects holding `num_rows` records
+    between them. Records with counters below `num_existing` are assumed to
+    be in the db already. Each record is an update of an earlier record
+    with probability `update_fraction`, otherwise it is new. A record always
+    belongs to the same species, and batches only hold one species.
+
+    >>> batches = list(occurrence_stream(1000, 0.25, 3, seed=1,
+    ...                                  batch_size=100))
+    >>> sum(len(b) for b in batches)
+    1000
+    >>> uuids = [b.uuid_bytes(i) for b in batches for i in xrange(len(b))]
+    >>> len(set(uuids))
+    753
+    >>> sorted(set(b.species_id for b in batches))
+    [1, 2, 3]
+    '''
+    if batch_size is None:
+        batch_size = ala.BATCH_SIZE
+
+    rng = random.Random(seed)
+    prefix = struct.pack('<Q', seed)
+    pending = {}
+    num_counters = num_existing
+    for _ in xrange(num_rows):
+        if num_counters > 0 and rng.random() < update_fraction:
+            counter = rng.randrange(num_counters)
+        else:
+            counter = num_counters
+            num_counters += 1
+
+        species_id = 1 + counter % num_species
+        batch = pending.get(species_id)
+        if batch is None:
+            batch = pending[species_id] = ala.RecordBatch(species_id)
+        batch.append(rng.uniform(-43.0, -10.0), rng.uniform(113.0, 153.0),
+                     _uuid_bytes(prefix, counter))
+        if len(batch) >= batch_size:
+            yield batch
+            del pending[species_id]
+
+    for species_id in sorted(pending):
+        yield pending[species_id]
+
+
+def occurrences_ddl(schema_sql, engine):
+    '''Returns the CREATE TABLE statement of the occurrences table in
+    `schema_sql`, changed to use the given storage engine. InnoDB doesn't
+    support ROW_FORMAT=FIXED, so that is dropped for it.
+
+    >>> sql = """CREATE TABLE IF NOT EXISTS `occurrences` (
+    ...     `id` INT UNSIGNED NOT NULL
+    ... )
+    ... ENGINE=MyISAM
+    ... ROW_FORMAT=FIXED;
+    ... CREATE TABLE `other` (`id` INT);"""
+    >>> print occurrences_ddl(sql, 'InnoDB')
+    CREATE TABLE IF NOT EXISTS `occurrences` (
+        `id` INT UNSIGNED NOT NULL
+    )
+    ENGINE=InnoDB
+    '''
+    match = re.search(r'CREATE TABLE IF NOT EXISTS `occurrences` .*?;',
+                      schema_sql, re.DOTALL)
+    if match is None:
+        raise RuntimeError('No occurrences table in the schema')
+    ddl = match.group(0).rstrip(';')
+    ddl = re.sub(r'ENGINE=\w+', 'ENGINE=' + engine, ddl)
+    if engine.lower() == 'innodb':
+        ddl = re.sub(r'\s*ROW_FORMAT=FIXED', '', ddl)
+    return ddl
+
+
+def create_occurrences_table(engine, schema_path=SCHEMA_PATH):
+    '''Drops the occurrences table, and creates it again empty'''
+    with open(schema_path, 'rb') as f:
+        ddl = occurrences_ddl(f.read(), engine)
+    db.engine.execute('DROP TABLE IF EXISTS occurrences')
+    db.engine.execute(ddl)
+
+
+def ensure_ala_source():
+    '''Syncer needs the ALA row in the sources table'''
+    row = db.sources.select().where(db.sources.c.name == 'ALA')\
+            .execute().fetchone()
+    if row is None:
+        db.sources.insert().execute(name='ALA', last_import_time=None)
+
+
+def table_size(analyze=False):
+    '''Returns (data bytes, index bytes, rows) of the occurrences table.
+    InnoDB only updates its sizes when the table is analyzed, and even then
+    the row count is an estimate.'''
+    if analyze:
+        db.engine.execute('ANALYZE TABLE occurrences').fetchall()
+    row = db.engine.execute('''SELECT data_length, index_length
+                               FROM information_schema.TABLES
+                               WHERE table_schema = DATABASE()
+                               AND table_name = 'occurrences' ''').fetchone()
+    num_rows = db.engine.execute('SELECT COUNT(*) FROM occurrences')\
+            .scalar()
+    return int(row[0]), int(row[1]), int(num_rows)
+
+
+def lock_status():
+    '''Returns MySQL's counters of lock waits, as a dict'''
+    rows = db.engine.execute('''SHOW GLOBAL STATUS WHERE Variable_name IN (
+                                    'Table_locks_waited',
+                                    'Table_locks_immediate',
+                                    'Innodb_row_lock_waits',
+                                    'Innodb_row_lock_time')''')
+    return dict((name, int(value)) for name, value in rows)
+
+
+def _next_sample(rows_written, num_rows, num_samples):
+    '''
+    >>> _next_sample(0, 1000, 4), _next_sample(250, 1000, 4)
+    (250, 500)
+    '''
+    step = max(1, num_rows // num_samples)
+    return (rows_written // step + 1) * step
+
+
+def _uuid_bytes(prefix, counter):
+    return hashlib.md5(prefix + struct.pack('<Q', counter)).digest()
+
+
+if __name__ == "__main__":
+    print 'Doctesting...'
+    import doctest
+    doctest.testmod()